@@ -1,25 +1,179 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
+
 from objct.logger import logger
+# Processus d'acquisition lancé par le GUI (voir ACQUISITION_PROCESS). Il écrit dans ses propres
+# fichiers de log.
+ACQUISITION_PROCESS_MODE = '--acquisition-process' in sys.argv
+if ACQUISITION_PROCESS_MODE:
+    logger.set_log_directory('./logs/acquisition')
 logger.log_app_start()
 
-import sys
-
-from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QApplication
+import locale
+import os
 
-from objct.main_window import MainWindow
-from objct.speed_thread import SpeedThread, SpeedThreadSimulator
+from objct.acquisition import SpeedAcquisition, SpeedAcquisitionSimulator
+from objct.acquisition_engine import AcquisitionEngine
+from objct.live_buffer import LiveServer, SampleRing
+from objct.metrics import MetricsServer, metrics
+from objct.shared_channel import ChannelService, SharedChannel, launch_acquisition_process
 
 
 SIMULATOR_ON = True  # Définit si l'on simule la connexion à l'automate
+HEADLESS = '--headless' in sys.argv or ACQUISITION_PROCESS_MODE  # Acquisition sans interface
+                                     # graphique (PyQt n'est pas chargé), par exemple sur un
+                                     # serveur sans écran
+# Si vrai (et MACHINES vide), l'acquisition tourne dans un processus séparé, lancé par le GUI
+# si il ne tourne pas déjà (main.py --acquisition-process), qui publie les vitesses dans la
+# mémoire partagée SHARED_CHANNEL_NAME. Le GUI peut être fermé et relancé sans interrompre
+# l'enregistrement. Le processus d'acquisition s'arrête avec main.py --stop-acquisition-process
+# (ou "Server Mondon.exe --stop-acquisition-process").
+ACQUISITION_PROCESS = False
+SHARED_CHANNEL_NAME = SharedChannel.NAME
 DB_LOCATION = '../mondon.db'
 AUTOMATE_IP = '192.168.0.50'
 AUTOMATE_PORT = 9600
+AUTOMATE_TRANSPORT = SpeedAcquisition.TRANSPORT_TCP  # TRANSPORT_UDP pour FINS/UDP (même port)
+# Nœuds FINS des commandes en FINS/UDP (non utilisés en FINS/TCP) : celui de l'automate (DA1)
+# et celui de ce PC (SA1), tels que configurés sur le réseau FINS. En adressage automatique,
+# c'est le dernier octet de l'adresse IP (ex: 50 pour AUTOMATE_IP).
+AUTOMATE_UDP_DA1 = SpeedAcquisition.UDP_DA1
+AUTOMATE_UDP_SA1 = SpeedAcquisition.UDP_SA1
+POLL_PERIOD_MS = SpeedAcquisition.SLEEP_TIME_MS  # Temps entre deux lectures de la vitesse (ex: 50
+                                                 # pour analyser les accélérations)
+MAX_IN_FLIGHT = 1  # Requêtes envoyées sans attendre la réponse de la précédente. À augmenter (ex: 4)
+                   # quand POLL_PERIOD_MS est proche du temps aller-retour avec l'automate.
+DB_BATCH_SIZE = 25  # Nombre de vitesses écrites dans une seule transaction
+DB_BATCH_DELAY_MS = 2000  # Temps maximum qu'une vitesse attend avant d'être écrite
+# None pour écrire toutes les valeurs (une ligne par lecture). DeadbandPolicy(deadband=0,
+# heartbeat_ms=5000) (de objct.storage_policy) n'écrit une valeur que quand elle change,
+# avec au moins une ligne toutes les heartbeat_ms millisecondes : les outils qui lisent
+# mondon_speed doivent alors reconstruire le signal en escalier (voir
+# Database.iter_speed_steps).
+DB_STORAGE_POLICY = None
+# None pour tout écrire dans DB_LOCATION. Pour écrire dans un fichier par jour
+# (../mondon_AAAAMMJJ.db, ../mondon.db reste lu s'il existe), avec from objct.partition import
+# Partitioning :
+# DB_PARTITIONING = Partitioning(Partitioning.DAY, retention_days=None, archive_directory=None)
+# retention_days supprime (ou déplace dans archive_directory) les partitions plus anciennes.
+# Les outils qui lisent DB_LOCATION directement ne voient alors plus les nouvelles vitesses.
+DB_PARTITIONING = None
+# Fichier où SpeedThread dépose les vitesses avant leur écriture dans la base de données (pour ne
+# jamais attendre ni perdre de vitesse si la base de données est verrouillée), par exemple
+# '../mondon.spool'. None pour écrire directement dans la base de données.
+SPOOL_LOCATION = None
+# Automates interrogés ensemble par `AcquisitionEngine`. Si la liste est vide, seul l'automate
+# AUTOMATE_IP est interrogé par `SpeedThread`. Une seule machine peut avoir store_speed.
+# Exemple (avec from objct.acquisition_engine import MachineConfig) :
+# MACHINES = [
+#     MachineConfig('mondon', AUTOMATE_IP, AUTOMATE_PORT, store_speed=True),
+#     MachineConfig('ligne_2', '192.168.0.51'),
+# ]
+MACHINES = []
+# Port HTTP local où les métriques (durée des échanges avec l'automate, des transactions, retard
+# des échéances, ...) sont exposées au format Prometheus sur /metrics. None pour ne pas l'ouvrir.
+METRICS_PORT = 9108
+METRICS_LOG_INTERVAL_S = 300  # Temps entre deux résumés des métriques dans le log (None: aucun)
+# Les dernières heures de vitesses sont gardées en mémoire et servies en JSON sur LIVE_PORT
+# (/latest, /window, /stats) : les tableaux de bord ne chargent pas la base de données.
+# LIVE_HOST à '0.0.0.0' pour les rendre accessibles depuis le réseau, LIVE_PORT à None pour ne
+# pas ouvrir le serveur.
+LIVE_BUFFER_HOURS = 4
+LIVE_HOST = '127.0.0.1'
+LIVE_PORT = 9109
+LOG_LEVEL = logger.INFO  # Niveau de log par défaut
+LOG_CATEGORY_LEVELS = {  # Niveau de log par catégorie (logger.DEBUG pour avoir chaque échange)
+    "SPEED_THREAD": logger.INFO,
+    "FINS": logger.INFO,
+    "ENGINE": logger.INFO,
+    "DATABASE": logger.WARNING,
+    "METRICS": logger.INFO,
+    "LIVE": logger.INFO,
+    "SHARED": logger.INFO,
+}
+
+logger.set_level(LOG_LEVEL)
+for category, level in LOG_CATEGORY_LEVELS.items():
+    logger.set_level(level, category)
+
+# La locale est définie une seule fois, avant le démarrage des threads (setlocale modifie tout
+# le processus et n'est pas thread-safe)
+locale.setlocale(locale.LC_TIME, '')
+
+DB_OPTIONS = {  # Paramètres de la base de données communs à tous les modes
+    'db_batch_size': DB_BATCH_SIZE,
+    'db_batch_delay_ms': DB_BATCH_DELAY_MS,
+    'db_storage_policy': DB_STORAGE_POLICY,
+    'db_partitioning': DB_PARTITIONING,
+}
+
+ACQUISITION_OPTIONS = {  # Paramètres de l'interrogation de l'automate par SpeedThread
+    'period_ms': POLL_PERIOD_MS,
+    'transport': AUTOMATE_TRANSPORT,
+    'da1': AUTOMATE_UDP_DA1,
+    'sa1': AUTOMATE_UDP_SA1,
+    'max_in_flight': MAX_IN_FLIGHT,
+}
+
+if '--stop-acquisition-process' in sys.argv:
+    # Demande l'arrêt du processus d'acquisition par la mémoire partagée (pas de SIGTERM sous
+    # Windows). Il écrit ses vitesses bufferisées avant de s'arrêter.
+    if SharedChannel.stop_running(SHARED_CHANNEL_NAME):
+        logger.log("INITIALISATION", "Arrêt du processus d'acquisition demandé")
+    else:
+        logger.log("INITIALISATION", "Aucun processus d'acquisition à arrêter")
+    sys.exit(0)
+
+# Sans processus d'acquisition séparé, ce processus interroge l'automate et sert les vitesses
+# récentes et les métriques
+OWNS_ACQUISITION = HEADLESS or not ACQUISITION_PROCESS or bool(MACHINES)
+
+live_buffer = SampleRing.for_duration(LIVE_BUFFER_HOURS, POLL_PERIOD_MS)
+live_server = LiveServer(live_buffer, LIVE_PORT, LIVE_HOST) \
+    if LIVE_PORT is not None and OWNS_ACQUISITION else None
+if live_server:
+    live_server.start()
+
+metrics_server = MetricsServer(metrics, port=METRICS_PORT, log_interval_s=METRICS_LOG_INTERVAL_S)
+if OWNS_ACQUISITION:
+    metrics_server.start()
+
+if HEADLESS:
+    from objct.headless import run_headless
+
+    channel = None
+    if MACHINES:
+        logger.log("INITIALISATION", "Création de AcquisitionEngine pour {} machines (sans "
+                                     "interface)", len(MACHINES))
+        service = AcquisitionEngine(DB_LOCATION, MACHINES, live_buffer=live_buffer, **DB_OPTIONS)
+    else:
+        logger.log("INITIALISATION", "Création de SpeedAcquisition{} (sans interface)"
+                   .format(" (Simulator)" if SIMULATOR_ON else ""))
+        acquisition_class = SpeedAcquisitionSimulator if SIMULATOR_ON else SpeedAcquisition
+        channel = SharedChannel.create(SHARED_CHANNEL_NAME) if ACQUISITION_PROCESS_MODE else None
+        service = acquisition_class(automate_ip=AUTOMATE_IP, automate_port=AUTOMATE_PORT,
+                                    db_location=DB_LOCATION, spool_location=SPOOL_LOCATION,
+                                    live_buffer=live_buffer, **ACQUISITION_OPTIONS,
+                                    **DB_OPTIONS, **(channel.callbacks() if channel else {}))
+        if channel:
+            service = ChannelService(channel, service)
+    run_headless(service, should_stop=channel.stop_requested if channel else None)
+    metrics_server.stop()
+    if live_server:
+        live_server.stop()
+    sys.exit(0)
+
+# PyQt n'est importé que pour le GUI
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWidgets import QApplication
 
+from objct.main_window import MainWindow
+from objct.speed_thread import EngineSignals, SharedChannelWatcher, SpeedThread, \
+    SpeedThreadSimulator
 
-logger.log("INITIALISATION", "Création de la QApplication avec les paramètres: {}".format(sys.argv))
+logger.log("INITIALISATION", "Création de la QApplication avec les paramètres: {}", sys.argv)
 app = QApplication(sys.argv)
 
 logger.log("INITIALISATION", "Définition de l'icone de l'application")
@@ -29,21 +183,64 @@ logger.log("INITIALISATION", "Création de MainWindow")
 window = MainWindow()
 
 logger.log("INITIALISATION", "Configuration de MainWindow")
-window.setFixedSize(400, 50)
+window.setFixedSize(400, 80 if MACHINES else 50)
 window.setWindowTitle("Get speed")
 
 logger.log("INITIALISATION", "Affichage de MainWindow")
 window.show()
 
+if MACHINES:
+    logger.log("INITIALISATION", "Création de AcquisitionEngine pour {} machines", len(MACHINES))
+    engine_signals = EngineSignals()
+    engine = AcquisitionEngine(DB_LOCATION, MACHINES,
+                               on_status=engine_signals.handle_status,
+                               on_new_speed=engine_signals.handle_new_speed,
+                               on_error=engine_signals.handle_error, live_buffer=live_buffer,
+                               **DB_OPTIONS)
+
+    logger.log("INITIALISATION", "MainWindow écoute AcquisitionEngine")
+    window.watch_signals(engine_signals.speeds, engine_signals.ERROR_SIGNAL)
+    window.watch_status_signal(engine_signals.STATUS_SIGNAL)
+    app.aboutToQuit.connect(engine.stop)
+    app.aboutToQuit.connect(metrics_server.stop)
+    if live_server:
+        app.aboutToQuit.connect(live_server.stop)
+
+    logger.log("INITIALISATION", "Démarrage de AcquisitionEngine")
+    engine.start()
+    sys.exit(app.exec_())
+
+if ACQUISITION_PROCESS:
+    if not SharedChannel.is_running(SHARED_CHANNEL_NAME):
+        logger.log("INITIALISATION", "Démarrage du processus d'acquisition")
+        launch_acquisition_process(os.path.abspath(__file__))
+    logger.log("INITIALISATION", "MainWindow écoute le processus d'acquisition")
+    watcher = SharedChannelWatcher(SHARED_CHANNEL_NAME)
+    window.watch_signals(watcher.speeds, watcher.ERROR_SIGNAL)
+    # Le processus d'acquisition continue après la fermeture du GUI
+    app.aboutToQuit.connect(watcher.stop)
+    watcher.start()
+    sys.exit(app.exec_())
+
 logger.log("INITIALISATION", "Création de SpeedThread{}"
            .format(" (Simulator)" if SIMULATOR_ON else ""))
 if SIMULATOR_ON:
-    speed_thread = SpeedThreadSimulator(automate_ip=None, automate_port=None, db_location=DB_LOCATION)
+    speed_thread = SpeedThreadSimulator(automate_ip=None, automate_port=None, db_location=DB_LOCATION,
+                                        spool_location=SPOOL_LOCATION, live_buffer=live_buffer,
+                                        **ACQUISITION_OPTIONS, **DB_OPTIONS)
 else:
-    speed_thread = SpeedThread(automate_ip=AUTOMATE_IP, automate_port=AUTOMATE_PORT, db_location=DB_LOCATION)
+    speed_thread = SpeedThread(automate_ip=AUTOMATE_IP, automate_port=AUTOMATE_PORT, db_location=DB_LOCATION,
+                               spool_location=SPOOL_LOCATION, live_buffer=live_buffer,
+                               **ACQUISITION_OPTIONS, **DB_OPTIONS)
 
 logger.log("INITIALISATION", "MainWindow écoute SpeedThread")
-window.watch_signals(speed_thread.NEW_SPEED_SIGNAL, speed_thread.ERROR_SIGNAL)
+window.watch_signals(speed_thread.speeds, speed_thread.ERROR_SIGNAL)
+
+logger.log("INITIALISATION", "Arrêt de SpeedThread (et écriture du buffer) à la fermeture")
+app.aboutToQuit.connect(speed_thread.stop)
+app.aboutToQuit.connect(metrics_server.stop)
+if live_server:
+    app.aboutToQuit.connect(live_server.stop)
 
 logger.log("INITIALISATION", "Démarrage de SpeedThread")
 speed_thread.start()
@@ -0,0 +1,549 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+from random import randint
+import socket
+import threading
+import time
+
+from objct.automate_command import CONNECT, SPEED_TAG, TagSet
+from objct.backoff import Backoff
+from objct.base_de_donnee import ConnectionProfile, Database
+from objct.fins import FinsError, FinsPipeline, FinsTcpTransport, FinsUdpTransport
+from objct.logger import logger
+from objct.metrics import metrics
+from objct.scheduler import FixedRateScheduler
+from objct.spool import Spool, SpoolDrainer
+
+
+POLL_DURATION = metrics.histogram('poll_cycle_duration_ms',
+                                  "Durée d'une échéance : lecture de l'automate et sauvegarde")
+POLL_FAILURES = metrics.counter('poll_failures_total',
+                                "Nombre d'erreurs de la boucle d'acquisition")
+
+
+class SpeedAcquisition:
+    """
+    Boucle d'acquisition qui se charge de se connecter à l'automate et de communiquer avec lui.
+    S'occupe de récupérer les nouvelles vitesses (et les autres tags de `TAGS`) et de les insérer
+    dans la base de données.
+    N'utilise pas Qt : les événements sont transmis par des fonctions de rappel (`on_new_speed`,
+    `on_error`, `on_state`), et la boucle tourne dans un thread Python (`start`) ou dans le
+    thread appelant (`run`). `SpeedThread` l'enveloppe dans un QThread pour le GUI.
+    """
+    SLEEP_TIME_MS = 240
+    TAGS = [SPEED_TAG]  # Tags lus à chaque échéance, en une seule requête. Le tag `SPEED_TAG` va
+                        # dans la table `mondon_speed`, les autres dans `mondon_tag`.
+    SLEEP_ON_ERROR_MS = 1000  # Temps d'attente après la première erreur, doublé à chaque
+                              # nouvel échec consécutif jusqu'à MAX_SLEEP_ON_ERROR_MS
+    MAX_SLEEP_ON_ERROR_MS = 30000
+    DEGRADED_AFTER_FAILURES = 5  # Nombre d'échecs consécutifs avant de passer en état DEGRADED
+    SOCKET_TIMEOUT_MS = 2000  # Temps maximum d'attente d'une réponse de l'automate
+    # Sans spool, les vitesses sont écrites par le thread d'acquisition : une écriture bloquée
+    # par un verrou n'attend pas plus de DB_BUSY_TIMEOUT_MS (une seule tentative), les vitesses
+    # restent dans le buffer et sont écrites à l'écriture suivante.
+    DB_BUSY_TIMEOUT_MS = 100
+    DB_FLUSH_ATTEMPTS = 1
+    USE_SCHEDULED_TIME = False  # Si vrai, chaque vitesse est enregistrée avec le temps auquel
+                                # elle était prévue (grille exacte de SLEEP_TIME_MS) plutôt
+                                # qu'avec le temps auquel elle a été reçue.
+    TRANSPORT_TCP = 'tcp'
+    TRANSPORT_UDP = 'udp'
+    TRANSPORT = TRANSPORT_TCP  # Transport FINS utilisé pour interroger l'automate
+    # Nœuds FINS des commandes envoyées en FINS/UDP, qui doivent être ceux de la configuration du
+    # réseau (en FINS/UDP, l'automate répond au nœud SA1) : nœud de l'automate (DA1) et de ce PC
+    # (SA1). En FINS/TCP, les commandes gardent les nœuds de `AutomateCommand.from_fins`.
+    UDP_DA1 = 0x01
+    UDP_SA1 = 0xEF
+    MAX_IN_FLIGHT = 1  # Nombre maximum de requêtes envoyées sans attendre leur réponse. Au delà
+                       # de 1, les requêtes sont envoyées à chaque échéance et les réponses
+                       # traitées à leur arrivée (voir `FinsPipeline`) : la période peut être
+                       # plus courte que le temps aller-retour avec l'automate.
+
+    # États du superviseur (voir `run`)
+    STATE_STOPPED = 'STOPPED'
+    STATE_CONNECTING = 'CONNECTING'
+    STATE_POLLING = 'POLLING'
+    STATE_BACKOFF = 'BACKOFF'
+    STATE_DEGRADED = 'DEGRADED'
+
+    def __init__(self, automate_ip, automate_port, db_location,
+                 db_batch_size=None, db_batch_delay_ms=None, use_scheduled_time=None,
+                 tags=None, db_storage_policy=None, db_partitioning=None, spool_location=None,
+                 live_buffer=None, period_ms=None, transport=None, max_in_flight=None,
+                 da1=None, sa1=None, on_new_speed=None, on_error=None, on_state=None):
+        """
+        Crée une nouvelle instance de SpeedAcquisition
+        :param db_batch_size: Nombre de vitesses écrites ensemble dans la base de données
+        :param db_batch_delay_ms: Temps maximum avant l'écriture des vitesses bufferisées
+        :param use_scheduled_time: Enregistre les vitesses avec leur temps prévu
+                                   (par défaut `USE_SCHEDULED_TIME`)
+        :param tags: Liste de `Tag` à lire à chaque échéance (par défaut `TAGS`)
+        :param db_storage_policy: Politique qui choisit les valeurs écrites dans la base de
+                                  données (ex: `DeadbandPolicy`), par défaut toutes
+        :param db_partitioning: `Partitioning` de la base de données (par défaut un seul fichier)
+        :param spool_location: Chemin d'un `Spool`. Si il est donné, les valeurs sont déposées
+                               dans le spool et écrites dans la base de données par un
+                               `SpoolDrainer` : l'acquisition n'attend jamais la base de données.
+        :param live_buffer: `SampleRing` où chaque vitesse lue est ajoutée tout de suite (avant
+                            son écriture dans la base de données), pour `LiveServer`
+        :param period_ms: Temps entre deux lectures de l'automate (par défaut `SLEEP_TIME_MS`)
+        :param transport: `TRANSPORT_TCP` ou `TRANSPORT_UDP` (par défaut `TRANSPORT`)
+        :param max_in_flight: Nombre maximum de requêtes en cours (par défaut `MAX_IN_FLIGHT`)
+        :param da1: Nœud FINS de l'automate en FINS/UDP (par défaut `UDP_DA1`)
+        :param sa1: Nœud FINS de ce PC en FINS/UDP (par défaut `UDP_SA1`)
+        :param on_new_speed: Fonction appelée avec (vitesse, temps) une fois la vitesse écrite dans
+                             la base de données
+        :param on_error: Fonction appelée avec le message d'erreur
+        :param on_state: Fonction appelée avec le nouvel état du superviseur
+        """
+        self.on_new_speed = on_new_speed
+        self.on_error = on_error
+        self.on_state = on_state
+        self._thread = None
+        self.socket = None
+        self.transport = None
+        self.pipeline = None
+        self.db = None
+        self.automate_ip = automate_ip
+        self.automate_port = automate_port
+        self.db_location = db_location
+        self.db_batch_size = db_batch_size
+        self.db_batch_delay_ms = db_batch_delay_ms
+        self.db_storage_policy = db_storage_policy
+        self.db_partitioning = db_partitioning
+        self.spool_location = spool_location
+        self.live_buffer = live_buffer
+        self.spool = None
+        self.drainer = None
+        self.running = False
+        self.transport_type = transport or SpeedAcquisition.TRANSPORT
+        if self.transport_type not in (SpeedAcquisition.TRANSPORT_TCP,
+                                       SpeedAcquisition.TRANSPORT_UDP):
+            raise ValueError("Transport inconnu: {}".format(self.transport_type))
+        nodes = {}
+        if self.transport_type == SpeedAcquisition.TRANSPORT_UDP:
+            nodes = {'da1': SpeedAcquisition.UDP_DA1 if da1 is None else da1,
+                     'sa1': SpeedAcquisition.UDP_SA1 if sa1 is None else sa1}
+        self.tags = tags or SpeedAcquisition.TAGS
+        self.tag_set = TagSet('GET_TAGS', self.tags, **nodes)
+        self.max_in_flight = max_in_flight or SpeedAcquisition.MAX_IN_FLIGHT
+        self.period_ms = period_ms or SpeedAcquisition.SLEEP_TIME_MS
+        self.use_scheduled_time = SpeedAcquisition.USE_SCHEDULED_TIME \
+            if use_scheduled_time is None else use_scheduled_time
+        self._stop_event = threading.Event()  # Permet d'interrompre les pauses lors de l'arrêt
+        self.scheduler = FixedRateScheduler(self.period_ms, sleep=self._stop_event.wait)
+        self.backoff = Backoff(initial_ms=SpeedAcquisition.SLEEP_ON_ERROR_MS,
+                               max_ms=SpeedAcquisition.MAX_SLEEP_ON_ERROR_MS)
+        self.state = SpeedAcquisition.STATE_STOPPED
+        self.consecutive_failures = 0
+        self.transition_counts = {}  # Nombre de passages par transition, ex: "POLLING->BACKOFF"
+
+    def _init_socket(self):
+        """
+        Crée une nouvelle socket (et ferme la socket courante si il y en a une) et connecte la
+        à l'automate.
+        """
+        logger.debug("SPEED_THREAD", "Initialization de la socket")
+        if self.socket:
+            logger.debug("SPEED_THREAD", "Socket déjà initialisée, fermeture de la socket")
+            self._close_socket()
+        logger.debug("SPEED_THREAD", "Création d'une socket")
+        if self.transport_type == SpeedAcquisition.TRANSPORT_UDP:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Les requêtes envoyées sans attendre la réponse précédente partent tout de suite
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.settimeout(SpeedAcquisition.SOCKET_TIMEOUT_MS / 1000)
+        logger.info("SPEED_THREAD", "Connexion à {}:{} ({})", self.automate_ip,
+                    self.automate_port, self.transport_type)
+        self.socket.connect((self.automate_ip, self.automate_port))
+
+    def _close_socket(self):
+        """
+        Ferme la socket courante si il y en a une.
+        """
+        if self.socket:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+        self.socket = None
+        self.transport = None
+        self.pipeline = None
+
+    def _connect(self):
+        """
+        Initialise la connexion à l'automate
+        """
+        self._init_socket()  # Création de la socket
+        if self.transport_type == SpeedAcquisition.TRANSPORT_UDP:
+            # Pas de connexion en FINS/UDP : la première requête vérifie que l'automate répond
+            self.transport = FinsUdpTransport(self.socket)
+        else:
+            self.transport = FinsTcpTransport(self.socket)
+            # Envoi du message initial de connexion, l'automate répond avec les adresses de nœud
+            self.transport.handshake(CONNECT)
+        if self.max_in_flight > 1:
+            self.pipeline = FinsPipeline(self.transport, self.max_in_flight)
+
+    def _read_tags(self):
+        """
+        Récupère la valeur courante de tous les tags en une seule requête à l'automate.
+        :return: Dictionnaire nom du tag -> valeur
+        """
+        return self._decode_tags(self.transport.request(self.tag_set.command))
+
+    def _decode_tags(self, response):
+        """
+        Décode la réponse à la lecture des tags.
+        :param response: `FinsResponse` de la commande de `tag_set`
+        :return: Dictionnaire nom du tag -> valeur
+        """
+        try:
+            values = self.tag_set.decode(response.payload)
+        except ValueError as e:
+            raise FinsError("Réponse invalide après tentative de récupération des tags de "
+                            "l'automate: {}".format(e))
+        logger.debug("SPEED_THREAD", "Nouvelles valeurs reçues: {}", values)
+        return values
+
+    @staticmethod
+    def timestamp_to_date(millitimestamp):
+        """
+        Utilitaire pour convertir un millitimestamp en date + heure.
+        La locale doit être définie une seule fois au démarrage (voir `main.py`).
+        :param millitimestamp: le millitimestamp à convertir
+        :return: Un string au format
+                 "<années>:<mois>:<jours> <heures>:<minutes>:<secondes>.<millisecondes>"
+                 ou "????-??-?? ??:??:??" en cas d'erreur.
+        """
+        ts = millitimestamp / 1000
+        try:
+            return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S.%f')
+        except:
+            return '????-??-?? ??:??:??'
+
+    def _emit_durable_speeds(self, durable_speeds):
+        """
+        Signal les vitesses qui ont été écrites dans la base de données.
+        :param durable_speeds: Liste de (value, time) écrites dans la base de données
+        """
+        if self.on_new_speed:
+            for speed, ts in durable_speeds:
+                self.on_new_speed(speed, ts)
+
+    def _emit_error(self, error):
+        """
+        Signal une erreur.
+        :param error: Message d'erreur
+        """
+        if self.on_error:
+            self.on_error(error)
+
+    def _save_speed(self, ts, speed, tags=None):
+        """
+        Gère l'insertion de la nouvelle vitesse dans la base de données et signal le résultat.
+        `on_new_speed` n'est appelé qu'une fois la vitesse écrite dans la base de données (ce qui
+        peut arriver plus tard si les écritures sont groupées).
+        :param speed_value: Nouvelle vitesse
+        :param ts: Millitimestamp de quand on a reçu la vitesse
+        :param tags: Valeurs des autres tags lus avec la vitesse (nom du tag -> valeur)
+        """
+        logger.debug("SPEED_THREAD", "Insert vitesse {} au temps {}", speed, ts)
+        try:
+            if self.spool:
+                if tags:
+                    self.spool.append_tags(ts, tags)
+                self.spool.append_speed(ts, speed)
+                return
+            self._emit_durable_speeds(self.db.insert_speed(speed, ts, tags))
+        except Exception as e:
+            self._emit_error(str(e))
+            logger.error("SPEED_THREAD", "Erreur lors de l'insertion dans la base de données: {}",
+                         e)
+
+    def _save_tags(self, ts, values):
+        """
+        Gère l'insertion des valeurs des tags (autres que la vitesse) dans la base de données.
+        :param ts: Millitimestamp de quand on a reçu les valeurs
+        :param values: Dictionnaire nom du tag -> valeur
+        """
+        try:
+            if self.spool:
+                self.spool.append_tags(ts, values)
+                return
+            self._emit_durable_speeds(self.db.insert_tags(ts, values))
+        except Exception as e:
+            self._emit_error(str(e))
+            logger.error("SPEED_THREAD", "Erreur lors de l'insertion des tags: {}", e)
+
+    def _flush_db(self):
+        """
+        Force l'écriture des vitesses bufferisées dans la base de données.
+        """
+        if not self.db:
+            return
+        try:
+            self._emit_durable_speeds(self.db.flush())
+        except Exception as e:
+            self._emit_error(str(e))
+            logger.error("SPEED_THREAD", "Erreur lors de l'écriture du buffer: {}", e)
+
+    def start(self):
+        """
+        Lance `run` dans un nouveau thread.
+        """
+        self._thread = threading.Thread(target=self.run, name="SpeedAcquisition")
+        self._thread.start()
+
+    def stop(self):
+        """
+        Demande l'arrêt de la boucle et attend qu'elle se termine (si elle a été lancée par
+        `start`). Les vitesses bufferisées sont écrites dans la base de données avant l'arrêt.
+        """
+        logger.info("SPEED_THREAD", "Arrêt demandé")
+        self.running = False
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+    def _set_state(self, state):
+        """
+        Change l'état du superviseur et compte la transition.
+        :param state: Nouvel état (une des constantes `STATE_*`)
+        """
+        if state == self.state:
+            return
+        transition = '{}->{}'.format(self.state, state)
+        self.transition_counts[transition] = self.transition_counts.get(transition, 0) + 1
+        logger.info("SPEED_THREAD", "État: {}", transition)
+        self.state = state
+        if self.on_state:
+            self.on_state(state)
+
+    def _handle_failure(self, error):
+        """
+        Gère une erreur de communication avec l'automate : ferme la socket, attend un temps
+        calculé par `backoff` puis repasse dans l'état de connexion.
+        La connexion à la base de données n'est pas touchée, seule la socket est recréée.
+        :param error: L'erreur qui s'est produite
+        """
+        POLL_FAILURES.inc()
+        self._emit_error(str(error))
+        logger.error("SPEED_THREAD", "Erreur: {}", error)
+        self._close_socket()
+        # Les vitesses bufferisées sont écrites pendant que l'on attend l'automate
+        self._flush_db()
+        self.consecutive_failures += 1
+        self._set_state(SpeedAcquisition.STATE_BACKOFF)
+        delay_ms = self.backoff.next_delay_ms()
+        logger.info("SPEED_THREAD", "Nouvelle tentative dans {:.0f} ms (échec #{})",
+                    delay_ms, self.consecutive_failures)
+        self._stop_event.wait(delay_ms / 1000)
+        if not self.running:
+            return
+        if self.consecutive_failures >= SpeedAcquisition.DEGRADED_AFTER_FAILURES:
+            self._set_state(SpeedAcquisition.STATE_DEGRADED)
+        else:
+            self._set_state(SpeedAcquisition.STATE_CONNECTING)
+
+    def _poll(self):
+        """
+        Attend la prochaine échéance du planning puis récupère et sauvegarde la vitesse et les
+        autres tags.
+        """
+        tick = self.scheduler.wait_next()
+        if not self.running:
+            return
+        if tick.missed:
+            logger.warning("SPEED_THREAD", "{} échéance(s) manquée(s) ({} au total)",
+                           tick.missed, self.scheduler.missed_ticks)
+
+        # Récupération de la vitesse et des autres tags
+        start = time.perf_counter()
+        values = self._read_tags()
+
+        # Sauvegarde les nouvelles valeurs
+        observed_ts = int(round(time.time() * 1000))
+        self._store_values(tick, observed_ts, values)
+        POLL_DURATION.observe((time.perf_counter() - start) * 1000)
+
+    def _store_values(self, tick, observed_ts, values):
+        """
+        Sauvegarde la vitesse et les autres tags lus pour une échéance.
+        :param tick: `Tick` de l'échéance
+        :param observed_ts: Millitimestamp de la lecture
+        :param values: Dictionnaire nom du tag -> valeur (la vitesse en est retirée)
+        """
+        ts = tick.scheduled_ms if self.use_scheduled_time else observed_ts
+        logger.debug("SPEED_THREAD", "Échéance #{} prévue à {}, valeurs reçues à {}",
+                     tick.index, tick.scheduled_ms, observed_ts)
+        mondon_speed = values.pop(SPEED_TAG.name, None)
+        if mondon_speed is None:
+            if values:
+                self._save_tags(ts, values)
+            return
+        if self.live_buffer is not None:
+            self.live_buffer.append(ts, mondon_speed)
+        self._save_speed(ts, mondon_speed, values)
+
+    def _receive_response(self, timeout):
+        """
+        Attend une réponse de `pipeline` et sauvegarde ses valeurs. La lecture est datée au
+        milieu de l'aller-retour, quand l'automate a lu sa mémoire, plutôt qu'à la réception.
+        :param timeout: Temps d'attente maximum en secondes
+        """
+        result = self.pipeline.receive(timeout)
+        if result is None:
+            return
+        tick, response, sent_ms, rtt_ms = result
+        values = self._decode_tags(response)
+        self._store_values(tick, int(round(sent_ms + rtt_ms / 2)), values)
+        POLL_DURATION.observe(rtt_ms)
+
+    def _poll_pipelined(self):
+        """
+        Équivalent de `_poll` avec plusieurs requêtes en cours : une requête est envoyée à
+        chaque échéance sans attendre la réponse de la précédente, et les réponses sont traitées
+        en attendant l'échéance suivante. Si `max_in_flight` requêtes sont déjà en cours, on
+        attend la plus ancienne réponse (les échéances dépassées sont alors sautées). Une
+        requête sans réponse après `SOCKET_TIMEOUT_MS` est abandonnée, c'est une erreur
+        seulement si l'automate ne répond plus du tout.
+        """
+        deadline = time.monotonic() + self.scheduler.next_delay()
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.pipeline.in_flight:
+                self._receive_response(remaining)
+            else:
+                self._stop_event.wait(remaining)
+        if not self.running:
+            return
+        tick = self.scheduler.tick()
+        if tick.missed:
+            logger.warning("SPEED_THREAD", "{} échéance(s) manquée(s) ({} au total)",
+                           tick.missed, self.scheduler.missed_ticks)
+        timeout_ms = SpeedAcquisition.SOCKET_TIMEOUT_MS
+        while self.pipeline.in_flight >= self.max_in_flight:
+            self.pipeline.expire(timeout_ms)
+            self._receive_response(max(0, timeout_ms - self.pipeline.oldest_age_ms()) / 1000)
+        self.pipeline.expire(timeout_ms)
+        self.pipeline.submit(self.tag_set.command, tick)
+
+    def run(self):
+        """
+        Boucle principale, exécutée par `start` sur un nouveau thread (ou par `SpeedThread`).
+        Superviseur qui passe par les états suivants :
+        - CONNECTING : établit la connexion à l'automate
+        - POLLING : récupère la vitesse courante toutes les `period_ms` millisecondes,
+          selon un planning fixe (voir `FixedRateScheduler`), avec jusqu'à `max_in_flight`
+          requêtes en cours
+        - BACKOFF : après une erreur, attend un temps qui augmente à chaque échec consécutif
+          (voir `Backoff`) avant de se reconnecter
+        - DEGRADED : comme CONNECTING, mais après `DEGRADED_AFTER_FAILURES` échecs consécutifs
+        La connexion à la base de données est créée une seule fois et gardée entre les
+        reconnexions à l'automate.
+        """
+        self.running = True
+        self._stop_event.clear()
+        if self.spool_location:
+            self._start_spool()
+        elif self.db is None:
+            self.db = Database(self.db_location, batch_size=self.db_batch_size,
+                               batch_delay_ms=self.db_batch_delay_ms,
+                               profile=ConnectionProfile(
+                                   busy_timeout_ms=SpeedAcquisition.DB_BUSY_TIMEOUT_MS),
+                               storage_policy=self.db_storage_policy,
+                               partitioning=self.db_partitioning,
+                               flush_attempts=SpeedAcquisition.DB_FLUSH_ATTEMPTS)
+        self._set_state(SpeedAcquisition.STATE_CONNECTING)
+        while self.running:
+            try:
+                if self.state == SpeedAcquisition.STATE_POLLING:
+                    if self.pipeline:
+                        self._poll_pipelined()
+                    else:
+                        self._poll()
+                else:
+                    self._connect()
+                    self.backoff.reset()
+                    self.consecutive_failures = 0
+                    self.scheduler.reset()
+                    self._set_state(SpeedAcquisition.STATE_POLLING)
+            except Exception as e:
+                self._handle_failure(e)
+        self._close_socket()
+        if self.spool:
+            self._stop_spool()
+        else:
+            self._flush_db()
+            try:
+                self.db.close()
+            except Exception as e:
+                logger.error("SPEED_THREAD", "Erreur lors de la fermeture de la base de données: "
+                                             "{}", e)
+            self.db = None
+        self._set_state(SpeedAcquisition.STATE_STOPPED)
+
+    def _start_spool(self):
+        """
+        Ouvre le spool et démarre le thread qui l'écrit dans la base de données. Les valeurs
+        restées dans le spool (panne de la base de données, arrêt brutal) sont écrites en premier.
+        """
+        self.spool = Spool(self.spool_location)
+        self.drainer = SpoolDrainer(self.spool, self.db_location,
+                                    on_new_speed=self.on_new_speed,
+                                    on_error=self.on_error,
+                                    interval_ms=self.db_batch_delay_ms,
+                                    storage_policy=self.db_storage_policy,
+                                    partitioning=self.db_partitioning)
+        self.drainer.start()
+
+    def _stop_spool(self):
+        """
+        Arrête le thread d'écriture du spool (après une dernière écriture) et ferme le spool.
+        """
+        self.drainer.stop()
+        self.spool.close()
+        self.drainer = None
+        self.spool = None
+
+
+class SpeedAcquisitionSimulator(SpeedAcquisition):
+    """
+    Acquisition qui hérite de SpeedAcquisition et qui redéfinit les fonctions `_connect` et `_read_tags`
+    pour simuler l'automate en locale.
+    """
+    def _connect(self):
+        """
+        Simule la connexion à l'automate. Ne fait rien à part un log.
+        """
+        logger.info("SPEED_THREAD", "Simulation d'une connexion à l'automate")
+
+    def _get_speed(self):
+        """
+        Simule la récupération d'une nouvelle vitesse en générant une valeur aléatoire.
+        Simule une erreur de manière aléatoire 1% du temps.
+        :return:
+        """
+        if randint(0, 100) == 1:
+            raise Exception("Simulation d'une erreur!!")
+        random_speed = randint(0, 185)
+        logger.debug("SPEED_THREAD", "Génération d'une vitesse aléatoire ({})", random_speed)
+        return random_speed
+
+    def _read_tags(self):
+        """
+        Simule la lecture des tags : la vitesse vient de `_get_speed`, les autres tags prennent
+        une valeur aléatoire.
+        :return: Dictionnaire nom du tag -> valeur
+        """
+        values = {tag.name: randint(0, 100) for tag in self.tags}
+        values[SPEED_TAG.name] = self._get_speed()
+        return values
@@ -0,0 +1,395 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import queue
+import threading
+import time
+
+from objct.automate_command import CONNECT, SPEED_TAG, TagSet
+from objct.backoff import Backoff
+from objct.base_de_donnee import Database
+from objct.fins import FinsAsyncTransport, FinsError
+from objct.logger import logger
+from objct.scheduler import FixedRateScheduler
+
+
+class MachineConfig:
+    """
+    Définit un automate à interroger par `AcquisitionEngine`.
+    """
+    def __init__(self, name, ip, port=9600, tags=None, period_ms=240, store_speed=False,
+                 timeout_ms=2000, backoff_initial_ms=1000, backoff_max_ms=30000):
+        """
+        Crée une nouvelle instance de `MachineConfig`
+        :param name: Nom de la machine, enregistré avec chaque tag dans `mondon_tag`
+        :param ip: Adresse IP de l'automate
+        :param port: Port FINS/TCP de l'automate
+        :param tags: Liste de `Tag` lus à chaque échéance (par défaut la vitesse seulement)
+        :param period_ms: Période d'interrogation en millisecondes
+        :param store_speed: Si vrai, le tag `SPEED_TAG` est enregistré dans `mondon_speed` (et
+                            signalé au GUI) au lieu de `mondon_tag`
+        :param timeout_ms: Temps maximum d'attente d'une réponse de l'automate
+        :param backoff_initial_ms: Temps d'attente après la première erreur
+        :param backoff_max_ms: Temps d'attente maximum entre deux tentatives
+        """
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.tags = tags or [SPEED_TAG]
+        self.period_ms = period_ms
+        self.store_speed = store_speed
+        self.timeout_ms = timeout_ms
+        self.backoff_initial_ms = backoff_initial_ms
+        self.backoff_max_ms = backoff_max_ms
+
+
+class DatabaseWriter:
+    """
+    Unique écrivain de la base de données pour toutes les machines de `AcquisitionEngine`.
+    Les valeurs sont déposées dans une queue (sans jamais bloquer la boucle asyncio) et écrites
+    par un thread dédié qui possède la connexion SQLite et profite des écritures groupées de
+    `Database`.
+    """
+    QUEUE_SIZE = 100000  # Nombre maximum de valeurs en attente d'écriture
+
+    def __init__(self, db_location, on_new_speed=None, on_error=None,
+                 batch_size=None, batch_delay_ms=None, storage_policy=None, partitioning=None):
+        """
+        Crée une nouvelle instance de `DatabaseWriter`
+        :param db_location: Chemin du fichier contenant la base de données
+        :param on_new_speed: Fonction appelée avec (vitesse, temps) une fois la vitesse écrite
+        :param on_error: Fonction appelée avec le message d'erreur en cas d'erreur d'écriture
+        :param batch_size: Nombre de vitesses écrites ensemble dans la base de données
+        :param batch_delay_ms: Temps maximum avant l'écriture des valeurs bufferisées
+        :param storage_policy: Politique qui choisit les valeurs écrites (ex: `DeadbandPolicy`)
+        :param partitioning: `Partitioning` de la base de données (par défaut un seul fichier)
+        """
+        self.db_location = db_location
+        self.on_new_speed = on_new_speed
+        self.on_error = on_error
+        self.batch_size = batch_size
+        self.batch_delay_ms = batch_delay_ms or Database.BATCH_DELAY_MS
+        self.storage_policy = storage_policy
+        self.partitioning = partitioning
+        self.dropped_count = 0  # Nombre de valeurs abandonnées car la queue était pleine
+        self._queue = queue.Queue(maxsize=DatabaseWriter.QUEUE_SIZE)
+        self._thread = None
+
+    def start(self):
+        """
+        Démarre le thread d'écriture.
+        """
+        self._thread = threading.Thread(target=self._run, name="DatabaseWriter", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Écrit les valeurs en attente et arrête le thread d'écriture.
+        """
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, machine, ts, values, speed=None):
+        """
+        Dépose les valeurs lues sur une machine. Ne bloque jamais.
+        :param machine: Nom de la machine
+        :param ts: Millitimestamp de quand on a reçu les valeurs
+        :param values: Dictionnaire nom du tag -> valeur pour `mondon_tag`
+        :param speed: Vitesse à écrire dans `mondon_speed` (ou None)
+        """
+        try:
+            self._queue.put_nowait((machine, ts, values, speed))
+        except queue.Full:
+            self.dropped_count += 1
+            logger.error("ENGINE", "Queue d'écriture pleine, abandon des valeurs de {} au temps {}",
+                         machine, ts)
+
+    def _handle_durable_speeds(self, durable_speeds):
+        """
+        Signal les vitesses qui ont été écrites dans la base de données.
+        :param durable_speeds: Liste de (value, time) écrites dans la base de données
+        """
+        if self.on_new_speed:
+            for speed, ts in durable_speeds:
+                self.on_new_speed(speed, ts)
+
+    def _write(self, db, item):
+        """
+        Ajoute une valeur déposée par `submit` au buffer de `Database`.
+        :param db: `Database` du thread d'écriture
+        :param item: (machine, temps, valeurs, vitesse)
+        """
+        machine, ts, values, speed = item
+        if speed is not None:
+            self._handle_durable_speeds(db.insert_speed(speed, ts, values, machine=machine))
+        elif values:
+            self._handle_durable_speeds(db.insert_tags(ts, values, machine=machine))
+
+    def _run(self):
+        """
+        Boucle du thread d'écriture.
+        """
+        db = Database(self.db_location, batch_size=self.batch_size,
+                      batch_delay_ms=self.batch_delay_ms, storage_policy=self.storage_policy,
+                      partitioning=self.partitioning)
+        running = True
+        while running:
+            try:
+                # Se réveille régulièrement pour que `batch_delay_ms` soit respecté même si plus
+                # aucune valeur n'arrive
+                item = self._queue.get(timeout=max(self.batch_delay_ms, 100) / 1000)
+            except queue.Empty:
+                item = False
+            try:
+                if item is None:
+                    running = False
+                elif item:
+                    self._write(db, item)
+                self._handle_durable_speeds(db.flush_if_due())
+            except Exception as e:
+                logger.error("ENGINE", "Erreur lors de l'écriture dans la base de données: {}", e)
+                if self.on_error:
+                    self.on_error(str(e))
+        try:
+            self._handle_durable_speeds(db.flush())
+            db.close()
+        except Exception as e:
+            logger.error("ENGINE", "Erreur lors de la fermeture de la base de données: {}", e)
+
+
+class MachinePoller:
+    """
+    Interroge un automate depuis la boucle asyncio de `AcquisitionEngine`.
+    Même superviseur que `SpeedThread` : CONNECTING -> POLLING, et BACKOFF puis CONNECTING (ou
+    DEGRADED après plusieurs échecs consécutifs) en cas d'erreur.
+    """
+    STATE_STOPPED = 'STOPPED'
+    STATE_CONNECTING = 'CONNECTING'
+    STATE_POLLING = 'POLLING'
+    STATE_BACKOFF = 'BACKOFF'
+    STATE_DEGRADED = 'DEGRADED'
+    DEGRADED_AFTER_FAILURES = 5  # Nombre d'échecs consécutifs avant de passer en état DEGRADED
+
+    def __init__(self, config, writer, on_status=None, live_buffer=None):
+        """
+        Crée une nouvelle instance de `MachinePoller`
+        :param config: `MachineConfig` de l'automate
+        :param writer: `DatabaseWriter` partagé par toutes les machines
+        :param on_status: Fonction appelée avec (machine, état, dernière vitesse) à chaque
+                          changement d'état et à chaque nouvelle valeur
+        :param live_buffer: `SampleRing` où la vitesse est ajoutée si `store_speed` est vrai
+        """
+        self.config = config
+        self.writer = writer
+        self.on_status = on_status
+        self.live_buffer = live_buffer if config.store_speed else None
+        self.tag_set = TagSet('GET_TAGS_{}'.format(config.name), config.tags)
+        self.scheduler = FixedRateScheduler(config.period_ms)
+        self.backoff = Backoff(initial_ms=config.backoff_initial_ms,
+                               max_ms=config.backoff_max_ms)
+        self.transport = None
+        self.state = MachinePoller.STATE_STOPPED
+        self.consecutive_failures = 0
+        self.transition_counts = {}  # Nombre de passages par transition, ex: "POLLING->BACKOFF"
+        self.last_values = {}
+
+    def _report_status(self):
+        """
+        Signal l'état courant de la machine.
+        """
+        if self.on_status:
+            self.on_status(self.config.name, self.state, self.last_values.get(SPEED_TAG.name))
+
+    def _set_state(self, state):
+        """
+        Change l'état de la machine et compte la transition.
+        :param state: Nouvel état (une des constantes `STATE_*`)
+        """
+        if state == self.state:
+            return
+        transition = '{}->{}'.format(self.state, state)
+        self.transition_counts[transition] = self.transition_counts.get(transition, 0) + 1
+        logger.info("ENGINE", "{} | État: {}", self.config.name, transition)
+        self.state = state
+        self._report_status()
+
+    async def _connect(self):
+        """
+        Établit la connexion FINS/TCP avec l'automate.
+        """
+        logger.info("ENGINE", "{} | Connexion à {}:{}",
+                    self.config.name, self.config.ip, self.config.port)
+        reader, writer = await asyncio.open_connection(self.config.ip, self.config.port)
+        self.transport = FinsAsyncTransport(reader, writer)
+        await self.transport.handshake(CONNECT)
+
+    def _close(self):
+        """
+        Ferme la connexion à l'automate si il y en a une.
+        """
+        if self.transport:
+            try:
+                self.transport.close()
+            except OSError:
+                pass
+        self.transport = None
+
+    async def _poll(self):
+        """
+        Attend la prochaine échéance puis lit et dépose les valeurs des tags.
+        """
+        await asyncio.sleep(self.scheduler.next_delay())
+        tick = self.scheduler.tick()
+        if tick.missed:
+            logger.warning("ENGINE", "{} | {} échéance(s) manquée(s) ({} au total)",
+                           self.config.name, tick.missed, self.scheduler.missed_ticks)
+        response = await self.transport.request(self.tag_set.command)
+        try:
+            values = self.tag_set.decode(response.payload)
+        except ValueError as e:
+            raise FinsError("Réponse invalide de {}: {}".format(self.config.name, e))
+        ts = int(round(time.time() * 1000))
+        self.last_values = dict(values)
+        speed = values.pop(SPEED_TAG.name, None) if self.config.store_speed else None
+        if speed is not None and self.live_buffer is not None:
+            self.live_buffer.append(ts, speed)
+        self.writer.submit(self.config.name, ts, values, speed)
+        self._report_status()
+
+    async def run(self):
+        """
+        Boucle du superviseur, jusqu'à ce que la tâche soit annulée.
+        """
+        timeout_s = self.config.timeout_ms / 1000
+        self._set_state(MachinePoller.STATE_CONNECTING)
+        try:
+            while True:
+                try:
+                    if self.state == MachinePoller.STATE_POLLING:
+                        # Le timeout couvre l'attente de l'échéance et l'échange avec l'automate
+                        await asyncio.wait_for(self._poll(),
+                                               timeout_s + self.config.period_ms / 1000)
+                    else:
+                        await asyncio.wait_for(self._connect(), timeout_s)
+                        self.backoff.reset()
+                        self.consecutive_failures = 0
+                        self.scheduler.reset()
+                        self._set_state(MachinePoller.STATE_POLLING)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("ENGINE", "{} | Erreur: {}", self.config.name,
+                                 e or e.__class__.__name__)
+                    self._close()
+                    self.consecutive_failures += 1
+                    self._set_state(MachinePoller.STATE_BACKOFF)
+                    await asyncio.sleep(self.backoff.next_delay_ms() / 1000)
+                    if self.consecutive_failures >= MachinePoller.DEGRADED_AFTER_FAILURES:
+                        self._set_state(MachinePoller.STATE_DEGRADED)
+                    else:
+                        self._set_state(MachinePoller.STATE_CONNECTING)
+        finally:
+            self._close()
+            self._set_state(MachinePoller.STATE_STOPPED)
+
+
+class AcquisitionEngine:
+    """
+    Interroge plusieurs automates en parallèle depuis une seule boucle asyncio (dans un thread
+    dédié), chacun avec son planning, son backoff et ses tags. Toutes les valeurs sont écrites
+    par un seul `DatabaseWriter`.
+    """
+    def __init__(self, db_location, machines, on_status=None, on_new_speed=None, on_error=None,
+                 db_batch_size=None, db_batch_delay_ms=None, db_storage_policy=None,
+                 db_partitioning=None, live_buffer=None):
+        """
+        Crée une nouvelle instance de `AcquisitionEngine`
+        :param db_location: Chemin du fichier contenant la base de données
+        :param machines: Liste de `MachineConfig`, dont une seule au plus avec `store_speed`
+        :param on_status: Fonction appelée avec (machine, état, dernière vitesse). Appelée depuis
+                          le thread de la boucle asyncio.
+        :param on_new_speed: Fonction appelée avec (vitesse, temps) pour les machines avec
+                             `store_speed`, une fois la vitesse écrite. Appelée depuis le thread
+                             d'écriture.
+        :param on_error: Fonction appelée avec un message d'erreur d'écriture
+        :param db_batch_size: Nombre de vitesses écrites ensemble dans la base de données
+        :param db_batch_delay_ms: Temps maximum avant l'écriture des valeurs bufferisées
+        :param db_storage_policy: Politique qui choisit les valeurs écrites (ex: `DeadbandPolicy`)
+        :param db_partitioning: `Partitioning` de la base de données (par défaut un seul fichier)
+        :param live_buffer: `SampleRing` où sont ajoutées les vitesses des machines avec
+                            `store_speed`, dès leur lecture
+        """
+        names = [machine.name for machine in machines]
+        if len(set(names)) != len(names):
+            raise ValueError("Les noms de machine doivent être uniques: {}".format(names))
+        # `mondon_speed` (clé primaire ts) et `live_buffer` ne contiennent qu'une seule série
+        speed_machines = [machine.name for machine in machines if machine.store_speed]
+        if len(speed_machines) > 1:
+            raise ValueError("Une seule machine peut avoir store_speed: {}".format(speed_machines))
+        self.writer = DatabaseWriter(db_location, on_new_speed=on_new_speed, on_error=on_error,
+                                     batch_size=db_batch_size, batch_delay_ms=db_batch_delay_ms,
+                                     storage_policy=db_storage_policy,
+                                     partitioning=db_partitioning)
+        self.pollers = [MachinePoller(machine, self.writer, on_status, live_buffer)
+                        for machine in machines]
+        self._loop = None
+        self._stop_event = None
+        self._stop_requested = False
+        self._thread = None
+
+    async def _main(self):
+        """
+        Lance un superviseur par machine et attend la demande d'arrêt.
+        """
+        self._stop_event = asyncio.Event()
+        if self._stop_requested:
+            self._stop_event.set()
+        tasks = [asyncio.ensure_future(poller.run()) for poller in self.pollers]
+        await self._stop_event.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self):
+        """
+        Exécute l'acquisition dans le thread courant jusqu'à l'appel de `stop`.
+        """
+        self.writer.start()
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._main())
+        finally:
+            self._loop.close()
+            self._loop = None
+            self.writer.stop()
+
+    def start(self):
+        """
+        Démarre l'acquisition dans un nouveau thread.
+        """
+        self._thread = threading.Thread(target=self.run, name="AcquisitionEngine", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Demande l'arrêt de l'acquisition et attend que les valeurs en attente soient écrites.
+        """
+        self._stop_requested = True
+        loop = self._loop
+        if loop and self._stop_event:
+            loop.call_soon_threadsafe(self._stop_event.set)
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def get_status(self):
+        """
+        :return: Dictionnaire nom de la machine -> (état, compteurs de transitions, échéances
+                 manquées)
+        """
+        return {poller.config.name: (poller.state, dict(poller.transition_counts),
+                                     poller.scheduler.missed_ticks)
+                for poller in self.pollers}
@@ -0,0 +1,270 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+from datetime import datetime, timedelta
+import json
+from time import perf_counter
+
+import numpy as np
+
+from objct.rollup import RollupAccumulator, parse_date
+
+
+# Lignes de `mondon_speed` chargées en un seul tableau NumPy
+SPEED_DTYPE = np.dtype([('ts', np.int64), ('speed', np.float64)])
+
+# Équipes : (nom, heure de début, heure de fin) en heure locale. Une équipe dont la fin est
+# avant le début se termine le lendemain.
+SHIFTS = (('Matin', 5, 13), ('Après-midi', 13, 21), ('Nuit', 21, 5))
+
+SPEED_BINS = tuple(range(0, 201, 20)) + (float('inf'),)  # Classes de vitesse de la répartition
+MIN_STOP_MS = 0  # Durée minimum d'un arrêt pour être compté dans `stop_count`
+
+
+def load_speeds(db, start, end, max_gap_ms=None):
+    """
+    Charge les vitesses d'une plage en un seul tableau, avec la connexion de `db` (et ses
+    partitions). Les lignes jusqu'à `max_gap_ms` avant et après la plage sont aussi chargées pour
+    connaître la vitesse au début de la plage et la durée de la dernière ligne.
+    Les vitesses de `db.archive` sont copiées directement depuis ses fichiers, sans passer par
+    des tuples Python.
+    :param db: `Database` à lire
+    :param start: Millitimestamp de début (inclus)
+    :param end: Millitimestamp de fin (exclu)
+    :param max_gap_ms: Écart au delà duquel il manque des données (par défaut `MAX_GAP_MS`)
+    :return: Tableau `SPEED_DTYPE` trié par temps
+    """
+    max_gap_ms = RollupAccumulator.MAX_GAP_MS if max_gap_ms is None else max_gap_ms
+    start, end = start - max_gap_ms, end + max_gap_ms + 1
+    archived = None
+    if db.archive and start < db.archive.end_ms:
+        split = min(end, db.archive.end_ms)
+        archived = db.archive.load(start, split, SPEED_DTYPE)
+        start = split
+    rows = np.fromiter(db.iter_speeds(start, end), dtype=SPEED_DTYPE)
+    if archived is not None:
+        rows = np.concatenate((archived, rows))
+    if len(rows) > 1 and not np.all(rows['ts'][1:] > rows['ts'][:-1]):
+        # Base de données non partitionnée et partitions qui se recouvrent : tri par temps et
+        # suppression des doublons
+        rows = rows[np.argsort(rows['ts'], kind='stable')]
+        rows = rows[np.concatenate(([True], rows['ts'][1:] > rows['ts'][:-1]))]
+    return rows
+
+
+def compute_kpis(rows, start, end, stop_threshold=None, max_gap_ms=None, min_stop_ms=None,
+                 bins=SPEED_BINS):
+    """
+    Calcule les indicateurs de production d'une plage. Chaque vitesse est constante jusqu'à la
+    ligne suivante (signal en escalier, voir `iter_steps`), sauf si celle-ci est à plus de
+    `max_gap_ms` (données manquantes). La vitesse est en mètres par minute.
+    :param rows: Tableau `SPEED_DTYPE` trié (voir `load_speeds`)
+    :param start: Millitimestamp de début (inclus)
+    :param end: Millitimestamp de fin (exclu)
+    :param stop_threshold: Vitesse en dessous (ou égale) de laquelle la machine est à l'arrêt
+                           (par défaut `RollupAccumulator.STOP_THRESHOLD`)
+    :param max_gap_ms: Écart au delà duquel il manque des données (par défaut `MAX_GAP_MS`)
+    :param min_stop_ms: Durée minimum d'un arrêt compté (par défaut `MIN_STOP_MS`)
+    :param bins: Limites des classes de vitesse de la répartition
+    :return: Dictionnaire des indicateurs (durées en millisecondes)
+    """
+    stop_threshold = RollupAccumulator.STOP_THRESHOLD if stop_threshold is None \
+        else stop_threshold
+    max_gap_ms = RollupAccumulator.MAX_GAP_MS if max_gap_ms is None else max_gap_ms
+    min_stop_ms = MIN_STOP_MS if min_stop_ms is None else min_stop_ms
+    ts = rows['ts']
+    # Intervalle i : de la ligne i à la ligne i + 1, limité à la plage
+    clipped = np.clip(ts, start, end)
+    durations = np.diff(clipped)
+    speeds = rows['speed'][:-1]
+    gaps = np.diff(ts) > max_gap_ms
+    valid = durations * ~gaps
+    running = speeds > stop_threshold
+
+    run_ms = int(valid[running].sum())
+    stop_ms = int(valid[~running].sum())
+    meters = float(np.dot(speeds, valid)) / 60000
+
+    # Arrêts : suites d'intervalles à l'arrêt. Les intervalles de durée nulle (hors de la plage)
+    # sont ignorés, un trou dans les données termine l'arrêt.
+    keep = durations > 0
+    stopped = (~running & ~gaps)[keep]
+    kept_durations = valid[keep]
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], stopped.view(np.int8), [0]))))
+    first, last = edges[0::2], edges[1::2]
+    cumulative = np.concatenate(([0], np.cumsum(kept_durations)))
+    stop_durations = cumulative[last] - cumulative[first]
+    stop_starts = clipped[:-1][keep][first]
+    counted = stop_durations >= min_stop_ms
+    stop_durations, stop_starts = stop_durations[counted], stop_starts[counted]
+
+    histogram, _ = np.histogram(speeds, bins=bins, weights=valid)
+    return {
+        'start': start,
+        'end': end,
+        'meters': round(meters, 1),
+        'run_ms': run_ms,
+        'stop_ms': stop_ms,
+        'missing_ms': int(end - start - run_ms - stop_ms),
+        'mean_running_speed': round(meters * 60000 / run_ms, 1) if run_ms else None,
+        'stop_count': int(len(stop_durations)),
+        'longest_stop_ms': int(stop_durations.max()) if len(stop_durations) else 0,
+        'stops': [(int(s), int(d)) for s, d in zip(stop_starts, stop_durations)],
+        'speed_distribution_ms': [(bins[i], bins[i + 1], int(value))
+                                  for i, value in enumerate(histogram)],
+    }
+
+
+def slice_rows(rows, start, end):
+    """
+    :return: Les lignes nécessaires pour calculer les indicateurs de [start, end[ : la dernière
+             ligne avant `start`, celles de la plage et la première à ou après `end`
+    """
+    ts = rows['ts']
+    first = max(0, int(np.searchsorted(ts, start, 'right')) - 1)
+    last = int(np.searchsorted(ts, end, 'left')) + 1
+    return rows[first:last]
+
+
+def shift_periods(start, end, shifts=SHIFTS):
+    """
+    :return: La liste des (jour, nom de l'équipe, début, fin) des équipes qui commencent dans la
+             plage, dans l'ordre chronologique (millitimestamps, heure locale)
+    """
+    periods = []
+    day = datetime.fromtimestamp(start / 1000).replace(hour=0, minute=0, second=0,
+                                                       microsecond=0)
+    while day.timestamp() * 1000 < end:
+        for name, first_hour, last_hour in shifts:
+            shift_start = day + timedelta(hours=first_hour)
+            shift_end = day + timedelta(days=1 if last_hour <= first_hour else 0,
+                                        hours=last_hour)
+            shift_start_ms = int(shift_start.timestamp() * 1000)
+            if start <= shift_start_ms < end:
+                periods.append((day.strftime('%Y-%m-%d'), name, shift_start_ms,
+                                int(shift_end.timestamp() * 1000)))
+        day += timedelta(days=1)
+    return sorted(periods, key=lambda period: period[2])
+
+
+def report(db, start, end, **kwargs):
+    """
+    Calcule les indicateurs de chaque équipe et de toute la plage.
+    :param kwargs: Paramètres passés à `compute_kpis`
+    :return: Dictionnaire avec les indicateurs de la plage ('total') et de chaque équipe
+             ('shifts')
+    """
+    periods = shift_periods(start, end)
+    load_start = min([start] + [period[2] for period in periods])
+    load_end = max([end] + [period[3] for period in periods])
+    rows = load_speeds(db, load_start, load_end, kwargs.get('max_gap_ms'))
+    shifts = []
+    for day, name, shift_start, shift_end in periods:
+        kpis = compute_kpis(slice_rows(rows, shift_start, shift_end), shift_start, shift_end,
+                            **kwargs)
+        kpis.update(day=day, shift=name)
+        shifts.append(kpis)
+    return {'rows': len(rows), 'total': compute_kpis(slice_rows(rows, start, end), start, end,
+                                                     **kwargs),
+            'shifts': shifts}
+
+
+def format_duration(ms):
+    """
+    :return: Une durée au format "HHhMM"
+    """
+    minutes = int(ms // 60000)
+    return '{}h{:02d}'.format(minutes // 60, minutes % 60)
+
+
+def print_report(result):
+    """
+    Affiche un rapport sous forme de tableau.
+    """
+    line = "{:<10} {:<10} {:>10} {:>8} {:>8} {:>8} {:>6} {:>10} {:>8}"
+    print(line.format("Jour", "Équipe", "Mètres", "Marche", "Arrêt", "Manque", "Arrêts",
+                      "Plus long", "m/min"))
+    for kpis in result['shifts'] + [dict(result['total'], day="Total", shift="")]:
+        print(line.format(kpis['day'], kpis['shift'], "{:.0f}".format(kpis['meters']),
+                          format_duration(kpis['run_ms']), format_duration(kpis['stop_ms']),
+                          format_duration(kpis['missing_ms']), kpis['stop_count'],
+                          format_duration(kpis['longest_stop_ms']),
+                          kpis['mean_running_speed'] if kpis['mean_running_speed'] else '-'))
+    total = result['total']
+    run_and_stop_ms = total['run_ms'] + total['stop_ms']
+    if run_and_stop_ms:
+        print("\nRépartition des vitesses (temps enregistré) :")
+        for low, high, ms in total['speed_distribution_ms']:
+            print("  {:>4} - {:<4} {:>6.1%}  {}".format(
+                low, high if high != float('inf') else '', ms / run_and_stop_ms,
+                format_duration(ms)))
+
+
+def main():
+    """
+    Commande de rapport de production :
+    python -m objct.analytics <base de données> (--day AAAA-MM-JJ | --week AAAA-MM-JJ |
+                                                 --month AAAA-MM) [--partition day|month]
+                                                [--stop-threshold V] [--min-stop-s S] [--json]
+                                                [--archive DOSSIER]
+    """
+    from objct.archive import ColumnarArchive
+    from objct.base_de_donnee import Database
+    from objct.partition import Partitioning
+
+    parser = argparse.ArgumentParser(description="Indicateurs de production par équipe "
+                                                 "(mètres, marche, arrêts, vitesses)")
+    parser.add_argument('database', help="Chemin du fichier contenant la base de données")
+    period = parser.add_mutually_exclusive_group(required=True)
+    period.add_argument('--day', type=parse_date, help="Jour à analyser")
+    period.add_argument('--week', type=parse_date,
+                        help="Un jour de la semaine (du lundi au dimanche) à analyser")
+    period.add_argument('--month', type=lambda value: parse_date(value + '-01'),
+                        help="Mois à analyser (AAAA-MM)")
+    parser.add_argument('--partition', choices=sorted(Partitioning.KEY_FORMATS), default=None,
+                        help="La base de données est partitionnée par jour ou par mois")
+    parser.add_argument('--stop-threshold', type=float, default=None,
+                        help="Vitesse en dessous (ou égale) de laquelle la machine est à l'arrêt")
+    parser.add_argument('--min-stop-s', type=float, default=None,
+                        help="Durée minimum d'un arrêt compté en secondes")
+    parser.add_argument('--archive', default=None,
+                        help="Dossier des jours archivés (voir `objct.archive`)")
+    parser.add_argument('--json', action='store_true', help="Affiche le résultat en JSON")
+    args = parser.parse_args()
+
+    if args.day is not None:
+        start = datetime.fromtimestamp(args.day / 1000)
+        end = start + timedelta(days=1)
+    elif args.week is not None:
+        day = datetime.fromtimestamp(args.week / 1000)
+        start = day - timedelta(days=day.weekday())
+        end = start + timedelta(days=7)
+    else:
+        start = datetime.fromtimestamp(args.month / 1000)
+        end = (start + timedelta(days=32)).replace(day=1)
+
+    archive = ColumnarArchive(args.archive) if args.archive else None
+    db = Database(args.database,
+                  partitioning=Partitioning(args.partition) if args.partition else None,
+                  archive=archive, read_only=True)
+    try:
+        begin = perf_counter()
+        result = report(db, int(start.timestamp() * 1000), int(end.timestamp() * 1000),
+                        stop_threshold=args.stop_threshold,
+                        min_stop_ms=args.min_stop_s * 1000 if args.min_stop_s is not None
+                        else None)
+        elapsed = perf_counter() - begin
+    finally:
+        db.close()
+        if archive:
+            archive.close()
+    if args.json:
+        print(json.dumps(result, indent=2, default=str))
+    else:
+        print_report(result)
+        print("\n{} lignes analysées en {:.3f} s".format(result['rows'], elapsed))
+
+
+if __name__ == '__main__':
+    main()
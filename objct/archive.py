@@ -0,0 +1,420 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import glob
+import mmap
+import os
+import re
+import struct
+
+from objct.logger import logger
+
+try:
+    import numpy as np
+except ImportError:
+    # Sans NumPy, les vues sont des memoryview (voir `ColumnarDay.view`)
+    np = None
+
+
+class ColumnarDay:
+    """
+    Fichier d'archive en colonnes des vitesses d'un jour fermé, lu via mmap.
+
+    Format du fichier (little endian) :
+    - en-tête (`HEADER`) : signature, version, type des vitesses, début et fin du jour en
+      millitimestamp, nombre de vitesses
+    - index (`INDEX`) : position de la première vitesse de chaque heure du jour
+    - à partir de `DATA_OFFSET`, la colonne des temps : écart en millisecondes avec le début du
+      jour (uint32, 4 octets par vitesse au lieu d'un entier SQLite et de son index)
+    - puis, alignée sur 8 octets, la colonne des vitesses dans le plus petit type qui les
+      représente toutes exactement (`SPEED_TYPES`, en général uint16)
+    Les temps étant stockés par rapport au début du jour (et non par rapport à la vitesse
+    précédente), les colonnes se lisent directement dans le fichier, sans décodage ni copie.
+    """
+    MAGIC = b'MCOL'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHBxqqQ')  # Signature, version, type, début, fin, nombre
+    HOUR_MS = 3600 * 1000
+    INDEX_SIZE = 26  # Nombre d'heures indexées (un jour de changement d'heure dure 25 heures)
+    INDEX = struct.Struct('<{}I'.format(INDEX_SIZE))
+    DATA_OFFSET = 256  # Position de la colonne des temps
+    # Code du type -> (code `array`, minimum, maximum) des vitesses, du plus petit au plus grand
+    SPEED_TYPES = {1: ('H', 0, 0xFFFF), 2: ('i', -2 ** 31, 2 ** 31 - 1), 3: ('d', None, None)}
+
+    def __init__(self, path):
+        """
+        Ouvre un fichier d'archive existant.
+        :param path: Chemin du fichier
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, speed_type, self.start_ms, self.end_ms, self.count = \
+            ColumnarDay.HEADER.unpack_from(self._map, 0)
+        if magic != ColumnarDay.MAGIC or version != ColumnarDay.VERSION:
+            self._map.close()
+            raise ValueError("{} n'est pas une archive (version {})"
+                             .format(path, ColumnarDay.VERSION))
+        self._index = ColumnarDay.INDEX.unpack_from(self._map, ColumnarDay.HEADER.size)
+        self.speed_code = ColumnarDay.SPEED_TYPES[speed_type][0]
+        self._speed_offset = ColumnarDay._speed_offset(self.count)
+        memory = memoryview(self._map)
+        self._offsets = memory[ColumnarDay.DATA_OFFSET:
+                               ColumnarDay.DATA_OFFSET + 4 * self.count].cast('I')
+        speed_size = struct.calcsize(self.speed_code)
+        self._speeds = memory[self._speed_offset:self._speed_offset + speed_size * self.count] \
+            .cast(self.speed_code)
+        memory.release()
+
+    @staticmethod
+    def _speed_offset(count):
+        """
+        :return: La position de la colonne des vitesses pour `count` vitesses
+        """
+        offset = ColumnarDay.DATA_OFFSET + 4 * count
+        return offset + (-offset % 8)
+
+    @staticmethod
+    def write(path, start_ms, end_ms, rows):
+        """
+        Écrit un fichier d'archive (dans un fichier temporaire renommé à la fin, pour qu'un
+        lecteur ne voie jamais un fichier incomplet).
+        :param path: Chemin du fichier
+        :param start_ms: Début du jour (inclus)
+        :param end_ms: Fin du jour (exclue)
+        :param rows: Liste de (temps, vitesse) du jour, dans l'ordre chronologique
+        """
+        offsets = array('I', (ts - start_ms for ts, _ in rows))
+        speeds = [speed for _, speed in rows]
+        for speed_type, (code, low, high) in sorted(ColumnarDay.SPEED_TYPES.items()):
+            if low is None or all(isinstance(speed, int) and low <= speed <= high
+                                  for speed in speeds):
+                break
+        speeds = array(code, speeds)
+        index = [bisect_left(offsets, hour * ColumnarDay.HOUR_MS)
+                 for hour in range(ColumnarDay.INDEX_SIZE)]
+        header = ColumnarDay.HEADER.pack(ColumnarDay.MAGIC, ColumnarDay.VERSION, speed_type,
+                                         start_ms, end_ms, len(rows)) + \
+            ColumnarDay.INDEX.pack(*index)
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(header.ljust(ColumnarDay.DATA_OFFSET, b'\0'))
+            f.write(offsets.tobytes())
+            f.write(b'\0' * (ColumnarDay._speed_offset(len(rows)) - f.tell()))
+            f.write(speeds.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+    def _bounds(self, start, end):
+        """
+        :return: (première position, position de fin) des vitesses de [start, end[
+        """
+        def position(ts):
+            if ts <= self.start_ms:
+                return 0
+            if ts >= self.end_ms:
+                return self.count
+            offset = ts - self.start_ms
+            hour = offset // ColumnarDay.HOUR_MS
+            # L'index réduit la recherche à une heure du fichier
+            low = self._index[hour] if hour < ColumnarDay.INDEX_SIZE else self.count
+            high = self._index[hour + 1] if hour + 1 < ColumnarDay.INDEX_SIZE else self.count
+            return bisect_left(self._offsets, offset, low, max(low, high))
+
+        return position(start), position(end)
+
+    def view(self, start, end):
+        """
+        Retourne les vitesses d'une plage sans les copier : les tableaux sont des vues sur le
+        fichier, valides tant que le fichier est ouvert.
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :return: (début du jour, écarts avec le début du jour, vitesses), les tableaux étant des
+                 numpy.ndarray (ou des memoryview sans NumPy)
+        """
+        first, last = self._bounds(start, end)
+        offsets, speeds = self._offsets[first:last], self._speeds[first:last]
+        if np is not None:
+            offsets, speeds = np.frombuffer(offsets, np.uint32), np.frombuffer(speeds,
+                                                                               self.speed_code)
+        return self.start_ms, offsets, speeds
+
+    def iter_speeds(self, start, end):
+        """
+        :return: Un générateur de (temps, vitesse) de la plage
+        """
+        first, last = self._bounds(start, end)
+        start_ms, offsets, speeds = self.start_ms, self._offsets, self._speeds
+        for position in range(first, last):
+            yield start_ms + offsets[position], speeds[position]
+
+    def last_at_or_before(self, ts):
+        """
+        :return: (temps, vitesse) de la dernière vitesse à ou avant `ts`, ou None
+        """
+        position = bisect_right(self._offsets, ts - self.start_ms) if ts < self.end_ms \
+            else self.count
+        if not position:
+            return None
+        return self.start_ms + self._offsets[position - 1], self._speeds[position - 1]
+
+    def close(self):
+        """
+        Ferme le fichier. Les vues retournées par `view` ne doivent plus être utilisées.
+        """
+        try:
+            self._offsets.release()
+            self._speeds.release()
+            self._map.close()
+        except BufferError:
+            # Une vue NumPy est encore utilisée, la projection sera fermée par le ramasse-miettes
+            pass
+
+
+class ColumnarArchive:
+    """
+    Dossier d'archives `ColumnarDay`, un fichier par jour fermé (`mondon_speed_AAAAMMJJ.col`).
+    Les jours archivés sont contigus : toutes les vitesses avant `end_ms` sont dans l'archive, la
+    base de données (voir `Database`, paramètre `archive`) ne garde que les vitesses suivantes.
+    """
+    PREFIX = 'mondon_speed_'
+    EXTENSION = '.col'
+    KEY_FORMAT = '%Y%m%d'
+    MAX_OPEN_FILES = 32  # Nombre maximum de fichiers ouverts en même temps
+
+    def __init__(self, directory):
+        """
+        Crée une nouvelle instance de `ColumnarArchive`
+        :param directory: Dossier des archives (créé si besoin)
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._open = OrderedDict()  # Clé -> `ColumnarDay`, du moins au plus récemment utilisé
+        self.refresh()
+
+    def refresh(self):
+        """
+        Relit la liste des jours archivés (après l'ajout d'un jour par un autre programme).
+        """
+        pattern = re.compile(r'^{}(\d{{8}}){}$'.format(re.escape(ColumnarArchive.PREFIX),
+                                                     re.escape(ColumnarArchive.EXTENSION)))
+        keys = []
+        for path in glob.glob(os.path.join(glob.escape(self.directory),
+                                           ColumnarArchive.PREFIX + '*' +
+                                           ColumnarArchive.EXTENSION)):
+            match = pattern.match(os.path.basename(path))
+            if match:
+                keys.append(match.group(1))
+        self.keys = sorted(keys)
+        self._bounds = [ColumnarArchive.bounds(key) for key in self.keys]
+
+    @staticmethod
+    def key(ts):
+        """
+        :return: La clé du jour qui contient `ts` (heure locale, ex: "20261018")
+        """
+        return datetime.fromtimestamp(ts / 1000).strftime(ColumnarArchive.KEY_FORMAT)
+
+    @staticmethod
+    def bounds(key):
+        """
+        :return: (début inclus, fin exclue) du jour `key` en millitimestamp
+        """
+        start = datetime.strptime(key, ColumnarArchive.KEY_FORMAT)
+        end = start + timedelta(days=1)
+        return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+    @property
+    def end_ms(self):
+        """
+        :return: La fin du dernier jour archivé (0 si l'archive est vide)
+        """
+        return self._bounds[-1][1] if self._bounds else 0
+
+    def path(self, key):
+        """
+        :return: Le chemin du fichier du jour `key`
+        """
+        return os.path.join(self.directory, ColumnarArchive.PREFIX + key +
+                            ColumnarArchive.EXTENSION)
+
+    def day(self, key):
+        """
+        :return: Le `ColumnarDay` du jour `key` (ouvert si besoin)
+        """
+        day = self._open.pop(key, None)
+        if day is None:
+            day = ColumnarDay(self.path(key))
+            while len(self._open) >= ColumnarArchive.MAX_OPEN_FILES:
+                self._open.popitem(last=False)[1].close()
+        self._open[key] = day
+        return day
+
+    def _days(self, start, end):
+        """
+        :return: Les `ColumnarDay` qui recouvrent [start, end[, dans l'ordre chronologique
+        """
+        return [self.day(key) for key, (key_start, key_end) in zip(self.keys, self._bounds)
+                if key_start < end and start < key_end]
+
+    def iter_speeds(self, start, end):
+        """
+        :return: Un générateur de (temps, vitesse) de la plage, dans l'ordre chronologique
+        """
+        for day in self._days(start, end):
+            yield from day.iter_speeds(start, end)
+
+    def views(self, start, end):
+        """
+        :return: La liste des vues (début du jour, écarts, vitesses) de chaque jour de la plage
+                 (voir `ColumnarDay.view`), sans copie
+        """
+        return [day.view(start, end) for day in self._days(start, end)]
+
+    def load(self, start, end, dtype):
+        """
+        Copie les vitesses de la plage dans un seul tableau NumPy.
+        :param dtype: Type structuré avec les champs 'ts' et 'speed' (ex: `analytics.SPEED_DTYPE`)
+        :return: Le tableau, dans l'ordre chronologique
+        """
+        views = self.views(start, end)
+        rows = np.empty(sum(len(offsets) for _, offsets, _ in views), dtype=dtype)
+        position = 0
+        for start_ms, offsets, speeds in views:
+            rows['ts'][position:position + len(offsets)] = offsets
+            rows['ts'][position:position + len(offsets)] += start_ms
+            rows['speed'][position:position + len(offsets)] = speeds
+            position += len(offsets)
+        return rows
+
+    def stats(self, start, end):
+        """
+        :return: (min, max, somme, nombre) des vitesses de la plage (min et max None si vide)
+        """
+        min_speed = max_speed = None
+        total = count = 0
+        for _, _, speeds in self.views(start, end):
+            if not len(speeds):
+                continue
+            if np is not None:
+                low, high = speeds.min().item(), speeds.max().item()
+            else:
+                low, high = min(speeds), max(speeds)
+            min_speed = low if min_speed is None else min(min_speed, low)
+            max_speed = high if max_speed is None else max(max_speed, high)
+            total += float(sum(speeds))
+            count += len(speeds)
+        return min_speed, max_speed, total, count
+
+    def last_at_or_before(self, ts):
+        """
+        :return: (temps, vitesse) de la dernière vitesse archivée à ou avant `ts`, ou None
+        """
+        for key, (key_start, _) in reversed(list(zip(self.keys, self._bounds))):
+            if key_start <= ts:
+                row = self.day(key).last_at_or_before(ts)
+                if row is not None:
+                    return row
+        return None
+
+    def close(self):
+        """
+        Ferme tous les fichiers ouverts.
+        """
+        while self._open:
+            self._open.popitem()[1].close()
+
+
+def archive_days(db, archive, before_ms, delete=False):
+    """
+    Archive les jours fermés de la base de données, à partir du lendemain du dernier jour déjà
+    archivé.
+    :param db: `Database` à archiver
+    :param archive: `ColumnarArchive` de destination
+    :param before_ms: Millitimestamp avant lequel les jours sont archivés (début d'un jour)
+    :param delete: Supprime les vitesses archivées de la base de données (les agrégats de
+                   `mondon_speed_rollup` et les tags sont gardés)
+    :return: Le nombre de vitesses archivées
+    """
+    rows = db.iter_speeds(archive.end_ms, before_ms, chunk_size=1)
+    try:
+        first = next(rows, None)
+    finally:
+        rows.close()
+    if first is None:
+        return 0
+    total = 0
+    key = ColumnarArchive.key(first[0])
+    while True:
+        start, end = ColumnarArchive.bounds(key)
+        if end > before_ms:
+            break
+        rows = list(db.iter_speeds(start, end))
+        path = archive.path(key)
+        ColumnarDay.write(path, start, end, rows)
+        day = ColumnarDay(path)
+        try:
+            if day.count != len(rows):
+                raise ValueError("Archive {} invalide: {} vitesses au lieu de {}"
+                                 .format(path, day.count, len(rows)))
+        finally:
+            day.close()
+        logger.info("DATABASE", "{} vitesses archivées dans {}", len(rows), path)
+        if delete:
+            db.delete_speeds(start, end)
+        total += len(rows)
+        key = ColumnarArchive.key(end)
+    archive.refresh()
+    return total
+
+
+def main():
+    """
+    Commande d'archivage des jours fermés :
+    python -m objct.archive <base de données> <dossier d'archive> [--before AAAA-MM-JJ]
+                            [--partition day|month] [--delete]
+    """
+    from objct.base_de_donnee import ConnectionProfile, Database
+    from objct.partition import Partitioning
+    from objct.rollup import parse_date
+
+    parser = argparse.ArgumentParser(description="Archive les vitesses des jours fermés dans "
+                                                 "des fichiers en colonnes")
+    parser.add_argument('database', help="Chemin du fichier contenant la base de données")
+    parser.add_argument('directory', help="Dossier des archives")
+    parser.add_argument('--before', type=parse_date, default=None,
+                        help="Jour (exclu) où s'arrêter (par défaut aujourd'hui)")
+    parser.add_argument('--partition', choices=sorted(Partitioning.KEY_FORMATS), default=None,
+                        help="La base de données est partitionnée par jour ou par mois")
+    parser.add_argument('--delete', action='store_true',
+                        help="Supprime les vitesses archivées de la base de données")
+    args = parser.parse_args()
+
+    before = args.before
+    if before is None:
+        before = int(datetime.now().replace(hour=0, minute=0, second=0,
+                                            microsecond=0).timestamp() * 1000)
+    archive = ColumnarArchive(args.directory)
+    # L'acquisition continue d'écrire dans la base de données : l'archivage ne crée pas les
+    # agrégats, ne lance pas l'entretien des partitions et ne fait pas de checkpoint. Sans
+    # --delete, la base de données est ouverte en lecture seule.
+    db = Database(args.database,
+                  partitioning=Partitioning(args.partition) if args.partition else None,
+                  profile=ConnectionProfile(checkpoint_on_close=None), rollups=False,
+                  maintenance=False, read_only=not args.delete)
+    try:
+        count = archive_days(db, archive, before, args.delete)
+    finally:
+        db.close()
+        archive.close()
+    print("{} vitesses archivées".format(count))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,32 @@
 import binascii
+import struct
+
+from objct.fins import FINS_HEADER, TCP_COMMAND_FRAME_SEND, TCP_HEADER, TCP_MAGIC
+
+
+# Codes des zones mémoire FINS (automates CS/CJ). Les codes "mot" lisent des mots de 16 bits,
+# les codes "bit" lisent un seul bit.
+AREA_CIO = 0xB0
+AREA_WR = 0xB1
+AREA_HR = 0xB2
+AREA_AR = 0xB3
+AREA_DM = 0x82
+AREA_CIO_BIT = 0x30
+AREA_WR_BIT = 0x31
+AREA_HR_BIT = 0x32
+AREA_AR_BIT = 0x33
+AREA_DM_BIT = 0x02
+BIT_AREAS = (AREA_CIO_BIT, AREA_WR_BIT, AREA_HR_BIT, AREA_AR_BIT, AREA_DM_BIT)
+
+# Codes commande FINS (MRC, SRC)
+MEMORY_AREA_READ = (0x01, 0x01)
+MULTIPLE_MEMORY_AREA_READ = (0x01, 0x04)
+
+MAX_WORDS_PER_READ = 499  # Nombre maximum de mots lus par une commande MEMORY_AREA_READ
+MAX_ITEMS_PER_MULTIPLE_READ = 167  # Nombre maximum d'éléments d'une MULTIPLE_MEMORY_AREA_READ
+
+READ_ITEM = struct.Struct('>BHB')  # Zone, adresse du mot, numéro du bit
+WORD = struct.Struct('>H')
 
 
 class AutomateCommand:
@@ -14,8 +42,162 @@ class AutomateCommand:
         self.description = description
         self.hex = hex_value
         self.binary = binascii.unhexlify(hex_value)
+        self.fins = self.binary[TCP_HEADER.size:]  # Trame FINS seule, envoyée en FINS/UDP
+
+    @classmethod
+    def from_fins(cls, description, command_code, data, sid=0, da1=0x01, sa1=0xEF, gct=0x03):
+        """
+        Construit une commande FINS encapsulée dans une trame FINS/TCP.
+        Les adresses par défaut sont celles utilisées par `GET_SPEED`.
+        :param description: Description de la commande
+        :param command_code: (MRC, SRC) de la commande
+        :param data: Paramètres de la commande (bytes)
+        :param sid: Numéro de service, retourné tel quel dans la réponse
+        :param da1: Nœud de l'automate
+        :param sa1: Nœud du client
+        :param gct: Nombre de passerelles autorisées
+        :return: La nouvelle `AutomateCommand`
+        """
+        fins = FINS_HEADER.pack(0x80, 0x00, gct, 0x00, da1, 0x00, 0x00, sa1, 0x00, sid,
+                                command_code[0], command_code[1]) + data
+        # La longueur compte la commande FINS/TCP et le code d'erreur (8 octets)
+        frame = TCP_HEADER.pack(TCP_MAGIC, 8 + len(fins), TCP_COMMAND_FRAME_SEND, 0) + fins
+        return cls(description, binascii.hexlify(frame).decode('ascii').upper())
+
+    @classmethod
+    def memory_area_read(cls, description, area, address, count, **kwargs):
+        """
+        Construit une commande qui lit `count` mots consécutifs d'une zone mémoire.
+        :param description: Description de la commande
+        :param area: Code de la zone mémoire (`AREA_*`)
+        :param address: Adresse du premier mot
+        :param count: Nombre de mots à lire
+        :param kwargs: Paramètres d'adressage passés à `from_fins`
+        :return: La nouvelle `AutomateCommand`
+        """
+        if not 0 < count <= MAX_WORDS_PER_READ:
+            raise ValueError("Impossible de lire {} mots en une commande".format(count))
+        data = READ_ITEM.pack(area, address, 0) + WORD.pack(count)
+        return cls.from_fins(description, MEMORY_AREA_READ, data, **kwargs)
+
+    @classmethod
+    def multiple_memory_area_read(cls, description, items, **kwargs):
+        """
+        Construit une commande qui lit plusieurs mots ou bits, éventuellement dans des zones
+        différentes.
+        :param description: Description de la commande
+        :param items: Liste de (zone, adresse, bit)
+        :param kwargs: Paramètres d'adressage passés à `from_fins`
+        :return: La nouvelle `AutomateCommand`
+        """
+        if not 0 < len(items) <= MAX_ITEMS_PER_MULTIPLE_READ:
+            raise ValueError("Impossible de lire {} éléments en une commande".format(len(items)))
+        data = b''.join(READ_ITEM.pack(area, address, bit) for area, address, bit in items)
+        return cls.from_fins(description, MULTIPLE_MEMORY_AREA_READ, data, **kwargs)
+
+
+class Tag:
+    """
+    Définit une valeur à lire dans la mémoire de l'automate.
+    """
+    # Types supportés : nombre de mots occupés et fonction de décodage des mots lus. Les valeurs
+    # de 32 bits sont stockées sur deux mots consécutifs, le mot de poids faible en premier.
+    TYPES = {
+        'BOOL': (1, lambda words: bool(words[0])),
+        'UINT16': (1, lambda words: words[0]),
+        'INT16': (1, lambda words: words[0] - 0x10000 if words[0] & 0x8000 else words[0]),
+        'UINT32': (2, lambda words: words[1] << 16 | words[0]),
+        'INT32': (2, lambda words: struct.unpack('>i', struct.pack('>HH', words[1], words[0]))[0]),
+        'FLOAT': (2, lambda words: struct.unpack('>f', struct.pack('>HH', words[1], words[0]))[0]),
+    }
+
+    def __init__(self, name, area, address, data_type='UINT16', bit=0):
+        """
+        Crée une nouvelle instance de `Tag`
+        :param name: Nom du tag (ex: "speed"), utilisé pour l'enregistrement
+        :param area: Code de la zone mémoire (`AREA_*`). Pour un `BOOL`, une zone bit.
+        :param address: Adresse du (premier) mot
+        :param data_type: Type de la valeur (une clé de `TYPES`)
+        :param bit: Numéro du bit pour un `BOOL`
+        """
+        if data_type not in Tag.TYPES:
+            raise ValueError("Type de tag inconnu: {}".format(data_type))
+        if (data_type == 'BOOL') != (area in BIT_AREAS):
+            raise ValueError("Le tag {} de type {} ne peut pas être lu dans la zone {:02X}"
+                             .format(name, data_type, area))
+        self.name = name
+        self.area = area
+        self.address = address
+        self.data_type = data_type
+        self.bit = bit
+        self.size, self.decode = Tag.TYPES[data_type]
+
+
+class TagSet:
+    """
+    Ensemble de tags lus par une seule commande.
+    Si tous les tags sont des mots d'une même zone assez proches les uns des autres, une seule
+    MEMORY_AREA_READ lit toute la plage. Sinon une MULTIPLE_MEMORY_AREA_READ lit chaque mot.
+    """
+    def __init__(self, description, tags, **kwargs):
+        """
+        Crée une nouvelle instance de `TagSet` et construit la commande de lecture.
+        :param description: Description de la commande
+        :param tags: Liste de `Tag`
+        :param kwargs: Paramètres d'adressage passés à `AutomateCommand.from_fins`
+        """
+        if not tags:
+            raise ValueError("Un TagSet doit contenir au moins un tag")
+        self.tags = list(tags)
+        areas = set(tag.area for tag in self.tags)
+        first = min(tag.address for tag in self.tags)
+        last = max(tag.address + tag.size for tag in self.tags)
+        if len(areas) == 1 and not areas & set(BIT_AREAS) and last - first <= MAX_WORDS_PER_READ:
+            self.command = AutomateCommand.memory_area_read(
+                description, self.tags[0].area, first, last - first, **kwargs)
+            # Position (en octets) du premier mot de chaque tag dans les données de la réponse
+            self._layout = [(tag, [(tag.address - first + i) * 2 for i in range(tag.size)], 2)
+                            for tag in self.tags]
+        else:
+            items = [(tag.area, tag.address + i, tag.bit)
+                     for tag in self.tags for i in range(tag.size)]
+            self.command = AutomateCommand.multiple_memory_area_read(description, items, **kwargs)
+            # Chaque élément de la réponse commence par le code de la zone (1 octet) suivi de
+            # la valeur (1 octet pour un bit, 2 octets pour un mot)
+            self._layout = []
+            offset = 0
+            for tag in self.tags:
+                value_size = 1 if tag.area in BIT_AREAS else 2
+                offsets = []
+                for _ in range(tag.size):
+                    offsets.append(offset + 1)
+                    offset += 1 + value_size
+                self._layout.append((tag, offsets, value_size))
+        self.response_size = max(offsets[-1] + value_size
+                                 for _, offsets, value_size in self._layout)
+
+    def decode(self, payload):
+        """
+        Décode les données d'une réponse à `command`.
+        :param payload: Données de la réponse (bytes ou memoryview)
+        :return: Dictionnaire nom du tag -> valeur
+        """
+        if len(payload) < self.response_size:
+            raise ValueError("Réponse trop courte: {} octets au lieu de {}"
+                             .format(len(payload), self.response_size))
+        values = {}
+        for tag, offsets, value_size in self._layout:
+            if value_size == 1:
+                words = [payload[offset] for offset in offsets]
+            else:
+                words = [WORD.unpack_from(payload, offset)[0] for offset in offsets]
+            values[tag.name] = tag.decode(words)
+        return values
 
 
 # Définition de commandes pour l'automate
 CONNECT = AutomateCommand('CONNECT', '46494E530000000C000000000000000000000000')
 GET_SPEED = AutomateCommand('GET_SPEED', '46494E530000001A000000020000000080000300010000EF00070101B10014000001')
+
+# Tag de la vitesse lue par `GET_SPEED` (mot W20)
+SPEED_TAG = Tag('speed', AREA_WR, 20, 'UINT16')
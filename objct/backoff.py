@@ -0,0 +1,41 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from random import random
+
+
+class Backoff:
+    """
+    Calcule des temps d'attente qui augmentent de manière exponentielle à chaque échec, avec une
+    part aléatoire (jitter) pour que plusieurs clients ne réessayent pas tous au même moment.
+    """
+    def __init__(self, initial_ms=1000, max_ms=30000, factor=2, jitter=0.5):
+        """
+        Crée une nouvelle instance de `Backoff`
+        :param initial_ms: Temps d'attente après le premier échec en millisecondes
+        :param max_ms: Temps d'attente maximum en millisecondes
+        :param factor: Facteur multiplicatif appliqué à chaque nouvel échec
+        :param jitter: Part du temps d'attente tirée au hasard (entre 0 et 1). Avec 0.5, le temps
+                       d'attente est compris entre la moitié et la totalité du délai calculé.
+        """
+        self.initial_ms = initial_ms
+        self.max_ms = max_ms
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0  # Nombre d'échecs depuis la dernière réinitialisation
+
+    def next_delay_ms(self):
+        """
+        Enregistre un nouvel échec et calcule le temps d'attente correspondant.
+        :return: Le temps à attendre en millisecondes avant la prochaine tentative
+        """
+        # L'exposant est borné pour ne pas calculer des nombres énormes après une longue panne
+        delay_ms = min(self.max_ms, self.initial_ms * self.factor ** min(self.attempts, 32))
+        self.attempts += 1
+        return delay_ms * (1 - self.jitter * random())
+
+    def reset(self):
+        """
+        Réinitialise le compteur d'échecs après un succès.
+        """
+        self.attempts = 0
@@ -1,10 +1,90 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sqlite3
-from time import sleep
+from collections import OrderedDict, deque
+from time import monotonic, sleep
+from time import time as wall_time
+from urllib.request import pathname2url
 
 from objct.logger import logger
+from objct.metrics import metrics
+from objct.partition import PartitionMaintenance
+from objct.rollup import CREATE_ROLLUP_TABLE, GRANULARITIES_MS, HOUR_MS, SECOND_MS, \
+    RollupAccumulator
+from objct.storage_policy import iter_steps
+
+
+TRANSACTION_DURATION = metrics.histogram('db_transaction_duration_ms',
+                                         "Durée d'une transaction, tentatives comprises")
+TRANSACTION_RETRIES = metrics.counter('db_transaction_retries_total',
+                                      "Nombre de nouvelles tentatives après une erreur SQLite")
+TRANSACTION_FAILURES = metrics.counter('db_transaction_failures_total',
+                                       "Nombre de transactions abandonnées")
+
+
+class ConnectionProfile:
+    """
+    Réglages SQLite appliqués à chaque (re)connexion à la base de données.
+    Le mode WAL permet aux outils de lecture (tableaux de bord, rapports) de lire la base de
+    données pendant que `SpeedThread` écrit, sans que l'un bloque l'autre.
+    """
+    def __init__(self, journal_mode='WAL', synchronous='NORMAL', busy_timeout_ms=5000,
+                 mmap_size=256 * 1024 * 1024, cache_size_kb=16 * 1024, wal_autocheckpoint=1000,
+                 checkpoint_on_close='TRUNCATE'):
+        """
+        Crée une nouvelle instance de `ConnectionProfile`
+        :param journal_mode: Mode de journalisation (WAL, DELETE, TRUNCATE, ...)
+        :param synchronous: Niveau de synchronisation sur le disque (OFF, NORMAL, FULL, EXTRA).
+                            En mode WAL, NORMAL ne fait un fsync qu'aux checkpoints.
+        :param busy_timeout_ms: Temps pendant lequel SQLite attend qu'un verrou se libère avant de
+                                retourner "database is locked"
+        :param mmap_size: Taille en octets de la base de données lue via mmap (0 pour désactiver)
+        :param cache_size_kb: Taille du cache de pages en kilo-octets
+        :param wal_autocheckpoint: Nombre de pages dans le WAL qui déclenche un checkpoint
+                                   automatique (0 pour désactiver)
+        :param checkpoint_on_close: Mode du checkpoint fait à la fermeture de la connexion
+                                    (PASSIVE, FULL, RESTART, TRUNCATE ou None pour aucun)
+        """
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.busy_timeout_ms = busy_timeout_ms
+        self.mmap_size = mmap_size
+        self.cache_size_kb = cache_size_kb
+        self.wal_autocheckpoint = wal_autocheckpoint
+        self.checkpoint_on_close = checkpoint_on_close
+
+    def apply(self, conn, read_only=False):
+        """
+        Applique les réglages sur une connexion.
+        :param conn: Connexion SQLite3 sur laquelle appliquer les réglages
+        :param read_only: La connexion est en lecture seule : seuls les réglages de la connexion
+                          sont appliqués, pas ceux du fichier (voir `apply_to_schema`)
+        """
+        conn.execute("PRAGMA busy_timeout = {:d}".format(self.busy_timeout_ms))
+        if not read_only:
+            self.apply_to_schema(conn, 'main')
+        conn.execute("PRAGMA mmap_size = {:d}".format(self.mmap_size))
+        # Une valeur négative de cache_size est interprétée par SQLite en kilo-octets
+        conn.execute("PRAGMA cache_size = {:d}".format(-self.cache_size_kb))
+        conn.execute("PRAGMA wal_autocheckpoint = {:d}".format(self.wal_autocheckpoint))
+
+    def apply_to_schema(self, conn, schema):
+        """
+        Applique les réglages propres à chaque fichier (mode de journalisation et
+        synchronisation) sur une base de données de la connexion, par exemple une partition
+        attachée.
+        :param conn: Connexion SQLite3
+        :param schema: Nom de la base de données dans la connexion ("main" ou nom de l'ATTACH)
+        """
+        journal_mode = conn.execute("PRAGMA {}.journal_mode = {}"
+                                    .format(schema, self.journal_mode)).fetchone()[0]
+        if journal_mode.upper() != self.journal_mode.upper():
+            # Par exemple, le mode WAL n'est pas disponible sur un partage réseau
+            logger.warning("DATABASE", "Mode de journalisation {} refusé, mode utilisé: {}",
+                           self.journal_mode, journal_mode)
+        conn.execute("PRAGMA {}.synchronous = {}".format(schema, self.synchronous))
 
 
 class Database:
@@ -17,39 +97,351 @@ class Database:
                               # que un autre programme essaye d'y accéder. Ou si la connexion à la
                               # base de données est cassée pour une raison inconnue.
     SLEEP_ON_ERROR_MS = 10  # Temps d'attent en millisecondes en cas d'erreur avant de réessayer.
+    BATCH_SIZE = 1  # Nombre de vitesses accumulées en mémoire avant d'être écrites dans une seule
+                    # transaction. Avec 1, chaque vitesse est écrite immédiatement.
+    BATCH_DELAY_MS = 0  # Temps maximum en millisecondes qu'une vitesse peut rester en mémoire
+                        # avant d'être écrite. Avec 0, seul `BATCH_SIZE` déclenche l'écriture.
+    MAX_BUFFERED_SAMPLES = 10000  # Nombre maximum de vitesses gardées en mémoire si les écritures
+                                  # échouent. Au delà, les plus anciennes sont abandonnées.
+    MAX_BUFFERED_TAG_ROWS = 100000  # Nombre maximum de valeurs de tags gardées en mémoire si les
+                                    # écritures échouent. Au delà, les plus anciennes sont
+                                    # abandonnées.
+    DEFAULT_MACHINE = 'mondon'  # Machine associée aux tags quand aucune n'est précisée
+    SPEED_KEY = 'mondon_speed'  # Clé des vitesses pour `storage_policy` (les tags utilisent
+                                # (machine, tag))
+    CHUNK_SIZE = 5000  # Nombre de lignes lues à la fois par les générateurs de lecture
+    MAX_ATTACHED_PARTITIONS = 8  # Nombre maximum de partitions attachées en même temps (SQLite
+                                 # en autorise 10 par défaut)
+    LEGACY_KEY = ''  # Clé de la base de données non partitionnée (`database_location`), encore
+                     # lue en mode partitionné si elle existe
+    ROLLUPS_ENABLED = True  # Maintient les agrégats par seconde/minute/heure de
+                            # `mondon_speed_rollup` à chaque écriture de vitesses
+    DELETE_CHUNK_SIZE = 5000  # Nombre maximum de vitesses supprimées par transaction
+                              # (`delete_speeds`), pour ne bloquer les écritures de l'acquisition
+                              # que peu de temps
+    DELETE_PAUSE_MS = 20  # Pause entre deux transactions de `delete_speeds`, pour laisser
+                          # l'acquisition écrire
 
-    def __init__(self, database_location):
+    DEFAULT_PROFILE = ConnectionProfile()  # Réglages SQLite utilisés si aucun n'est donné
+
+    def __init__(self, database_location, batch_size=None, batch_delay_ms=None, profile=None,
+                 rollups=None, storage_policy=None, partitioning=None, archive=None,
+                 flush_attempts=None, read_only=False, maintenance=True):
         """
         Crée une nouvelle instance de `Database` et établit une connexion à la base de données.
         :param database_location: Chemin du fichier contenant la base de données
+        :param batch_size: Nombre de vitesses à accumuler avant une écriture groupée
+                           (par défaut `BATCH_SIZE`)
+        :param batch_delay_ms: Temps maximum en millisecondes avant une écriture groupée
+                               (par défaut `BATCH_DELAY_MS`)
+        :param profile: `ConnectionProfile` appliqué à chaque connexion
+                        (par défaut `DEFAULT_PROFILE`)
+        :param rollups: Maintient les agrégats de `mondon_speed_rollup`
+                        (par défaut `ROLLUPS_ENABLED`)
+        :param storage_policy: Politique qui choisit les valeurs écrites (ex: `DeadbandPolicy`).
+                               Par défaut, toutes les valeurs sont écrites.
+        :param partitioning: `Partitioning` qui découpe la base de données en un fichier par jour
+                             ou par mois. Les écritures vont dans la partition de leur temps, et
+                             les lectures attachent les partitions de la plage demandée.
+                             Par défaut, tout est dans `database_location`.
+        :param archive: `ColumnarArchive` des jours fermés : les lectures de vitesses avant
+                        `archive.end_ms` se font dans l'archive, les suivantes dans la base de
+                        données (qui peut ne plus contenir les vitesses archivées).
+        :param flush_attempts: Nombre d'essais de l'écriture du buffer (`flush`) avant
+                               d'abandonner (par défaut `MAX_ATTEMPT_ON_ERROR`). Une écriture
+                               peut attendre jusqu'à `flush_attempts` fois le `busy_timeout_ms`
+                               de `profile`. Avec 1, une écriture bloquée par un verrou abandonne
+                               vite et les vitesses restent dans le buffer pour la suivante.
+        :param read_only: Ouvre la base de données en lecture seule (outils de rapport qui
+                          tournent pendant l'acquisition) : les tables ne sont pas créées, le
+                          mode de journalisation n'est pas changé, il n'y a ni agrégats, ni
+                          entretien des partitions, ni checkpoint à la fermeture.
+        :param maintenance: Lance `PartitionMaintenance` en mode partitionné. Les outils qui
+                            tournent pendant l'acquisition laissent l'entretien à celle-ci.
         """
         self.database_location = database_location
+        self.partitioning = partitioning
+        self.read_only = read_only
+        self.maintenance = PartitionMaintenance(database_location, partitioning) \
+            if partitioning and maintenance and not read_only else None
+        self._partition_key = partitioning.key(wall_time() * 1000) if partitioning else None
+        self._attached = OrderedDict()  # Clé -> schéma des partitions attachées, de la moins
+                                        # récemment utilisée à la plus récemment utilisée
+        self._schema_users = {}  # Schéma -> nombre d'utilisations en cours (non détachable)
+        self.profile = profile or Database.DEFAULT_PROFILE
+        self.flush_attempts = flush_attempts or Database.MAX_ATTEMPT_ON_ERROR
+        self.batch_size = max(1, batch_size or Database.BATCH_SIZE)
+        self.batch_delay_ms = batch_delay_ms or Database.BATCH_DELAY_MS
+        self.storage_policy = storage_policy
+        self.archive = archive
+        self._samples = deque()  # Vitesses reçues depuis la dernière écriture, sous la forme
+                                 # (time, value). Ce sont elles qui sont ajoutées aux agrégats.
+        self._buffer = deque()  # Vitesses en attente d'écriture, sous la forme (time, value)
+        self._tag_buffer = []  # Tags en attente d'écriture, sous la forme (machine, tag, time, value)
+        self._pending_samples = 0  # Nombre de lectures (appels à `insert_speed`/`insert_tags`)
+                                   # bufferisées
+        self._buffer_start = None  # Temps (monotonic) auquel la première vitesse a été bufferisée
+        self._held_speed = None  # Dernière vitesse (time, value) écrite dans les agrégats. Avec
+                                 # `storage_policy`, elle n'est écrite dans `mondon_speed` qu'à
+                                 # `close` : elle termine la dernière marche (voir `_iter_steps`)
+        if rollups is None:
+            rollups = Database.ROLLUPS_ENABLED
+        self.rollup = RollupAccumulator() if rollups and not read_only else None
+        self.conn = None
         self._init_db_connection()
+        if not read_only:
+            self._create_tables()
+            self._ensure_time_index()
+        if self.rollup:
+            # Les vitesses déjà écrites (par exemple rejouées par un `SpoolDrainer` après un arrêt
+            # brutal) ne sont pas comptées une deuxième fois dans les agrégats
+            self.rollup.last = self.get_latest_speed()
+        if self.maintenance:
+            self._start_maintenance(wall_time() * 1000)
 
     def _init_db_connection(self):
-        logger.log("DATABASE", "Connection à la base de données {}".format(self.database_location))
-        self.conn = sqlite3.connect(self.database_location)
+        """
+        (Re)crée la connexion à la base de données (la partition courante en mode partitionné)
+        et lui applique `profile`. Les partitions qui étaient attachées sont rattachées.
+        En lecture seule et en mode partitionné, la connexion est une base de données en
+        mémoire et toutes les partitions sont attachées (la partition courante peut ne pas
+        encore exister).
+        """
+        location = self.partitioning.path(self.database_location, self._partition_key) \
+            if self.partitioning else self.database_location
+        if self.read_only:
+            location = ':memory:' if self.partitioning else _read_only_uri(location)
+        logger.info("DATABASE", "Connection à la base de données {}", location)
+        if self.conn:
+            try:
+                self.conn.close()
+            except sqlite3.Error:
+                pass
+        self.conn = sqlite3.connect(location, timeout=self.profile.busy_timeout_ms / 1000,
+                                    uri=self.read_only)
+        self.profile.apply(self.conn, self.read_only)
+        for key, schema in self._attached.items():
+            self._attach(key, schema)
+
+    def _partition_path(self, key):
+        """
+        :return: Le chemin du fichier de la partition `key`
+        """
+        if key == Database.LEGACY_KEY:
+            return self.database_location
+        return self.partitioning.path(self.database_location, key)
+
+    def _attach(self, key, schema):
+        """
+        Attache le fichier de la partition `key` à la connexion sous le nom `schema`.
+        """
+        if self.read_only:
+            self.conn.execute("ATTACH DATABASE ? AS {}".format(schema),
+                              (_read_only_uri(self._partition_path(key)),))
+            return
+        self.conn.execute("ATTACH DATABASE ? AS {}".format(schema), (self._partition_path(key),))
+        self.profile.apply_to_schema(self.conn, schema)
+
+    def _schema(self, key):
+        """
+        Retourne le schéma à utiliser dans les requêtes pour la partition `key`, en l'attachant
+        si besoin. Si trop de partitions sont attachées, la moins récemment utilisée qui n'est
+        pas en cours d'utilisation est détachée.
+        :param key: Clé de la partition (None sans partitionnement)
+        :return: "main" pour la partition courante, sinon le nom de l'ATTACH
+        """
+        if key is None or key == self._partition_key and not self.read_only:
+            return 'main'
+        schema = self._attached.get(key)
+        if schema:
+            self._attached.move_to_end(key)
+            return schema
+        while len(self._attached) >= Database.MAX_ATTACHED_PARTITIONS:
+            unused = [old_key for old_key, old_schema in self._attached.items()
+                      if not self._schema_users.get(old_schema)]
+            if not unused:
+                raise Exception("Impossible d'attacher la partition {}, {} partitions sont déjà "
+                                "utilisées".format(key, len(self._attached)))
+            self.conn.execute("DETACH DATABASE {}".format(self._attached.pop(unused[0])))
+        schema = 'legacy' if key == Database.LEGACY_KEY else 'p' + key
+        self._attach(key, schema)
+        if not self.read_only:
+            self._create_tables(schema)
+        self._attached[key] = schema
+        return schema
+
+    def _acquire(self, key):
+        """
+        Retourne le schéma de la partition `key` et empêche de la détacher jusqu'au `_release`.
+        """
+        schema = self._schema(key)
+        self._schema_users[schema] = self._schema_users.get(schema, 0) + 1
+        return schema
+
+    def _release(self, schema):
+        """
+        Permet de nouveau de détacher `schema`.
+        """
+        self._schema_users[schema] -= 1
+
+    def _write_schema(self, ts, schemas):
+        """
+        Retourne le schéma où écrire une valeur du millitimestamp `ts`. La partition reste
+        attachée jusqu'au `_release_all`.
+        :param ts: Millitimestamp de la valeur
+        :param schemas: Dictionnaire clé -> schéma des partitions déjà utilisées, complété
+        :return: Le schéma de la partition
+        """
+        key = self.partitioning.key(ts) if self.partitioning else None
+        if key not in schemas:
+            schemas[key] = self._acquire(key)
+        return schemas[key]
+
+    def _release_all(self, schemas):
+        """
+        Permet de nouveau de détacher les partitions utilisées par `_write_schema`.
+        """
+        for schema in schemas.values():
+            self._release(schema)
+
+    def _source_keys(self, start, end, legacy=True):
+        """
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :param legacy: Inclut la base de données non partitionnée si elle existe
+        :return: Les clés des partitions à lire pour une plage, dans l'ordre chronologique
+        """
+        if not self.partitioning:
+            return [None]
+        keys = self.partitioning.keys_between(self.database_location, start, end)
+        if self._partition_key not in keys and not self.read_only:
+            start_key, end_key = self.partitioning.bounds(self._partition_key)
+            if start_key < end and start < end_key:
+                keys.append(self._partition_key)
+                keys.sort()
+        if legacy and os.path.exists(self.database_location):
+            keys.insert(0, Database.LEGACY_KEY)
+        return keys
+
+    def _rotate_if_needed(self):
+        """
+        En mode partitionné, ouvre la nouvelle partition courante quand le jour (ou le mois)
+        change, puis lance l'entretien des partitions fermées en tâche de fond.
+        """
+        if not self.partitioning:
+            return
+        now_ms = wall_time() * 1000
+        key = self.partitioning.key(now_ms)
+        if key == self._partition_key:
+            return
+        logger.info("DATABASE", "Changement de partition: {} -> {}", self._partition_key, key)
+        self._attached.pop(key, None)
+        self._partition_key = key
+        self._init_db_connection()
+        self._create_tables()
+        self._ensure_time_index()
+        if self.maintenance:
+            self._start_maintenance(now_ms)
+
+    def _start_maintenance(self, now_ms):
+        """
+        Lance l'entretien des partitions fermées. Les partitions expirées sont d'abord détachées
+        de la connexion : sous Windows, un fichier ouvert ne peut être ni déplacé ni supprimé.
+        Celles qui sont en cours d'utilisation restent attachées et ne sont pas expirées par cet
+        entretien.
+        :param now_ms: Millitimestamp utilisé pour la rétention
+        """
+        for key, schema in list(self._attached.items()):
+            if key != Database.LEGACY_KEY and self.partitioning.is_expired(key, now_ms) \
+                    and not self._schema_users.get(schema):
+                self.conn.execute("DETACH DATABASE {}".format(schema))
+                del self._attached[key]
+        self.maintenance.start(self._partition_key, now_ms, attached_keys=set(self._attached))
+
+    def checkpoint(self, mode='PASSIVE'):
+        """
+        Reporte le contenu du WAL dans le fichier de la base de données.
+        :param mode: PASSIVE (n'attend pas les lecteurs), FULL, RESTART ou TRUNCATE (vide le WAL)
+        :return: (busy, pages dans le WAL, pages reportées) comme retourné par SQLite
+        """
+        return self.conn.execute("PRAGMA wal_checkpoint({})".format(mode)).fetchone()
+
+    def _create_tables(self, schema='main'):
+        """
+        Crée les tables utilisées par `Database` si elles n'existent pas.
+        :param schema: Base de données de la connexion où créer les tables
+        """
+        self._run_query("CREATE TABLE IF NOT EXISTS {}.mondon_speed "
+                        "(ts INTEGER PRIMARY KEY, speed INTEGER)".format(schema), ())
+        self._run_query("CREATE TABLE IF NOT EXISTS {}.mondon_tag "
+                        "(machine TEXT, tag TEXT, ts INTEGER, value REAL, "
+                        "PRIMARY KEY (machine, tag, ts))".format(schema), ())
+        self._run_query(CREATE_ROLLUP_TABLE.format(schema=schema), ())
+
+    def _uses_time_index(self):
+        """
+        :return: True si SQLite utilise un index pour une requête par plage de temps sur
+                 `mondon_speed`
+        """
+        plan = self.conn.execute("EXPLAIN QUERY PLAN SELECT ts, speed FROM mondon_speed "
+                                 "WHERE ts >= ? AND ts < ?", (0, 0)).fetchall()
+        return any('USING' in row[-1] and 'INDEX' in row[-1].upper() or
+                   'PRIMARY KEY' in row[-1] for row in plan)
 
-    def _run_query(self, query, args):
+    def _ensure_time_index(self):
+        """
+        Vérifie que les requêtes par plage de temps sur `mondon_speed` utilisent un index (la
+        clé primaire `ts`), et crée l'index sur `ts` sinon (ancienne base de données).
+        """
+        if self._uses_time_index():
+            return
+        logger.warning("DATABASE", "Aucun index sur mondon_speed.ts, création de l'index")
+        self._run_query("CREATE INDEX IF NOT EXISTS mondon_speed_ts ON mondon_speed (ts)", ())
+        if not self._uses_time_index():
+            logger.error("DATABASE", "Les requêtes par plage de temps sur mondon_speed "
+                                     "n'utilisent pas d'index")
+
+    def _run_query(self, query, args, many=False):
         """
         Exécute une requête sur la base de données
         :param query: Requête SQL à exécuter
         :param args: Paramètre de la requête à exécuter
+        :param many: Si vrai, `args` est une liste de paramètres et la requête est exécutée
+                     pour chacun d'eux (`executemany`) dans une seule transaction
         :return: Un array avec le résultat de la requête.
                  Retourne un tableau vide pour les CREATE et INSERT
         """
-        logger.log("DATABASE", "Requête: {} - Paramêtres: {}".format(query, args))
+        return self._run_transaction([(query, args, many)])
+
+    def _run_transaction(self, statements, max_attempts=None):
+        """
+        Exécute plusieurs requêtes dans une seule transaction (un seul commit).
+        :param statements: Liste de (requête, paramètres, many) comme pour `_run_query`
+        :param max_attempts: Nombre d'essais avant d'abandonner (par défaut
+                             `MAX_ATTEMPT_ON_ERROR`)
+        :return: Le résultat de la dernière requête
+        """
+        max_attempts = max_attempts or Database.MAX_ATTEMPT_ON_ERROR
+        for query, args, _ in statements:
+            logger.debug("DATABASE", "Requête: {} - Paramêtres: {}", query, args)
         data = None
         attempt = 0
+        start = monotonic()
 
-        while attempt < Database.MAX_ATTEMPT_ON_ERROR:
+        while attempt < max_attempts:
             if attempt > 0:
+                TRANSACTION_RETRIES.inc()
                 sleep(Database.SLEEP_ON_ERROR_MS / 1000)  # Pause entre 2 tentatives
-                logger.log("DATABASE", "(Tentative #{}) Requête: {} - Paramêtres: {}"
-                           .format(attempt + 1, query, args))
+                for query, args, _ in statements:
+                    logger.warning("DATABASE", "(Tentative #{}) Requête: {} - Paramêtres: {}",
+                                   attempt + 1, query, args)
             try:
                 cursor = self.conn.cursor()
-                cursor.execute(query, args)
+                for query, args, many in statements:
+                    if many:
+                        cursor.executemany(query, args)
+                    else:
+                        cursor.execute(query, args)
                 self.conn.commit()
                 data = cursor.fetchall()
                 break
@@ -57,7 +449,8 @@ class Database:
                 # OperationalError veut généralement dire que la base de données est locked ou
                 # de manière générale qu'une erreur s'est produite lors de la lecture du fichier
                 # où la base de données est stockée.
-                logger.log("DATABASE", "OperationalError: {}".format(e))
+                logger.warning("DATABASE", "OperationalError: {}", e)
+                self._rollback()
                 attempt += 1
             except sqlite3.DatabaseError as e:
                 if e.__class__.__name__ == "DatabaseError":
@@ -65,34 +458,646 @@ class Database:
                     # En générale, cela veut dire que la base de données est corrompue et l'on ne
                     # peut pas faire grand chose. On essaye quand même de s'en sortir en recréant
                     # la connexion à la base de données.
-                    logger.log("DATABASE", "DatabaseError: {}".format(e))
+                    logger.error("DATABASE", "DatabaseError: {}", e)
                     attempt += 1
                     self._init_db_connection()
                 # Si l'exception n'est pas directement une DatabaseError (ex: une sous class de
                 # DatabaseError comme IntegrityError), on abandonne directement.
                 else:
+                    TRANSACTION_FAILURES.inc()
+                    self._rollback()
                     raise e
 
+        TRANSACTION_DURATION.observe((monotonic() - start) * 1000)
         # Dans le cas où on a consommé tous les essais possible, on génère une erreur
-        if attempt >= Database.MAX_ATTEMPT_ON_ERROR:
+        if attempt >= max_attempts:
+            TRANSACTION_FAILURES.inc()
             raise Exception("Abandon de la requête {} avec les paramètres {}. Une erreur s'est"
                             "produite à chacun des {} essais"
-                            .format(query, args, Database.MAX_ATTEMPT_ON_ERROR))
+                            .format(statements[-1][0], statements[-1][1],
+                                    max_attempts))
 
         return data
 
-    def insert_speed(self, value, time):
+    def _rollback(self):
+        """
+        Annule la transaction en cours (les requêtes d'un lot déjà exécutées avant l'erreur).
         """
-        Insert une nouvelle vitesse dans la base de données
+        try:
+            self.conn.rollback()
+        except sqlite3.Error:
+            pass
+
+    def insert_speed(self, value, time, tags=None, machine=None):
+        """
+        Ajoute une nouvelle vitesse au buffer et écrit le buffer dans la base de données si il
+        est plein (`batch_size`) ou si la plus ancienne vitesse attend depuis plus de
+        `batch_delay_ms` millisecondes.
         :param value: Valeur de la vitesse à insérer
         :param time: Temps à lequel la vitesse a été reçu
+        :param tags: Valeurs des autres tags lus en même temps que la vitesse (dictionnaire nom
+                     du tag -> valeur, voir `insert_tags`). La lecture ne compte qu'une fois pour
+                     `batch_size`.
+        :param machine: Nom de la machine des tags (par défaut `DEFAULT_MACHINE`)
+        :return: La liste des vitesses (value, time) qui viennent d'être écrites dans la base de
+                 de données (ou écartées par `storage_policy`). Liste vide si la vitesse est
+                 seulement bufferisée.
+        """
+        self._start_buffering()
+        if tags:
+            self._buffer_tags(time, tags, machine)
+        self._samples.append((time, value))
+        if self.storage_policy:
+            self._buffer.extend(self.storage_policy.filter(Database.SPEED_KEY, time, value))
+        else:
+            self._buffer.append((time, value))
+        if len(self._samples) > Database.MAX_BUFFERED_SAMPLES:
+            # La plus ancienne vitesse est abandonnée avec ses lignes : elle n'est pas non plus
+            # comptée dans les agrégats. Pendant une coupure de la base de données, chaque
+            # nouvelle vitesse en abandonne une : `deque` garde ce coût constant.
+            dropped_ts, dropped = self._samples.popleft()
+            while self._buffer and self._buffer[0][0] <= dropped_ts:
+                self._buffer.popleft()
+            logger.error("DATABASE", "Buffer plein, abandon de la vitesse {} au temps {}",
+                         dropped, dropped_ts)
+        return self.flush_if_due()
+
+    def insert_tags(self, time, values, machine=None):
         """
+        Ajoute les valeurs d'un ensemble de tags lus au même moment au buffer. Elles sont écrites
+        dans la table `mondon_tag` dans la même transaction que les vitesses.
+        :param time: Temps auquel les valeurs ont été reçues
+        :param values: Dictionnaire nom du tag -> valeur
+        :param machine: Nom de la machine (par défaut `DEFAULT_MACHINE`)
+        :return: La liste des vitesses (value, time) qui viennent d'être écrites
+        """
+        self._start_buffering()
+        self._buffer_tags(time, values, machine)
+        return self.flush_if_due()
+
+    def _buffer_tags(self, time, values, machine=None):
+        """
+        Ajoute les valeurs d'un ensemble de tags au buffer (après `storage_policy`). Au delà de
+        `MAX_BUFFERED_TAG_ROWS` valeurs, les plus anciennes sont abandonnées.
+        """
+        machine = machine or Database.DEFAULT_MACHINE
+        if self.storage_policy:
+            for tag, value in values.items():
+                self._tag_buffer.extend((machine, tag, ts, kept)
+                                        for ts, kept in self.storage_policy.filter((machine, tag),
+                                                                                   time, value))
+        else:
+            self._tag_buffer.extend((machine, tag, time, value) for tag, value in values.items())
+        excess = len(self._tag_buffer) - Database.MAX_BUFFERED_TAG_ROWS
+        if excess > 0:
+            last_dropped = self._tag_buffer[excess - 1]
+            del self._tag_buffer[:excess]
+            logger.error("DATABASE", "Buffer plein, abandon de {} valeurs de tags (jusqu'au "
+                                     "temps {})", excess, last_dropped[2])
+
+    def _start_buffering(self):
+        """
+        Compte un nouvel échantillon bufferisé et note l'heure du premier.
+        """
+        if not self._pending_samples:
+            self._buffer_start = monotonic()
+        self._pending_samples += 1
+
+    def flush_if_due(self):
+        """
+        Écrit le buffer dans la base de données si `batch_size` ou `batch_delay_ms` est atteint.
+        :return: La liste des vitesses (value, time) qui viennent d'être écrites
+        """
+        if not self._pending_samples:
+            return []
+        elapsed_ms = (monotonic() - self._buffer_start) * 1000
+        if self._pending_samples >= self.batch_size or \
+                (self.batch_delay_ms and elapsed_ms >= self.batch_delay_ms):
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Écrit toutes les vitesses du buffer dans la base de données avec un `executemany` dans
+        une seule transaction (un seul fsync). Les vitesses sont ajoutées aux agrégats dans la
+        même transaction.
+        Si l'écriture échoue, les vitesses restent dans le buffer pour la prochaine tentative (et
+        ne sont pas comptées dans les agrégats).
+        :return: La liste des vitesses (value, time) qui viennent d'être écrites (ou écartées
+                 par `storage_policy`)
+        """
+        if not self._pending_samples:
+            return []
+        self._rotate_if_needed()
+        # En mode partitionné, chaque valeur est écrite dans la partition de son temps. Toutes
+        # les partitions concernées restent attachées jusqu'à la fin de la transaction.
+        schemas = {}
+
+        def schema_of(ts):
+            return self._write_schema(ts, schemas)
+
         try:
-            self._run_query("INSERT INTO mondon_speed VALUES (?, ?)", (time, value))
-        except sqlite3.IntegrityError as e:
-            # IntegrityError veut dire que l'on essaye d'insérer une vitesse avec un timestamp
-            # qui existe déjà dans la base de données.
-            # Dans ce cas, on considère que cette valeur n'a pas besoin d'être insérée et on
-            # ignore l'exception.
-            logger.log("DATABASE", "(Ignorée) IntegrityError: {}".format(e))
-            pass
+            speeds_by_schema = {}
+            for sample in self._buffer:
+                speeds_by_schema.setdefault(schema_of(sample[0]), []).append(sample)
+            tags_by_schema = {}
+            for row in self._tag_buffer:
+                tags_by_schema.setdefault(schema_of(row[2]), []).append(row)
+            # Un timestamp qui existe déjà dans la base de données veut dire que la vitesse a déjà
+            # été insérée. On l'ignore plutôt que de faire échouer tout le lot.
+            statements = []
+            for schema, samples in speeds_by_schema.items():
+                statements.append(("INSERT OR IGNORE INTO {}.mondon_speed VALUES (?, ?)"
+                                   .format(schema), samples, True))
+            for schema, tags in tags_by_schema.items():
+                statements.append(("INSERT OR IGNORE INTO {}.mondon_tag VALUES (?, ?, ?, ?)"
+                                   .format(schema), tags, True))
+            rollup_last = self.rollup.last if self.rollup else None
+            try:
+                if self.rollup:
+                    for time, value in self._samples:
+                        self.rollup.add(time, value)
+                    statements.extend(self.rollup.statements(schema_of))
+                if statements:
+                    self._run_transaction(statements, self.flush_attempts)
+            except Exception:
+                if self.rollup:
+                    self.rollup.discard(rollup_last)
+                raise
+        finally:
+            self._release_all(schemas)
+        if self.rollup:
+            self.rollup.clear()
+        received = self._samples
+        if self.storage_policy and received:
+            self._held_speed = received[-1]
+        self._samples = deque()
+        self._buffer = deque()
+        self._tag_buffer = []
+        self._pending_samples = 0
+        self._buffer_start = None
+        return [(value, time) for time, value in received]
+
+    def _write_pending_policy_rows(self):
+        """
+        Ajoute au buffer les dernières valeurs écartées par `storage_policy`, pour que la dernière
+        marche du signal se termine à la dernière valeur reçue.
+        """
+        if not self.storage_policy:
+            return
+        for key, ts, value in self.storage_policy.pending():
+            self._start_buffering()
+            if key == Database.SPEED_KEY:
+                self._buffer.append((ts, value))
+            else:
+                self._tag_buffer.append(key + (ts, value))
+
+    def _iter_query(self, query, args, chunk_size=None):
+        """
+        Exécute une requête de lecture et retourne ses lignes au fur et à mesure, par paquets de
+        `chunk_size`, pour ne jamais charger tout le résultat en mémoire.
+        :param query: Requête SQL à exécuter
+        :param args: Paramètre de la requête à exécuter
+        :param chunk_size: Nombre de lignes lues à la fois (par défaut `CHUNK_SIZE`)
+        :return: Un générateur de lignes
+        """
+        logger.debug("DATABASE", "Requête: {} - Paramêtres: {}", query, args)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, args)
+            while True:
+                rows = cursor.fetchmany(chunk_size or Database.CHUNK_SIZE)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            try:
+                cursor.close()
+            except sqlite3.ProgrammingError:
+                # La connexion a déjà été fermée (générateur abandonné avant `close`)
+                pass
+
+    def _iter_sources(self, start, end, query, args, chunk_size=None):
+        """
+        Exécute une requête de lecture sur chaque partition de la plage (voir `_source_keys`),
+        dans l'ordre chronologique, et retourne leurs lignes au fur et à mesure.
+        :param start: Millitimestamp de début (inclus) de la plage
+        :param end: Millitimestamp de fin (exclu) de la plage
+        :param query: Requête SQL où "{schema}" est remplacé par le schéma de la partition
+        :param args: Paramètre de la requête à exécuter
+        :param chunk_size: Nombre de lignes lues à la fois (par défaut `CHUNK_SIZE`)
+        :return: Un générateur de lignes
+        """
+        for key in self._source_keys(start, end):
+            schema = self._acquire(key)
+            try:
+                yield from self._iter_query(query.format(schema=schema), args, chunk_size)
+            finally:
+                self._release(schema)
+
+    def _query_sources(self, start, end, query, args, legacy=True):
+        """
+        Exécute une requête (ex: un agrégat) sur chaque partition de la plage.
+        :param query: Requête SQL où "{schema}" est remplacé par le schéma de la partition
+        :param legacy: Inclut la base de données non partitionnée si elle existe
+        :return: La liste des résultats (un par partition), dans l'ordre chronologique
+        """
+        results = []
+        for key in self._source_keys(start, end, legacy):
+            schema = self._acquire(key)
+            try:
+                results.append(self._run_query(query.format(schema=schema), args))
+            finally:
+                self._release(schema)
+        return results
+
+    def iter_speeds(self, start, end, chunk_size=None):
+        """
+        Retourne les vitesses d'une plage de temps, dans l'ordre chronologique.
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :param chunk_size: Nombre de lignes lues à la fois (par défaut `CHUNK_SIZE`)
+        :return: Un générateur de (ts, vitesse)
+        """
+        hot_start = max(start, self.archive.end_ms) if self.archive else start
+        if hot_start > start:
+            yield from self.archive.iter_speeds(start, min(end, hot_start))
+        rows = self._iter_sources(hot_start, end, "SELECT ts, speed FROM {schema}.mondon_speed "
+                                                  "WHERE ts >= ? AND ts < ? ORDER BY ts",
+                                  (hot_start, end), chunk_size)
+        try:
+            yield from rows
+        finally:
+            rows.close()
+
+    def iter_tags(self, tag, start, end, machine=None, chunk_size=None):
+        """
+        Retourne les valeurs d'un tag sur une plage de temps, dans l'ordre chronologique.
+        :param tag: Nom du tag
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :param machine: Nom de la machine (par défaut `DEFAULT_MACHINE`)
+        :param chunk_size: Nombre de lignes lues à la fois (par défaut `CHUNK_SIZE`)
+        :return: Un générateur de (ts, valeur)
+        """
+        return self._iter_sources(start, end, "SELECT ts, value FROM {schema}.mondon_tag "
+                                              "WHERE machine = ? AND tag = ? AND ts >= ? "
+                                              "AND ts < ? ORDER BY ts",
+                                  (machine or Database.DEFAULT_MACHINE, tag, start, end),
+                                  chunk_size)
+
+    def _iter_steps(self, table, columns, where, args, start, end, max_gap_ms, archived=False):
+        """
+        Reconstruit le signal en escalier d'une série (voir `iter_steps`). Les lignes sont lues
+        à partir de la dernière ligne avant `start`, jusqu'à la première ligne après `end`.
+        :param archived: La série est celle des vitesses, lue aussi dans `archive`
+        """
+        if max_gap_ms is None:
+            max_gap_ms = self.storage_policy.heartbeat_ms if self.storage_policy \
+                else RollupAccumulator.MAX_GAP_MS
+        first = None
+        for key in reversed(self._source_keys(0, start + 1)):
+            schema = self._acquire(key)
+            try:
+                first = self._run_query("SELECT max(ts) FROM {}.{} WHERE {} AND ts <= ?"
+                                        .format(schema, table, where), args + (start,))[0][0]
+            finally:
+                self._release(schema)
+            if first is not None:
+                break
+        if first is None and archived and self.archive:
+            row = self.archive.last_at_or_before(start)
+            first = row[0] if row else None
+        first = start if first is None else first
+        if archived:
+            rows = self._with_held_speed(self.iter_speeds(first, 2 ** 62))
+        else:
+            rows = self._iter_sources(first, 2 ** 62, "SELECT {} FROM {{schema}}.{} WHERE {} "
+                                                      "AND ts >= ? ORDER BY ts"
+                                      .format(columns, table, where), args + (first,))
+        try:
+            yield from iter_steps(rows, start, end, max_gap_ms)
+        finally:
+            rows.close()
+
+    def _with_held_speed(self, rows):
+        """
+        Ajoute à la fin des vitesses écrites la dernière vitesse reçue par cette instance si elle
+        n'a pas encore été écrite (voir `storage_policy`) : la dernière marche couvre alors
+        toutes les vitesses comptées dans les agrégats, sans écrire une ligne à chaque flush.
+        :param rows: Générateur de (ts, vitesse) dans l'ordre chronologique
+        :return: Un générateur de (ts, vitesse)
+        """
+        last_ts = None
+        try:
+            for row in rows:
+                last_ts = row[0]
+                yield row
+        finally:
+            rows.close()
+        held = self._held_speed
+        if held is not None and (last_ts is None or held[0] > last_ts):
+            yield held
+
+    def iter_speed_steps(self, start, end, max_gap_ms=None):
+        """
+        Reconstruit le signal de vitesse d'une plage de temps à partir des lignes écrites (avec
+        ou sans `storage_policy`) : chaque vitesse est constante jusqu'à la ligne suivante. La
+        dernière marche va jusqu'à la dernière vitesse reçue par cette instance, même si elle
+        n'est pas encore écrite.
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :param max_gap_ms: Écart entre deux lignes au delà duquel il manque des données (par
+                           défaut le `heartbeat_ms` de `storage_policy`, sinon
+                           `RollupAccumulator.MAX_GAP_MS`)
+        :return: Un générateur de (début, fin, vitesse)
+        """
+        return self._iter_steps("mondon_speed", "ts, speed", "1", (), start, end, max_gap_ms,
+                                archived=True)
+
+    def iter_tag_steps(self, tag, start, end, machine=None, max_gap_ms=None):
+        """
+        Reconstruit le signal d'un tag d'une plage de temps (voir `iter_speed_steps`).
+        :param tag: Nom du tag
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :param machine: Nom de la machine (par défaut `DEFAULT_MACHINE`)
+        :param max_gap_ms: Écart entre deux lignes au delà duquel il manque des données
+        :return: Un générateur de (début, fin, valeur)
+        """
+        return self._iter_steps("mondon_tag", "ts, value", "machine = ? AND tag = ?",
+                                (machine or Database.DEFAULT_MACHINE, tag), start, end,
+                                max_gap_ms)
+
+    def iter_rollups(self, granularity_ms, start, end, chunk_size=None):
+        """
+        Retourne les agrégats d'une plage de temps, dans l'ordre chronologique.
+        :param granularity_ms: Granularité des agrégats (`SECOND_MS`, `MINUTE_MS` ou `HOUR_MS`)
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :param chunk_size: Nombre de lignes lues à la fois (par défaut `CHUNK_SIZE`)
+        :return: Un générateur de (bucket, min, max, moyenne, nombre, temps d'arrêt en ms)
+        """
+        return self._iter_sources(start, end, "SELECT bucket, min_speed, max_speed, "
+                                              "CAST(sum_speed AS REAL) / count, count, stopped_ms "
+                                              "FROM {schema}.mondon_speed_rollup "
+                                              "WHERE granularity = ? AND bucket >= ? "
+                                              "AND bucket < ? ORDER BY bucket",
+                                  (granularity_ms, start, end), chunk_size)
+
+    def get_latest_speed(self):
+        """
+        :return: La dernière vitesse écrite sous la forme (ts, vitesse), ou None si il n'y en
+                 a pas
+        """
+        for key in reversed(self._source_keys(0, 2 ** 62)):
+            schema = self._acquire(key)
+            try:
+                rows = self._run_query("SELECT ts, speed FROM {}.mondon_speed "
+                                       "ORDER BY ts DESC LIMIT 1".format(schema), ())
+            finally:
+                self._release(schema)
+            if rows:
+                return rows[0]
+        return self.archive.last_at_or_before(2 ** 62) if self.archive else None
+
+    def get_speed_stats(self, start, end, use_rollups=None):
+        """
+        Calcule les statistiques des vitesses d'une plage de temps.
+        Avec les agrégats, la plage est découpée en heures, minutes et secondes entières lues
+        dans `mondon_speed_rollup`, et seuls les bords (moins d'une seconde) sont lus dans
+        `mondon_speed` (ou dans `archive` avant `archive.end_ms`). Pour une base de données
+        existante, les agrégats doivent avoir été reconstruits (`backfill_rollups`).
+        Avec `storage_policy`, les lignes des bords ne sont pas toutes les vitesses reçues : les
+        bords sont reconstruits à partir du signal en escalier (voir `_step_stats`).
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :param use_rollups: Utilise les agrégats (par défaut si ils sont maintenus par cette
+                            instance)
+        :return: Dictionnaire avec les clés min, max, avg, count et stopped_ms (le temps d'arrêt
+                 n'est connu que par les agrégats, il vaut 0 sans eux)
+        """
+        if use_rollups is None:
+            use_rollups = self.rollup is not None
+        levels = sorted(GRANULARITIES_MS, reverse=True) if use_rollups else []
+        stats = {'min': None, 'max': None, 'sum': 0, 'count': 0, 'stopped_ms': 0}
+        for granularity_ms, segment_start, segment_end in _split_range(start, end, levels):
+            if granularity_ms is None and use_rollups and self.storage_policy:
+                results = [[self._step_stats(piece_start, piece_end)]
+                           for piece_start, piece_end in _split_seconds(segment_start,
+                                                                        segment_end)]
+            elif granularity_ms is None:
+                if self.archive and segment_start < self.archive.end_ms:
+                    archive_end = min(segment_end, self.archive.end_ms)
+                    _merge_stats(stats, *self.archive.stats(segment_start, archive_end), 0)
+                    segment_start = archive_end
+                results = self._query_sources(segment_start, segment_end,
+                                              "SELECT min(speed), max(speed), total(speed), "
+                                              "count(*), 0 FROM {schema}.mondon_speed "
+                                              "WHERE ts >= ? AND ts < ?",
+                                              (segment_start, segment_end))
+            else:
+                results = self._query_sources(segment_start, segment_end,
+                                              "SELECT min(min_speed), max(max_speed), "
+                                              "total(sum_speed), total(count), total(stopped_ms) "
+                                              "FROM {schema}.mondon_speed_rollup "
+                                              "WHERE granularity = ? AND bucket >= ? "
+                                              "AND bucket < ?",
+                                              (granularity_ms, segment_start, segment_end))
+            for rows in results:
+                _merge_stats(stats, *rows[0])
+        total = stats.pop('sum')
+        stats['count'] = int(stats['count'])
+        stats['stopped_ms'] = int(stats['stopped_ms'])
+        stats['avg'] = total / stats['count'] if stats['count'] else None
+        return stats
+
+    def _step_stats(self, start, end):
+        """
+        Calcule les statistiques d'un bord de plage (à l'intérieur d'une seule seconde) à partir
+        du signal en escalier (voir `iter_speed_steps`), comme si toutes les vitesses reçues
+        avaient été écrites. Le nombre de vitesses est celui de l'agrégat de la seconde, en
+        proportion de la durée du signal qui tombe dans le bord.
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :return: (min, max, somme, nombre, 0) comme une ligne de `mondon_speed_rollup`
+        """
+        bucket = start - start % SECOND_MS
+        bucket_count = 0
+        for rows in self._query_sources(bucket, bucket + SECOND_MS,
+                                        "SELECT total(count) FROM {schema}.mondon_speed_rollup "
+                                        "WHERE granularity = ? AND bucket = ?",
+                                        (SECOND_MS, bucket)):
+            bucket_count += rows[0][0]
+        steps = list(self.iter_speed_steps(bucket, bucket + SECOND_MS))
+        bucket_ms = sum(step_end - step_start for step_start, step_end, _ in steps)
+        overlaps = [(min(step_end, end) - max(step_start, start), speed)
+                    for step_start, step_end, speed in steps
+                    if min(step_end, end) > max(step_start, start)]
+        covered_ms = sum(duration for duration, _ in overlaps)
+        count = round(bucket_count * covered_ms / bucket_ms) if bucket_ms else 0
+        if not count:
+            return None, None, 0, 0, 0
+        mean = sum(duration * speed for duration, speed in overlaps) / covered_ms
+        speeds = [speed for _, speed in overlaps]
+        return min(speeds), max(speeds), mean * count, count, 0
+
+    def backfill_rollups(self, start=None, end=None):
+        """
+        Reconstruit les agrégats de `mondon_speed_rollup` à partir des vitesses déjà présentes
+        dans `mondon_speed` (par exemple pour une base de données existante).
+        Les vitesses sont lues heure par heure pour garder une consommation mémoire constante.
+        À lancer sur une période où l'acquisition n'écrit pas (ou avec l'acquisition arrêtée).
+        En mode partitionné, seules les partitions sont reconstruites (pas la base de données
+        non partitionnée, qui peut l'être en l'ouvrant sans partitionnement).
+        Les vitesses supprimées après archivage (voir `delete_speeds`) ne sont pas relues : les
+        agrégats de leurs jours ne doivent pas être reconstruits.
+        :param start: Millitimestamp de début (arrondi à l'heure), par défaut la première vitesse
+        :param end: Millitimestamp de fin exclue (arrondi à l'heure supérieure), par défaut après
+                    la dernière vitesse
+        :return: Le nombre de vitesses agrégées
+        """
+        self.flush()
+        first, last = None, None
+        for rows in self._query_sources(start or 0, end or 2 ** 62,
+                                        "SELECT min(ts), max(ts) FROM {schema}.mondon_speed "
+                                        "WHERE ts >= ? AND ts < ?",
+                                        (start or 0, end or 2 ** 62), legacy=False):
+            source_first, source_last = rows[0]
+            if source_first is not None:
+                first = source_first if first is None else min(first, source_first)
+                last = source_last if last is None else max(last, source_last)
+        if first is None:
+            return 0
+        start = first if start is None else start
+        end = last + 1 if end is None else end
+        # Les buckets d'une heure sont reconstruits en entier
+        start -= start % HOUR_MS
+        end += -end % HOUR_MS
+        logger.info("DATABASE", "Reconstruction des agrégats de {} à {}", start, end)
+        self._query_sources(start, end, "DELETE FROM {schema}.mondon_speed_rollup "
+                                        "WHERE bucket >= ? AND bucket < ?",
+                            (start, end), legacy=False)
+        accumulator = RollupAccumulator()
+        count = 0
+        for window_start in range(start, end, HOUR_MS):
+            window_end = window_start + HOUR_MS
+            for rows in self._query_sources(window_start, window_end,
+                                            "SELECT ts, speed FROM {schema}.mondon_speed "
+                                            "WHERE ts >= ? AND ts < ? ORDER BY ts",
+                                            (window_start, window_end), legacy=False):
+                for ts, speed in rows:
+                    accumulator.add(ts, speed)
+                count += len(rows)
+            schemas = {}
+            try:
+                statements = accumulator.statements(lambda ts: self._write_schema(ts, schemas))
+                if statements:
+                    self._run_transaction(statements)
+                    accumulator.clear()
+            finally:
+                self._release_all(schemas)
+        return count
+
+    def delete_speeds(self, start, end, chunk_size=None):
+        """
+        Supprime les vitesses d'une plage de temps (par exemple après leur archivage, voir
+        `objct.archive`). Les agrégats de `mondon_speed_rollup` sont gardés. Les partitions
+        fermées seront de nouveau compactées par `PartitionMaintenance` pour libérer la place.
+        Les vitesses sont supprimées par paquets de `chunk_size`, un paquet par transaction,
+        pour que les écritures de l'acquisition n'attendent jamais longtemps.
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :param chunk_size: Nombre maximum de vitesses supprimées par transaction
+                           (par défaut `DELETE_CHUNK_SIZE`)
+        """
+        chunk_size = chunk_size or Database.DELETE_CHUNK_SIZE
+        self.flush()
+        for key in self._source_keys(start, end):
+            schema = self._acquire(key)
+            try:
+                chunk_start = start
+                while chunk_start < end:
+                    # Temps de la première vitesse du paquet suivant
+                    rows = self._run_query("SELECT ts FROM {}.mondon_speed WHERE ts >= ? AND "
+                                           "ts < ? ORDER BY ts LIMIT 1 OFFSET ?".format(schema),
+                                           (chunk_start, end, chunk_size))
+                    chunk_end = rows[0][0] if rows else end
+                    statements = [("DELETE FROM {}.mondon_speed WHERE ts >= ? AND ts < ?"
+                                   .format(schema), (chunk_start, chunk_end), False)]
+                    if schema != 'main' and chunk_end == end:
+                        statements.append(("PRAGMA {}.user_version = 0".format(schema), (),
+                                           False))
+                    self._run_transaction(statements)
+                    chunk_start = chunk_end
+                    if chunk_start < end:
+                        sleep(Database.DELETE_PAUSE_MS / 1000)
+            finally:
+                self._release(schema)
+
+    def close(self):
+        """
+        Écrit les vitesses restantes dans le buffer puis ferme la connexion à la base de données.
+        """
+        try:
+            self._write_pending_policy_rows()
+            self.flush()
+            if self.profile.checkpoint_on_close and not self.read_only:
+                self.checkpoint(self.profile.checkpoint_on_close)
+        finally:
+            self.conn.close()
+
+
+def _read_only_uri(path):
+    """
+    :return: L'URI SQLite qui ouvre le fichier `path` en lecture seule
+    """
+    return 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(path)))
+
+
+def _split_range(start, end, levels):
+    """
+    Découpe une plage de temps en segments alignés sur les granularités des agrégats.
+    :param start: Millitimestamp de début (inclus)
+    :param end: Millitimestamp de fin (exclu)
+    :param levels: Granularités disponibles, de la plus grande à la plus petite
+    :return: Liste de (granularité ou None pour les vitesses brutes, début, fin)
+    """
+    if start >= end:
+        return []
+    if not levels:
+        return [(None, start, end)]
+    granularity_ms = levels[0]
+    aligned_start = start + (-start % granularity_ms)
+    aligned_end = end - end % granularity_ms
+    if aligned_start >= aligned_end:
+        return _split_range(start, end, levels[1:])
+    return _split_range(start, aligned_start, levels[1:]) + \
+        [(granularity_ms, aligned_start, aligned_end)] + \
+        _split_range(aligned_end, end, levels[1:])
+
+
+def _split_seconds(start, end):
+    """
+    Découpe une plage de temps aux changements de seconde.
+    :return: Liste de (début, fin)
+    """
+    pieces = []
+    while start < end:
+        piece_end = min(end, start - start % SECOND_MS + SECOND_MS)
+        pieces.append((start, piece_end))
+        start = piece_end
+    return pieces
+
+
+def _merge_stats(stats, min_speed, max_speed, total, count, stopped_ms):
+    """
+    Ajoute les statistiques d'un segment à celles de toute la plage.
+    """
+    if min_speed is not None and (stats['min'] is None or min_speed < stats['min']):
+        stats['min'] = min_speed
+    if max_speed is not None and (stats['max'] is None or max_speed > stats['max']):
+        stats['max'] = max_speed
+    stats['sum'] += total
+    stats['count'] += count
+    stats['stopped_ms'] += stopped_ms
@@ -0,0 +1,566 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+import select
+import struct
+from time import perf_counter, time
+
+from objct.logger import logger
+from objct.metrics import metrics
+
+
+# En-tête FINS/TCP : "FINS", longueur (octets qui suivent le champ longueur), commande, code
+# d'erreur. Tous les entiers sont en big endian.
+TCP_HEADER = struct.Struct('>4sIII')
+TCP_MAGIC = b'FINS'
+TCP_COMMAND_NODE_ADDRESS_REQUEST = 0  # Client -> automate : demande d'adresse de nœud
+TCP_COMMAND_NODE_ADDRESS_RESPONSE = 1  # Automate -> client : adresses de nœud attribuées
+TCP_COMMAND_FRAME_SEND = 2  # Trame FINS dans les deux sens
+TCP_ERRORS = {
+    0x01: "L'en-tête n'est pas 'FINS'",
+    0x02: "Trame trop longue",
+    0x03: "Commande non supportée",
+    0x20: "Toutes les connexions sont utilisées",
+    0x21: "Le nœud est déjà connecté",
+    0x22: "Tentative d'accès à un nœud protégé depuis une adresse IP non autorisée",
+    0x23: "Le nœud client est hors limites",
+    0x24: "Le nœud client est déjà utilisé",
+    0x25: "Tous les nœuds sont utilisés",
+}
+NODE_ADDRESS = struct.Struct('>II')  # Nœud client, nœud automate
+
+# En-tête FINS (ICF, RSV, GCT, DNA, DA1, DA2, SNA, SA1, SA2, SID) suivi du code commande
+# (MRC, SRC) et, dans les réponses, du code de fin sur 2 octets.
+FINS_HEADER = struct.Struct('>10B2B')
+FINS_RESPONSE_HEADER = struct.Struct('>10B2BH')
+SID_OFFSET = 9  # Position du SID dans l'en-tête FINS
+MAX_SID = 0xFF
+ICF_RESPONSE = 0x40  # Bit de l'ICF qui indique une réponse
+END_CODE_RELAY_ERROR = 0x8000  # Erreur lors du relais entre réseaux
+END_CODE_FATAL_ERROR = 0x0080  # L'automate a une erreur fatale
+END_CODE_NON_FATAL_ERROR = 0x0040  # L'automate a une erreur non fatale
+END_CODE_MASK = 0x7F3F  # Masque pour extraire MRES/SRES sans les bits d'état ci-dessus
+
+REQUEST_DURATION = metrics.histogram('fins_request_duration_ms',
+                                     "Temps aller-retour d'une commande FINS (envoi et réponse)")
+REQUEST_ERRORS = metrics.counter('fins_request_errors_total',
+                                 "Nombre de commandes FINS en erreur (socket, timeout, réponse)")
+LATE_RESPONSES = metrics.counter('fins_late_responses_total',
+                                 "Nombre de réponses FINS ignorées car leur requête n'est plus "
+                                 "attendue")
+
+
+class FinsError(Exception):
+    """
+    Erreur dans un échange FINS avec l'automate (trame invalide, code d'erreur, réponse qui ne
+    correspond pas à la requête, ...).
+    """
+    pass
+
+
+class FinsResponse:
+    """
+    Réponse FINS décodée sans copie.
+    Attention : `payload` est une vue sur le buffer de réception de `FinsTcpTransport`, elle
+    n'est valide que jusqu'à la prochaine lecture.
+    """
+    __slots__ = ('sid', 'mrc', 'src', 'end_code', 'payload')
+
+    def __init__(self, sid, mrc, src, end_code, payload):
+        """
+        Crée une nouvelle instance de `FinsResponse`
+        :param sid: Numéro de service (identifiant de la requête)
+        :param mrc: Code commande principal
+        :param src: Code commande secondaire
+        :param end_code: Code de fin retourné par l'automate
+        :param payload: memoryview sur les données de la réponse
+        """
+        self.sid = sid
+        self.mrc = mrc
+        self.src = src
+        self.end_code = end_code
+        self.payload = payload
+
+
+def parse_request_header(frame):
+    """
+    Extrait l'identifiant d'une trame de commande FINS/TCP.
+    :param frame: Trame complète (en-tête FINS/TCP inclus)
+    :return: (sid, mrc, src)
+    """
+    fields = FINS_HEADER.unpack_from(frame, TCP_HEADER.size)
+    return fields[9], fields[10], fields[11]
+
+
+def parse_tcp_header(header, max_frame_size):
+    """
+    Décode un en-tête FINS/TCP.
+    :param header: Les `TCP_HEADER.size` premiers octets de la trame
+    :param max_frame_size: Taille maximum acceptée pour la trame complète
+    :return: (commande FINS/TCP, code d'erreur, taille du corps qui suit l'en-tête)
+    """
+    magic, length, command, error_code = TCP_HEADER.unpack_from(header)
+    if magic != TCP_MAGIC:
+        raise FinsError("En-tête FINS/TCP invalide: {}".format(bytes(magic)))
+    # La longueur compte la commande et le code d'erreur (8 octets) en plus du corps
+    body_size = length - 8
+    if body_size < 0 or TCP_HEADER.size + body_size > max_frame_size:
+        raise FinsError("Longueur de trame FINS/TCP invalide: {}".format(length))
+    return command, error_code, body_size
+
+
+def check_tcp_error(error_code):
+    """
+    Génère une erreur si le code d'erreur d'une trame FINS/TCP n'est pas nul.
+    :param error_code: Code d'erreur de l'en-tête FINS/TCP
+    """
+    if error_code:
+        raise FinsError("Erreur FINS/TCP {:08X}: {}"
+                        .format(error_code, TCP_ERRORS.get(error_code, "Erreur inconnue")))
+
+
+def parse_node_address(tcp_command, body):
+    """
+    Décode la réponse de l'automate à la demande d'adresse de nœud.
+    :param tcp_command: Commande FINS/TCP de la trame reçue
+    :param body: Corps de la trame reçue
+    :return: (nœud client, nœud automate)
+    """
+    if tcp_command != TCP_COMMAND_NODE_ADDRESS_RESPONSE or len(body) < NODE_ADDRESS.size:
+        raise FinsError("Réponse invalide après tentative de connexion à l'automate "
+                        "(commande {}, {} octets)".format(tcp_command, len(body)))
+    client_node, server_node = NODE_ADDRESS.unpack_from(body)
+    logger.info("FINS", "Connecté à l'automate (nœud client {}, nœud automate {})",
+                client_node, server_node)
+    return client_node, server_node
+
+
+def parse_response(body, expected=None):
+    """
+    Décode une réponse FINS et vérifie son code de fin.
+    :param body: Octets de la trame FINS (sans l'en-tête FINS/TCP)
+    :param expected: (sid, mrc, src) de la requête à laquelle la réponse doit correspondre
+    :return: La `FinsResponse` décodée
+    """
+    if len(body) < FINS_RESPONSE_HEADER.size:
+        raise FinsError("Réponse FINS trop courte ({} octets)".format(len(body)))
+    fields = FINS_RESPONSE_HEADER.unpack_from(body)
+    icf, sid, mrc, src, end_code = fields[0], fields[9], fields[10], fields[11], fields[12]
+    if not icf & ICF_RESPONSE:
+        raise FinsError("La trame reçue n'est pas une réponse (ICF={:02X})".format(icf))
+    if expected is not None and (sid, mrc, src) != expected:
+        raise FinsError("Réponse inattendue (SID={:02X}, commande={:02X}{:02X}), attendu "
+                        "SID={:02X}, commande={:02X}{:02X}"
+                        .format(sid, mrc, src, *expected))
+    if end_code & END_CODE_MASK:
+        raise FinsError("Code de fin FINS {:04X}".format(end_code))
+    if end_code & (END_CODE_RELAY_ERROR | END_CODE_FATAL_ERROR | END_CODE_NON_FATAL_ERROR):
+        logger.warning("FINS", "Réponse valide avec un code de fin signalant une erreur de "
+                               "l'automate: {:04X}", end_code)
+    return FinsResponse(sid, mrc, src, end_code,
+                        memoryview(body)[FINS_RESPONSE_HEADER.size:])
+
+
+class FinsTcpTransport:
+    """
+    Couche de transport FINS/TCP au-dessus d'une socket connectée à l'automate.
+    Lit exactement une trame à la fois en se basant sur le champ longueur de l'en-tête (TCP peut
+    couper ou regrouper les trames), dans un buffer alloué une seule fois.
+    """
+    MAX_FRAME_SIZE = 2048  # Taille maximum d'une trame (en-tête FINS/TCP inclus)
+    FINS_OFFSET = TCP_HEADER.size  # Position de l'en-tête FINS dans les trames envoyées
+
+    def __init__(self, sock, max_frame_size=None):
+        """
+        Crée une nouvelle instance de `FinsTcpTransport`
+        :param sock: Socket connectée à l'automate
+        :param max_frame_size: Taille du buffer de réception (par défaut `MAX_FRAME_SIZE`)
+        """
+        self.socket = sock
+        self._buffer = bytearray(max_frame_size or FinsTcpTransport.MAX_FRAME_SIZE)
+        self._view = memoryview(self._buffer)
+        self.client_node = None  # Adresse de nœud attribuée par l'automate lors du handshake
+        self.server_node = None  # Adresse de nœud de l'automate
+
+    def _recv_exact(self, offset, size):
+        """
+        Remplit le buffer de réception de `offset` à `offset + size`.
+        :param offset: Position dans le buffer
+        :param size: Nombre d'octets à lire
+        """
+        end = offset + size
+        while offset < end:
+            received = self.socket.recv_into(self._view[offset:end])
+            if not received:
+                raise ConnectionError("Connexion fermée par l'automate")
+            offset += received
+
+    def read_frame(self):
+        """
+        Lit une trame FINS/TCP complète.
+        :return: (commande FINS/TCP, memoryview sur le corps de la trame)
+        """
+        self._recv_exact(0, TCP_HEADER.size)
+        command, error_code, body_size = parse_tcp_header(self._buffer, len(self._buffer))
+        frame_size = TCP_HEADER.size + body_size
+        self._recv_exact(TCP_HEADER.size, body_size)
+        if logger.is_enabled(logger.DEBUG, "FINS"):
+            logger.debug("FINS", "Reçu de l'automate: {}", bytes(self._view[:frame_size]).hex())
+        check_tcp_error(error_code)
+        return command, self._view[TCP_HEADER.size:frame_size]
+
+    def read_response(self):
+        """
+        Lit une trame FINS/TCP qui contient une trame FINS.
+        :return: memoryview sur la trame FINS (valide jusqu'à la prochaine lecture)
+        """
+        tcp_command, body = self.read_frame()
+        if tcp_command != TCP_COMMAND_FRAME_SEND:
+            raise FinsError("Commande FINS/TCP inattendue: {}".format(tcp_command))
+        return body
+
+    @staticmethod
+    def frame(command):
+        """
+        :return: La trame envoyée pour `command` (avec l'en-tête FINS/TCP)
+        """
+        return command.binary
+
+    def send_frame(self, frame):
+        """
+        Envoi une trame déjà construite (voir `frame`).
+        """
+        self.socket.sendall(frame)
+
+    def send(self, command):
+        """
+        Envoi une commande à l'automate
+        :param command: `AutomateCommand` à envoyer
+        """
+        logger.debug("FINS", 'Envoi de la commande {} ({})', command.description, command.hex)
+        self.socket.sendall(command.binary)
+
+    def handshake(self, command):
+        """
+        Envoi la demande d'adresse de nœud et lit la réponse de l'automate.
+        :param command: Commande de connexion (`CONNECT`)
+        :return: (nœud client, nœud automate)
+        """
+        self.send(command)
+        self.client_node, self.server_node = parse_node_address(*self.read_frame())
+        return self.client_node, self.server_node
+
+    def request(self, command):
+        """
+        Envoi une commande FINS et lit la réponse correspondante.
+        :param command: `AutomateCommand` à envoyer
+        :return: La `FinsResponse` (valide jusqu'à la prochaine lecture)
+        """
+        expected = parse_request_header(command.binary)
+        start = perf_counter()
+        try:
+            self.send(command)
+            response = parse_response(self.read_response(), expected)
+        except Exception:
+            REQUEST_ERRORS.inc()
+            raise
+        REQUEST_DURATION.observe((perf_counter() - start) * 1000)
+        return response
+
+
+class FinsUdpTransport:
+    """
+    Couche de transport FINS/UDP au-dessus d'une socket UDP connectée à l'automate (`connect`
+    filtre les datagrammes qui ne viennent pas de l'automate).
+    Chaque datagramme contient une trame FINS, sans en-tête FINS/TCP ni demande d'adresse de
+    nœud : les nœuds des commandes (`da1`, `sa1` de `AutomateCommand.from_fins`, voir
+    `SpeedAcquisition.UDP_DA1`) doivent correspondre à la configuration de l'automate. Un
+    datagramme perdu n'est pas renvoyé, la requête se termine par un timeout de la socket.
+    """
+    MAX_FRAME_SIZE = FinsTcpTransport.MAX_FRAME_SIZE
+    FINS_OFFSET = 0  # Position de l'en-tête FINS dans les trames envoyées
+
+    def __init__(self, sock, max_frame_size=None):
+        """
+        Crée une nouvelle instance de `FinsUdpTransport`
+        :param sock: Socket UDP connectée à l'automate
+        :param max_frame_size: Taille du buffer de réception (par défaut `MAX_FRAME_SIZE`)
+        """
+        self.socket = sock
+        self._buffer = bytearray(max_frame_size or FinsUdpTransport.MAX_FRAME_SIZE)
+        self._view = memoryview(self._buffer)
+
+    def read_response(self):
+        """
+        Lit un datagramme.
+        :return: memoryview sur la trame FINS (valide jusqu'à la prochaine lecture)
+        """
+        size = self.socket.recv_into(self._buffer)
+        if logger.is_enabled(logger.DEBUG, "FINS"):
+            logger.debug("FINS", "Reçu de l'automate: {}", bytes(self._view[:size]).hex())
+        return self._view[:size]
+
+    @staticmethod
+    def frame(command):
+        """
+        :return: La trame envoyée pour `command` (sans l'en-tête FINS/TCP)
+        """
+        return command.fins
+
+    def send_frame(self, frame):
+        """
+        Envoi une trame déjà construite (voir `frame`).
+        """
+        self.socket.send(frame)
+
+    def send(self, command):
+        """
+        Envoi une commande à l'automate
+        :param command: `AutomateCommand` à envoyer
+        """
+        logger.debug("FINS", 'Envoi de la commande {} ({})', command.description, command.hex)
+        self.socket.send(command.fins)
+
+    def request(self, command):
+        """
+        Envoi une commande FINS et lit la réponse correspondante. Les réponses en retard à une
+        requête précédente (même SID mais déjà abandonnée, ou autre SID) sont ignorées.
+        :param command: `AutomateCommand` à envoyer
+        :return: La `FinsResponse` (valide jusqu'à la prochaine lecture)
+        """
+        expected = parse_request_header(command.binary)
+        start = perf_counter()
+        try:
+            self.send(command)
+            while True:
+                response = parse_response(self.read_response())
+                if (response.sid, response.mrc, response.src) == expected:
+                    break
+                LATE_RESPONSES.inc()
+                logger.warning("FINS", "Réponse ignorée (SID={:02X}), attendu SID={:02X}",
+                               response.sid, expected[0])
+        except Exception:
+            REQUEST_ERRORS.inc()
+            raise
+        REQUEST_DURATION.observe((perf_counter() - start) * 1000)
+        return response
+
+
+class FinsPipeline:
+    """
+    Plusieurs requêtes FINS en cours en même temps sur un `FinsTcpTransport` ou un
+    `FinsUdpTransport` : chaque requête envoyée reçoit un numéro de service (SID) libre, et
+    chaque réponse est associée à sa requête par ce numéro. L'intervalle entre deux requêtes
+    n'est donc plus limité par le temps aller-retour avec l'automate.
+    Une réponse dont le SID n'est pas attendu (requête abandonnée) est ignorée, une requête
+    sans réponse (datagramme FINS/UDP perdu) est abandonnée par `expire`.
+    """
+    def __init__(self, transport, window):
+        """
+        Crée une nouvelle instance de `FinsPipeline`
+        :param transport: Transport connecté à l'automate
+        :param window: Nombre maximum de requêtes en cours (au plus `MAX_SID`)
+        """
+        if not 0 < window <= MAX_SID:
+            raise ValueError("Nombre de requêtes en cours invalide: {}".format(window))
+        self.transport = transport
+        self.window = window
+        self._next_sid = 1
+        # SID -> (mrc, src, perf_counter de l'envoi, millitimestamp de l'envoi, contexte), de la
+        # plus ancienne à la plus récente
+        self._pending = OrderedDict()
+        self._frames = {}  # `AutomateCommand` -> (copie modifiable de sa trame, mrc, src)
+        self._last_response = perf_counter()  # Réception de la dernière réponse (ou création)
+
+    @property
+    def in_flight(self):
+        """
+        :return: Le nombre de requêtes en attente de réponse
+        """
+        return len(self._pending)
+
+    def oldest_age_ms(self):
+        """
+        :return: Le temps depuis l'envoi de la plus ancienne requête en cours (0 si aucune)
+        """
+        if not self._pending:
+            return 0
+        return (perf_counter() - next(iter(self._pending.values()))[2]) * 1000
+
+    def _allocate_sid(self):
+        """
+        :return: Le prochain SID qui n'est pas utilisé par une requête en cours
+        """
+        while True:
+            sid = self._next_sid
+            self._next_sid = sid % MAX_SID + 1
+            if sid not in self._pending:
+                return sid
+
+    def submit(self, command, context=None):
+        """
+        Envoi une commande sans attendre sa réponse.
+        :param command: `AutomateCommand` à envoyer (son SID est remplacé)
+        :param context: Valeur retournée avec la réponse par `receive`
+        :return: Le SID de la requête
+        """
+        if len(self._pending) >= self.window:
+            raise FinsError("{} requêtes déjà en cours".format(len(self._pending)))
+        cached = self._frames.get(command)
+        if cached is None:
+            frame = bytearray(self.transport.frame(command))
+            fields = FINS_HEADER.unpack_from(frame, self.transport.FINS_OFFSET)
+            cached = self._frames[command] = (frame, fields[10], fields[11])
+        frame, mrc, src = cached
+        sid = self._allocate_sid()
+        frame[self.transport.FINS_OFFSET + SID_OFFSET] = sid
+        if logger.is_enabled(logger.DEBUG, "FINS"):
+            logger.debug("FINS", "Envoi de la commande {} (SID={:02X}, {} en cours)",
+                         command.description, sid, len(self._pending))
+        try:
+            self.transport.send_frame(frame)
+        except Exception:
+            REQUEST_ERRORS.inc()
+            raise
+        self._pending[sid] = (mrc, src, perf_counter(), time() * 1000, context)
+        return sid
+
+    def receive(self, timeout):
+        """
+        Attend la prochaine réponse à une requête en cours.
+        :param timeout: Temps d'attente maximum en secondes
+        :return: (contexte, `FinsResponse`, millitimestamp de l'envoi, temps aller-retour en
+                 ms) de la requête, ou None si aucune réponse n'est arrivée à temps. La
+                 `FinsResponse` n'est valide que jusqu'à la prochaine lecture.
+        """
+        deadline = perf_counter() + timeout
+        try:
+            while True:
+                remaining = max(0, deadline - perf_counter())
+                readable, _, _ = select.select([self.transport.socket], [], [], remaining)
+                if not readable:
+                    return None
+                response = parse_response(self.transport.read_response())
+                request = self._pending.get(response.sid)
+                if request is None:
+                    LATE_RESPONSES.inc()
+                    logger.warning("FINS", "Réponse ignorée (SID={:02X}): aucune requête en "
+                                           "cours avec ce numéro", response.sid)
+                    continue
+                if (response.mrc, response.src) != request[:2]:
+                    raise FinsError("Réponse inattendue (SID={:02X}, commande={:02X}{:02X}), "
+                                    "attendu commande={:02X}{:02X}"
+                                    .format(response.sid, response.mrc, response.src,
+                                            *request[:2]))
+                del self._pending[response.sid]
+                self._last_response = perf_counter()
+                rtt_ms = (perf_counter() - request[2]) * 1000
+                REQUEST_DURATION.observe(rtt_ms)
+                return request[4], response, request[3], rtt_ms
+        except Exception:
+            REQUEST_ERRORS.inc()
+            raise
+
+    def expire(self, timeout_ms):
+        """
+        Abandonne les requêtes qui attendent leur réponse depuis plus de `timeout_ms`. Génère
+        une erreur si l'automate n'a répondu à aucune requête pendant `timeout_ms`.
+        :return: Le nombre de requêtes abandonnées
+        """
+        now = perf_counter()
+        expired = []
+        for sid, request in self._pending.items():
+            if (now - request[2]) * 1000 <= timeout_ms:
+                break
+            expired.append(sid)
+        if not expired:
+            return 0
+        for sid in expired:
+            del self._pending[sid]
+        REQUEST_ERRORS.inc(len(expired))
+        logger.warning("FINS", "{} requête(s) sans réponse abandonnée(s) (SID={})", len(expired),
+                       ','.join('{:02X}'.format(sid) for sid in expired))
+        silence_ms = (now - self._last_response) * 1000
+        if silence_ms > timeout_ms:
+            raise FinsError("Pas de réponse de l'automate depuis {:.0f} ms".format(silence_ms))
+        return len(expired)
+
+
+class FinsAsyncTransport:
+    """
+    Équivalent de `FinsTcpTransport` pour asyncio, au-dessus d'un couple
+    (`asyncio.StreamReader`, `asyncio.StreamWriter`). Utilisé pour interroger plusieurs
+    automates depuis une seule boucle d'évènements.
+    """
+    MAX_FRAME_SIZE = FinsTcpTransport.MAX_FRAME_SIZE
+
+    def __init__(self, reader, writer):
+        """
+        Crée une nouvelle instance de `FinsAsyncTransport`
+        :param reader: Flux de lecture connecté à l'automate
+        :param writer: Flux d'écriture connecté à l'automate
+        """
+        self.reader = reader
+        self.writer = writer
+        self.client_node = None
+        self.server_node = None
+
+    async def read_frame(self):
+        """
+        Lit une trame FINS/TCP complète.
+        :return: (commande FINS/TCP, corps de la trame)
+        """
+        header = await self.reader.readexactly(TCP_HEADER.size)
+        command, error_code, body_size = parse_tcp_header(header,
+                                                          FinsAsyncTransport.MAX_FRAME_SIZE)
+        body = await self.reader.readexactly(body_size)
+        if logger.is_enabled(logger.DEBUG, "FINS"):
+            logger.debug("FINS", "Reçu de l'automate: {}", (header + body).hex())
+        check_tcp_error(error_code)
+        return command, body
+
+    async def send(self, command):
+        """
+        Envoi une commande à l'automate
+        :param command: `AutomateCommand` à envoyer
+        """
+        logger.debug("FINS", 'Envoi de la commande {} ({})', command.description, command.hex)
+        self.writer.write(command.binary)
+        await self.writer.drain()
+
+    async def handshake(self, command):
+        """
+        Envoi la demande d'adresse de nœud et lit la réponse de l'automate.
+        :param command: Commande de connexion (`CONNECT`)
+        :return: (nœud client, nœud automate)
+        """
+        await self.send(command)
+        self.client_node, self.server_node = parse_node_address(*await self.read_frame())
+        return self.client_node, self.server_node
+
+    async def request(self, command):
+        """
+        Envoi une commande FINS et lit la réponse correspondante.
+        :param command: `AutomateCommand` à envoyer
+        :return: La `FinsResponse`
+        """
+        expected = parse_request_header(command.binary)
+        start = perf_counter()
+        try:
+            await self.send(command)
+            tcp_command, body = await self.read_frame()
+            if tcp_command != TCP_COMMAND_FRAME_SEND:
+                raise FinsError("Commande FINS/TCP inattendue: {}".format(tcp_command))
+            response = parse_response(body, expected)
+        except Exception:
+            REQUEST_ERRORS.inc()
+            raise
+        REQUEST_DURATION.observe((perf_counter() - start) * 1000)
+        return response
+
+    def close(self):
+        """
+        Ferme la connexion à l'automate.
+        """
+        self.writer.close()
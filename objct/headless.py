@@ -0,0 +1,36 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import signal
+import threading
+
+from objct.logger import logger
+
+
+def run_headless(service, should_stop=None):
+    """
+    Exécute l'acquisition sans interface graphique (et sans importer PyQt) jusqu'à ce que le
+    programme reçoive SIGINT (Ctrl+C) ou SIGTERM, ou que `should_stop` retourne vrai.
+    :param service: Objet avec des méthodes `start` et `stop`, par exemple une `SpeedAcquisition`
+                    ou un `AcquisitionEngine`
+    :param should_stop: Fonction appelée chaque seconde, l'acquisition s'arrête quand elle
+                        retourne vrai (ex: `SharedChannel.stop_requested`)
+    """
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info("INITIALISATION", "Signal {} reçu, arrêt de l'acquisition", signum)
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    service.start()
+    try:
+        # Attente par petits intervalles pour que les signaux soient traités (notamment sous
+        # Windows, où une attente sans délai n'est pas interrompue par Ctrl+C)
+        while not stop_event.wait(1):
+            if should_stop and should_stop():
+                logger.info("INITIALISATION", "Arrêt de l'acquisition demandé")
+                break
+    finally:
+        service.stop()
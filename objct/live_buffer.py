@@ -0,0 +1,227 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from objct.logger import logger
+
+
+class SampleRing:
+    """
+    Buffer circulaire des dernières vitesses lues, en mémoire (deux `array` de taille fixe) :
+    les lectures de la vitesse courante ou des dernières heures ne touchent pas la base de
+    données. Les vitesses sont gardées dans l'ordre chronologique (une vitesse plus ancienne que
+    la dernière ajoutée est ignorée), ce qui permet de chercher une plage par dichotomie.
+    """
+    HOURS = 4  # Durée gardée par défaut
+
+    def __init__(self, capacity):
+        """
+        Crée une nouvelle instance de `SampleRing`
+        :param capacity: Nombre maximum de vitesses gardées (les plus anciennes sont écrasées)
+        """
+        if capacity <= 0:
+            raise ValueError("Capacité invalide: {}".format(capacity))
+        self.capacity = capacity
+        self._times = array('q', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._next = 0  # Position de la prochaine écriture
+        self._count = 0  # Nombre de vitesses gardées
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_duration(cls, hours, period_ms):
+        """
+        :param hours: Durée à garder en heures
+        :param period_ms: Temps entre deux vitesses
+        :return: Un `SampleRing` assez grand pour `hours` heures de vitesses
+        """
+        return cls(int(hours * 3600 * 1000 // period_ms))
+
+    def __len__(self):
+        return self._count
+
+    def append(self, ts, value):
+        """
+        Ajoute une vitesse.
+        :param ts: Millitimestamp de la vitesse
+        :param value: Valeur de la vitesse
+        """
+        with self._lock:
+            if self._count and ts <= self._times[self._next - 1]:
+                return
+            self._times[self._next] = ts
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            if self._count < self.capacity:
+                self._count += 1
+
+    def _position(self, index):
+        """
+        :return: La position dans les `array` de la `index`ième vitesse gardée (0 la plus
+                 ancienne). Le verrou doit être pris.
+        """
+        return (self._next - self._count + index) % self.capacity
+
+    def _first_index(self, ts):
+        """
+        :return: L'index de la première vitesse gardée à `ts` ou après. Le verrou doit être pris.
+        """
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._times[self._position(middle)] < ts:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def latest(self):
+        """
+        :return: (temps, vitesse) de la dernière vitesse, ou None si le buffer est vide
+        """
+        with self._lock:
+            if not self._count:
+                return None
+            position = self._next - 1
+            return self._times[position], self._values[position]
+
+    def window(self, start, end):
+        """
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :return: La liste des (temps, vitesse) de la plage, dans l'ordre chronologique
+        """
+        with self._lock:
+            samples = []
+            for index in range(self._first_index(start), self._count):
+                position = self._position(index)
+                ts = self._times[position]
+                if ts >= end:
+                    break
+                samples.append((ts, self._values[position]))
+            return samples
+
+    def stats(self, start, end):
+        """
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :return: Dictionnaire avec le nombre de vitesses, le min, le max et la moyenne de la
+                 plage (None si la plage est vide), et le temps de la première et de la dernière
+                 vitesse
+        """
+        samples = self.window(start, end)
+        if not samples:
+            return {'count': 0, 'min': None, 'max': None, 'mean': None, 'first': None,
+                    'last': None}
+        values = [value for _, value in samples]
+        return {'count': len(values), 'min': min(values), 'max': max(values),
+                'mean': sum(values) / len(values), 'first': samples[0][0],
+                'last': samples[-1][0]}
+
+
+class LiveServer:
+    """
+    Serveur HTTP local qui répond en JSON à partir d'un `SampleRing`, sans toucher à la base de
+    données :
+    - /latest : dernière vitesse {"ts": ..., "value": ...}
+    - /window?start=...&end=... ou /window?last_ms=... : {"start", "end", "samples": [[ts, v]]}
+    - /stats?start=...&end=... ou /stats?last_ms=... : nombre, min, max et moyenne
+    Les temps sont des millitimestamps. Sans paramètre, la plage est tout le buffer.
+    """
+    HOST = '127.0.0.1'  # Adresse d'écoute (0.0.0.0 pour les tableaux de bord du réseau)
+
+    def __init__(self, ring, port, host=None):
+        """
+        Crée une nouvelle instance de `LiveServer`
+        :param ring: `SampleRing` à exposer
+        :param port: Port HTTP (0 pour un port libre)
+        :param host: Adresse d'écoute (par défaut `HOST`)
+        """
+        self.ring = ring
+        self.port = port
+        self.host = host or LiveServer.HOST
+        self.httpd = None
+
+    @staticmethod
+    def _range(query):
+        """
+        :param query: Paramètres de la requête (résultat de `parse_qs`)
+        :return: (début, fin) de la plage demandée
+        """
+        def get(name):
+            values = query.get(name)
+            return int(values[0]) if values else None
+
+        last_ms = get('last_ms')
+        if last_ms is not None:
+            end = int(time.time() * 1000) + 1
+            return end - last_ms, end
+        start, end = get('start'), get('end')
+        return (0 if start is None else start), (2 ** 63 - 1 if end is None else end)
+
+    def _handler(self):
+        """
+        :return: La classe qui répond aux requêtes HTTP
+        """
+        ring = self.ring
+        live_range = LiveServer._range
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send_json(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                try:
+                    start, end = live_range(parse_qs(url.query))
+                except ValueError:
+                    self._send_json(400, {'error': "Paramètre invalide: {}".format(url.query)})
+                    return
+                if url.path == '/latest':
+                    latest = ring.latest()
+                    self._send_json(200, {'ts': latest[0], 'value': latest[1]} if latest
+                                    else {'ts': None, 'value': None})
+                elif url.path == '/window':
+                    self._send_json(200, {'start': start, 'end': end,
+                                          'samples': ring.window(start, end)})
+                elif url.path == '/stats':
+                    self._send_json(200, dict(ring.stats(start, end), start=start, end=end))
+                else:
+                    self._send_json(404, {'error': "Chemin inconnu: {}".format(url.path)})
+
+            def log_message(self, format, *args):
+                logger.debug("LIVE", "{} - {}", self.address_string(), format % args)
+
+        return Handler
+
+    def start(self):
+        """
+        Démarre le serveur HTTP dans un thread en tâche de fond.
+        """
+        self.httpd = ThreadingHTTPServer((self.host, self.port), self._handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_port
+        logger.info("LIVE", "Vitesses récentes disponibles sur http://{}:{}/latest",
+                    self.host, self.port)
+        threading.Thread(target=self.httpd.serve_forever, name="LiveServer", daemon=True).start()
+
+    def stop(self):
+        """
+        Arrête le serveur HTTP.
+        """
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
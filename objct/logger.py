@@ -1,19 +1,57 @@
+import atexit
 import os
+import queue
+import threading
 from datetime import datetime
 
 
 class Logger:
     """
-    S'occupe de créer et maintenir des fichiers de logs
+    S'occupe de créer et maintenir des fichiers de logs.
+    Les lignes de log sont mises dans une queue et écrites par un thread dédié, pour qu'un disque
+    lent ne retarde jamais l'appelant (récupération de la vitesse, insertion dans la base, ...).
     """
-    def __init__(self, log_directory_location):
+    QUEUE_SIZE = 10000  # Nombre maximum de lignes en attente d'écriture. Au delà, les nouvelles
+                        # lignes sont abandonnées (et comptées dans `dropped_count`).
+    BATCH_SIZE = 500  # Nombre maximum de lignes écrites dans le fichier avant un flush
+    CLOSE_TIMEOUT_S = 2  # Temps maximum d'attente du thread d'écriture à la fermeture
+
+    # Niveaux de log. Un message n'est formaté et écrit que si son niveau est supérieur ou égal
+    # au niveau configuré pour sa catégorie.
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+    # Types d'arguments qui ne peuvent pas changer après l'appel : ils sont formatés plus tard
+    # par le thread d'écriture. Les autres (dict, list, objets, ...) sont convertis en texte au
+    # moment de l'appel.
+    IMMUTABLE_ARG_TYPES = (str, int, float, bool, bytes, type(None))
+
+    def __init__(self, log_directory_location, queue_size=None, deferred_writer=False):
         """
         Crée une nouvelle instance de `Logger`
         :param log_directory_location: Chemin du dossier ou les fichiers de log seront stockés.
                                        Si le dossier n'existe pas, il sera automatiquement créé
+        :param queue_size: Nombre maximum de lignes en attente d'écriture
+                           (par défaut `QUEUE_SIZE`)
+        :param deferred_writer: Si True, le thread d'écriture n'est démarré qu'au premier
+                                `flush` ou `close` : les lignes loggées avant restent dans la
+                                queue (ex: pour vérifier ce qui est mis en queue)
         """
         self.log_directory_location = log_directory_location
         self._create_log_directory_if_not_exists()
+        self.level = Logger.INFO  # Niveau par défaut des catégories non configurées
+        self._category_levels = {}  # Niveau configuré pour chaque catégorie
+        self.dropped_count = 0  # Nombre de lignes abandonnées car la queue était pleine
+        self._reported_dropped_count = 0  # Nombre de lignes abandonnées déjà signalées dans le log
+        self._queue = queue.Queue(maxsize=queue_size or Logger.QUEUE_SIZE)
+        self._file = None  # Fichier de log courant, gardé ouvert jusqu'au changement de jour
+        self._file_location = None
+        self.deferred_writer = deferred_writer
+        self._writer_thread = None
+        self._writer_lock = threading.Lock()
+        atexit.register(self.close)
 
     def _create_log_directory_if_not_exists(self):
         """
@@ -22,59 +60,258 @@ class Logger:
         if not os.path.exists(self.log_directory_location):
             os.makedirs(self.log_directory_location)
 
-    def _get_log_file_location(self):
+    def _get_log_file_location(self, now):
         """
-        Génère le chemin où le fichier de log courant est stocké.
-        Le nom du fichier est dérivé de la date courante.
+        Génère le chemin où le fichier de log est stocké.
+        Le nom du fichier est dérivé de la date.
+        :param now: Date de la ligne à écrire
         :return: Le chemin vers le fichier de log
         """
-        now = datetime.now()
         file_name = now.strftime('%Y-%m-%d.txt')
         return self.log_directory_location + '/' + file_name
 
-    def _write_to_log_file(self, text):
+    def _get_log_file(self, now):
         """
-        Log dans le fichier de log courant. Si le fichier n'existe pas,
-        il sera crée automatiquement.
-        :param text: Texte à insérer dans le fichier de log
+        Retourne le fichier de log correspondant à la date donnée. Le fichier courant est fermé
+        et un nouveau est ouvert (ou créé) lorsque l'on change de jour.
+        :param now: Date de la ligne à écrire
+        :return: Le fichier ouvert
         """
-        file_location = self._get_log_file_location()
-        file = open(file_location, 'a')
-        file.writelines(text + "\n")
-        file.flush()
+        file_location = self._get_log_file_location(now)
+        if file_location != self._file_location:
+            self._close_log_file()
+            self._file = open(file_location, 'a')
+            self._file_location = file_location
+        return self._file
 
-    def _date_and_time(self):
+    def _close_log_file(self):
         """
-        :return: Un string représentant le temps actuel
+        Ferme le fichier de log courant si il y en a un.
         """
-        now = datetime.now()
-        date_and_time = now.isoformat()
-        return date_and_time
+        if self._file:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+        self._file = None
+        self._file_location = None
+
+    def _format_entry(self, entry):
+        """
+        Construit la ligne de log avec le format suivant:
+        "[<temps>] | <niveau> | <category> | <message>"
+        C'est ici (sur le thread d'écriture) que le message est formaté avec ses arguments.
+        :param entry: (date, niveau, catégorie, message, arguments). Si la catégorie est None,
+                      le message est écrit tel quel.
+        :return: La ligne à écrire
+        """
+        now, level, log_category, log_text, args = entry
+        if log_category is None:
+            return log_text
+        if args:
+            try:
+                log_text = log_text.format(*args)
+            except Exception as e:
+                log_text = '{} {} (Erreur de formatage: {})'.format(log_text, args, e)
+        return '[{}] | {} | {} | {}'.format(now.isoformat(),
+                                            Logger.LEVEL_NAMES.get(level, level).ljust(7),
+                                            log_category.ljust(14), log_text)
+
+    def _write_to_log_file(self, entries):
+        """
+        Écrit un lot de lignes dans le fichier de log, puis flush une seule fois.
+        Si le fichier n'existe pas, il sera crée automatiquement.
+        :param entries: Liste de (date, niveau, catégorie, message, arguments)
+        """
+        try:
+            for entry in entries:
+                self._get_log_file(entry[0]).write(self._format_entry(entry) + "\n")
+            dropped_count = self.dropped_count
+            if dropped_count != self._reported_dropped_count and entries:
+                dropped_entry = (datetime.now(), Logger.WARNING, "LOGGER",
+                                 "{} lignes de log abandonnées",
+                                 (dropped_count - self._reported_dropped_count,))
+                self._get_log_file(entries[-1][0]).write(self._format_entry(dropped_entry) + "\n")
+                self._reported_dropped_count = dropped_count
+            if self._file:
+                self._file.flush()
+        except Exception:
+            # Une erreur d'écriture (disque plein, ...) ne doit pas arrêter le thread d'écriture
+            self._close_log_file()
+
+    def _writer_loop(self):
+        """
+        Boucle du thread d'écriture. Attend une ligne, puis récupère toutes celles déjà en
+        attente (jusqu'à `BATCH_SIZE`) pour les écrire d'un coup.
+        Un `None` dans la queue arrête la boucle, un `threading.Event` est déclenché une fois
+        que toutes les lignes qui le précèdent ont été écrites.
+        """
+        running = True
+        while running:
+            entries = []
+            events = []
+            item = self._queue.get()
+            while True:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    events.append(item)
+                else:
+                    entries.append(item)
+                if not running or len(entries) >= Logger.BATCH_SIZE:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._write_to_log_file(entries)
+            for event in events:
+                event.set()
+        self._close_log_file()
 
-    def log(self, log_category, log_text):
+    def _ensure_writer_thread(self):
+        """
+        Démarre le thread d'écriture si il n'est pas déjà démarré.
+        """
+        if self._writer_thread is not None:
+            return
+        with self._writer_lock:
+            if self._writer_thread is None:
+                thread = threading.Thread(target=self._writer_loop, name="Logger", daemon=True)
+                thread.start()
+                self._writer_thread = thread
+
+    def _enqueue(self, item):
+        """
+        Ajoute un élément dans la queue sans jamais bloquer.
+        :param item: Élément à ajouter
+        :return: True si l'élément a été ajouté, False si la queue était pleine
+        """
+        if not self.deferred_writer:
+            self._ensure_writer_thread()
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped_count += 1
+            return False
+
+    def set_log_directory(self, log_directory_location):
+        """
+        Change le dossier où les fichiers de log sont stockés. Le fichier courant est fermé à la
+        prochaine ligne écrite.
+        :param log_directory_location: Chemin du dossier, créé si il n'existe pas
+        """
+        self.log_directory_location = log_directory_location
+        self._create_log_directory_if_not_exists()
+
+    def set_level(self, level, log_category=None):
+        """
+        Configure le niveau minimum des messages à écrire.
+        :param level: Niveau minimum (`DEBUG`, `INFO`, `WARNING` ou `ERROR`)
+        :param log_category: Catégorie à configurer (ex: "SPEED_THREAD"). Si None, configure le
+                             niveau par défaut des catégories qui n'ont pas de niveau spécifique.
+        """
+        if log_category is None:
+            self.level = level
+        else:
+            self._category_levels[log_category] = level
+
+    def is_enabled(self, level, log_category):
+        """
+        :param level: Niveau du message
+        :param log_category: Catégorie du message
+        :return: True si un message de ce niveau et de cette catégorie doit être écrit
+        """
+        return level >= self._category_levels.get(log_category, self.level)
+
+    def log(self, log_category, log_text, *args, level=INFO):
         """
         Méthode principale pour les log.
         Ajoute à la fin du fichier de log courant une nouvelle ligne avec le format suivant:
-        "[<temps>] | <category> | <message>"
+        "[<temps>] | <niveau> | <category> | <message>"
+        Si des arguments sont donnés, le message est formaté avec `log_text.format(*args)`,
+        seulement si le niveau est activé et par le thread d'écriture. Les appels sur le chemin
+        critique ne coûtent donc presque rien lorsque leur niveau est désactivé.
+        Les arguments modifiables sont convertis en texte dès l'appel (voir
+        `IMMUTABLE_ARG_TYPES`) : la ligne montre leur valeur au moment de l'appel.
+        L'écriture est faite en arrière plan, cette méthode ne bloque jamais.
         Note: Si quelque chose se passe mal durant le log, on ignore l'erreur et ne log rien
         :param log_category: Catégorie du message de log
         :param log_text: Message à log
+        :param args: Arguments du message
+        :param level: Niveau du message (`INFO` par défaut)
         """
         try:
-            category = log_category.ljust(14)
-            date_and_time = self._date_and_time()
-            to_log = '[{}] | {} | {}'.format(date_and_time, category, log_text)
-            self._write_to_log_file(to_log)
+            if level >= self._category_levels.get(log_category, self.level):
+                args = tuple(arg if isinstance(arg, Logger.IMMUTABLE_ARG_TYPES) else str(arg)
+                             for arg in args)
+                self._enqueue((datetime.now(), level, log_category, log_text, args))
         except:
             pass
 
+    def debug(self, log_category, log_text, *args):
+        """
+        Log un message de niveau `DEBUG` (détail de chaque requête, trames échangées, ...)
+        """
+        self.log(log_category, log_text, *args, level=Logger.DEBUG)
+
+    def info(self, log_category, log_text, *args):
+        """
+        Log un message de niveau `INFO` (changements d'état, démarrage, connexion, ...)
+        """
+        self.log(log_category, log_text, *args, level=Logger.INFO)
+
+    def warning(self, log_category, log_text, *args):
+        """
+        Log un message de niveau `WARNING` (erreur dont on se remet automatiquement)
+        """
+        self.log(log_category, log_text, *args, level=Logger.WARNING)
+
+    def error(self, log_category, log_text, *args):
+        """
+        Log un message de niveau `ERROR`
+        """
+        self.log(log_category, log_text, *args, level=Logger.ERROR)
+
     def log_app_start(self):
         """
         Méthode spécial pour log le démarrage de l'application avec un format spécial
         """
-        date_and_time = self._date_and_time()
-        to_log = '\n\n\n------- APP START [{}] -------\n\n\n'.format(date_and_time)
-        self._write_to_log_file(to_log)
+        now = datetime.now()
+        to_log = '\n\n\n------- APP START [{}] -------\n\n\n'.format(now.isoformat())
+        self._enqueue((now, Logger.INFO, None, to_log, ()))
+
+    def flush(self, timeout=None):
+        """
+        Attend que toutes les lignes déjà loggées soient écrites dans le fichier.
+        :param timeout: Temps maximum d'attente en secondes (None pour attendre indéfiniment)
+        :return: True si toutes les lignes ont été écrites
+        """
+        event = threading.Event()
+        self._ensure_writer_thread()
+        try:
+            self._queue.put(event, timeout=timeout)
+        except queue.Full:
+            return False
+        return event.wait(timeout)
+
+    def close(self):
+        """
+        Écrit les lignes en attente, arrête le thread d'écriture et ferme le fichier de log.
+        """
+        if self._writer_thread is None:
+            if self._queue.empty():
+                return
+            # Lignes loggées avant le premier `flush` avec `deferred_writer`
+            self._ensure_writer_thread()
+        thread = self._writer_thread
+        try:
+            self._queue.put(None, timeout=Logger.CLOSE_TIMEOUT_S)
+        except queue.Full:
+            return
+        thread.join(Logger.CLOSE_TIMEOUT_S)
+        self._writer_thread = None
 
 
 logger = Logger('./logs')
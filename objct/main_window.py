@@ -1,12 +1,61 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from PyQt5.QtWidgets import QLabel, QMainWindow
+from array import array
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QPainter, QPolygon
+from PyQt5.QtWidgets import QLabel, QMainWindow, QWidget
 
 from objct.base_de_donnee import *
 from datetime import datetime
-import locale
-import time
+
+
+class Sparkline(QWidget):
+    """
+    Petit graphique des dernières vitesses reçues.
+    Les vitesses sont gardées dans un buffer circulaire alloué une seule fois, et les points du
+    tracé sont réutilisés à chaque dessin.
+    """
+    SIZE = 120  # Nombre de vitesses affichées
+
+    def __init__(self, parent=None):
+        """
+        Crée une nouvelle instance de `Sparkline`
+        """
+        super(Sparkline, self).__init__(parent)
+        self.values = array('d', [0.0] * Sparkline.SIZE)
+        self.count = 0  # Nombre de vitesses reçues (la plus récente est à l'index count - 1)
+        self._polygon = QPolygon(Sparkline.SIZE)
+
+    def add(self, value):
+        """
+        Ajoute une vitesse au buffer (sans redessiner).
+        :param value: Nouvelle vitesse
+        """
+        self.values[self.count % Sparkline.SIZE] = value
+        self.count += 1
+
+    def paintEvent(self, event):
+        """
+        Dessine les vitesses du buffer, de la plus ancienne (à gauche) à la plus récente.
+        """
+        points = min(self.count, Sparkline.SIZE)
+        if points < 2:
+            return
+        first = self.count - points
+        maximum = max(max(self.values), 1)
+        width = self.width() - 1
+        height = self.height() - 1
+        for i in range(Sparkline.SIZE):
+            # Tant que le buffer n'est pas plein, les points en trop répètent le dernier point
+            index = min(i, points - 1)
+            value = self.values[(first + index) % Sparkline.SIZE]
+            self._polygon.setPoint(i, width * index // (Sparkline.SIZE - 1),
+                                   height - int(height * value / maximum))
+        painter = QPainter(self)
+        painter.drawPolyline(self._polygon)
+        painter.end()
 
 
 class MainWindow(QMainWindow):
@@ -16,7 +65,11 @@ class MainWindow(QMainWindow):
     - Afficher l'heure à laquelle on a reçu la dernière vitesse
     - Afficher la dernière vitesse insérée dans la base de données ou une erreur si quelque chose
       s'est mal passé.
+    - Afficher les dernières vitesses dans un petit graphique
+    Les signaux ne font que retenir la dernière valeur reçue : l'affichage est mis à jour au plus
+    toutes les `REFRESH_INTERVAL_MS` millisecondes, quel que soit le nombre de signaux reçus.
     """
+    REFRESH_INTERVAL_MS = 250  # Temps entre deux mises à jour de l'affichage
 
     def __init__(self):
         """
@@ -28,48 +81,107 @@ class MainWindow(QMainWindow):
         self.label.setGeometry(15, 20, 370, 30)
         # Label qui affiche l'heure
         self.label2 = QLabel(self)
-        self.label2.setGeometry(15, 0, 370, 30)
+        self.label2.setGeometry(15, 0, 100, 20)
+        # Graphique des dernières vitesses, à côté de l'heure (au dessus de `label`)
+        self.sparkline = Sparkline(self)
+        self.sparkline.setGeometry(120, 2, 265, 16)
+        # Label qui affiche l'état de chaque machine (mode multi-machines), sous `label`
+        self.status_label = QLabel(self)
+        self.status_label.setGeometry(15, 50, 370, 30)
+        self.machine_status = {}
+        # Dernières valeurs reçues, affichées au prochain `refresh`
+        self._text = None
+        self._last_ts = None
+        self._status_changed = False
+        self._sparkline_count = 0  # `sparkline.count` lors du dernier dessin
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start(MainWindow.REFRESH_INTERVAL_MS)
 
-    def watch_signals(self, new_speed_signal, error_signal):
+    def watch_signals(self, speeds, error_signal):
         """
-        Écoute les signaux et exécute les fonction `handle_new_speed` et `handle_error` à chaque
-        fois que les signaux émettent de nouvelles valeurs
-        :param new_speed_signal: Signal qui se déclenche quand l'on a reçu une nouvelle qui a été
-                                 insérée avec succès dans la base de données
+        Écoute les signaux et exécute les fonction `handle_new_speed` (pour chaque vitesse d'un
+        lot) et `handle_error` à chaque fois que les signaux émettent de nouvelles valeurs
+        :param speeds: `SpeedBatch` des vitesses insérées avec succès dans la base de données
         :param error_signal: Signal qui se déclenche lorsqu'une erreur s'est produite durant la
                              récupération ou la sauvegarde d'une vitesse
         """
-        new_speed_signal.connect(self.handle_new_speed)
+        speeds.NEW_SPEEDS_SIGNAL.connect(lambda: self.handle_new_speeds(speeds.take()))
         error_signal.connect(self.handle_error)
 
+    def watch_status_signal(self, status_signal):
+        """
+        Écoute le signal d'état des machines de `AcquisitionEngine`
+        :param status_signal: Signal qui se déclenche avec (machine, état, dernière vitesse)
+        """
+        status_signal.connect(self.handle_machine_status)
+
+    def handle_machine_status(self, machine, state, speed):
+        """
+        Retient l'état d'une machine pour le prochain affichage
+        :param machine: Nom de la machine
+        :param state: État du superviseur de la machine
+        :param speed: Dernière vitesse lue (string vide si aucune)
+        """
+        self.machine_status[machine] = "{}: {}{}".format(
+            machine, state, " ({})".format(speed) if speed else "")
+        self._status_changed = True
+
     @staticmethod
     def timestamp_to_hour(millitimestamp):
         """
         Utilitaire pour convertir un millitimestamp en heure.
+        La locale doit être définie une seule fois au démarrage (voir `main.py`).
         :param millitimestamp: le millitimestamp à convertir
         :return: Un string au format "<heures>:<minutes>:<secondes>" ou "??:??:??" en cas d'erreur
         """
         ts = millitimestamp / 1000
         try:
-            locale.setlocale(locale.LC_TIME, '')
             return datetime.fromtimestamp(ts).strftime('%H:%M:%S')
-        except:
+        except (OverflowError, OSError, ValueError):
             return '??:??:??'
 
     def handle_new_speed(self, speed_value, ts):
         """
-        Met à jour les labels lorsqu'une nouvelle vitesse à été insérée
+        Retient une nouvelle vitesse insérée pour le prochain affichage
         :param speed_value: La nouvelle vitesse
         :param ts: Le timestamp en milliseconde de quand on a reçu la vitesse
         """
-        hours = MainWindow.timestamp_to_hour(ts)
-        self.label.setText("Mise à jour : vitesse = {} m/min".format(speed_value))
-        self.label2.setText(hours)
+        self._text = "Mise à jour : vitesse = {} m/min".format(speed_value)
+        self._last_ts = ts
+        self.sparkline.add(speed_value)
+
+    def handle_new_speeds(self, speeds):
+        """
+        Retient un lot de vitesses insérées pour le prochain affichage
+        :param speeds: Liste de (vitesse, millitimestamp), de la plus ancienne à la plus récente
+        """
+        for speed_value, ts in speeds:
+            self.handle_new_speed(speed_value, ts)
 
     def handle_error(self, error):
         """
-        Met à jour les labels lorsqu'une erreur se produit durant la récupération ou la sauvegarde
-        d'une nouvelle vitesse.
+        Retient l'erreur qui s'est produite durant la récupération ou la sauvegarde d'une nouvelle
+        vitesse pour le prochain affichage.
         :param error: L'erreur qui s'est produite
         """
-        self.label.setText(error)
+        self._text = error
+
+    def refresh(self):
+        """
+        Met à jour les labels et le graphique avec les dernières valeurs reçues depuis la
+        dernière mise à jour. Ne fait rien si rien n'a été reçu.
+        """
+        if self._text is not None:
+            self.label.setText(self._text)
+            self._text = None
+        if self._last_ts is not None:
+            self.label2.setText(MainWindow.timestamp_to_hour(self._last_ts))
+            self._last_ts = None
+        if self._status_changed:
+            self.status_label.setText(" | ".join(self.machine_status[name]
+                                                 for name in sorted(self.machine_status)))
+            self._status_changed = False
+        if self.sparkline.count != self._sparkline_count:
+            self._sparkline_count = self.sparkline.count
+            self.sparkline.update()
@@ -0,0 +1,295 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+from objct.logger import logger
+
+
+# Limites (en millisecondes) des buckets des histogrammes de durée
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+JITTER_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 500, 1000)
+
+
+def jitter_buckets_ms(period_ms):
+    """
+    :param period_ms: Période du planning (ex: `SpeedAcquisition.SLEEP_TIME_MS`)
+    :return: Les limites de `JITTER_BUCKETS_MS` plus la période : un retard d'une période
+             entière (échéance sautée) a son propre bucket
+    """
+    return tuple(sorted(set(JITTER_BUCKETS_MS) | {period_ms}))
+
+
+class Counter:
+    """
+    Compteur qui ne fait qu'augmenter.
+    """
+    TYPE = 'counter'
+
+    def __init__(self, name, description):
+        """
+        Crée une nouvelle instance de `Counter`
+        :param name: Nom de la métrique (format Prometheus, ex: "db_retries_total")
+        :param description: Description de la métrique
+        """
+        self.name = name
+        self.description = description
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        Augmente le compteur.
+        """
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        """
+        :return: Les lignes de valeurs au format texte de Prometheus
+        """
+        return ['{} {}'.format(self.name, self.value)]
+
+    def summary(self):
+        """
+        :return: Un résumé pour le log
+        """
+        return str(self.value)
+
+
+class Gauge(Counter):
+    """
+    Valeur qui peut monter ou descendre (ex: nombre de valeurs en attente).
+    """
+    TYPE = 'gauge'
+
+    def set(self, value):
+        """
+        Change la valeur.
+        """
+        self.value = value
+
+
+class Histogram:
+    """
+    Histogramme à buckets fixes : chaque observation incrémente le bucket qui la contient, sans
+    garder les valeurs elles même (mémoire et coût constants).
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name, description, buckets):
+        """
+        Crée une nouvelle instance de `Histogram`
+        :param name: Nom de la métrique (format Prometheus, ex: "fins_request_duration_ms")
+        :param description: Description de la métrique
+        :param buckets: Limites supérieures (incluses) des buckets, dans l'ordre croissant
+        """
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Le dernier bucket est +Inf
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Ajoute une observation.
+        :param value: Valeur observée
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """
+        Estime un quantile à partir des buckets.
+        :param q: Quantile entre 0 et 1 (ex: 0.99)
+        :return: La limite supérieure du bucket qui contient le quantile (inf pour le dernier
+                 bucket), ou None si il n'y a aucune observation
+        """
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def render(self):
+        """
+        :return: Les lignes de valeurs au format texte de Prometheus
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bucket, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bucket, cumulative))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, count))
+        lines.append('{}_sum {}'.format(self.name, total))
+        lines.append('{}_count {}'.format(self.name, count))
+        return lines
+
+    def summary(self):
+        """
+        :return: Un résumé pour le log (nombre, moyenne et quantiles estimés)
+        """
+        if not self.count:
+            return "n=0"
+        return "n={} moyenne={:.2f} p50<={} p99<={}".format(
+            self.count, self.sum / self.count, self.quantile(0.5), self.quantile(0.99))
+
+
+class MetricsRegistry:
+    """
+    Ensemble des métriques du programme. Une métrique est créée au premier appel de `counter`,
+    `gauge` ou `histogram` avec son nom, puis retournée telle quelle aux appels suivants.
+    """
+    def __init__(self):
+        """
+        Crée une nouvelle instance de `MetricsRegistry`
+        """
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        """
+        :return: La métrique `name`, créée avec `cls(name, *args)` si elle n'existe pas
+        """
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = self._metrics[name] = cls(name, *args)
+        return metric
+
+    def counter(self, name, description):
+        """
+        :return: Le `Counter` `name`
+        """
+        return self._get(Counter, name, description)
+
+    def gauge(self, name, description):
+        """
+        :return: La `Gauge` `name`
+        """
+        return self._get(Gauge, name, description)
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS_MS):
+        """
+        :return: L'`Histogram` `name`
+        """
+        return self._get(Histogram, name, description, buckets)
+
+    def render(self):
+        """
+        :return: Toutes les métriques au format texte de Prometheus
+        """
+        lines = []
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            lines.append('# HELP {} {}'.format(name, metric.description))
+            lines.append('# TYPE {} {}'.format(name, metric.TYPE))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def log_summary(self):
+        """
+        Écrit une ligne par métrique dans le log.
+        """
+        for name in sorted(self._metrics):
+            logger.info("METRICS", "{}: {}", name, self._metrics[name].summary())
+
+
+class MetricsServer:
+    """
+    Serveur HTTP local qui expose les métriques au format Prometheus sur /metrics, et écrit
+    régulièrement un résumé dans le log.
+    """
+    HOST = '127.0.0.1'  # Adresse d'écoute (locale par défaut)
+
+    def __init__(self, registry, port=None, log_interval_s=None, host=None):
+        """
+        Crée une nouvelle instance de `MetricsServer`
+        :param registry: `MetricsRegistry` à exposer
+        :param port: Port HTTP (None pour ne pas démarrer le serveur)
+        :param log_interval_s: Temps entre deux résumés dans le log (None pour aucun)
+        :param host: Adresse d'écoute (par défaut `HOST`)
+        """
+        self.registry = registry
+        self.port = port
+        self.log_interval_s = log_interval_s
+        self.host = host or MetricsServer.HOST
+        self.httpd = None
+        self._stop_event = threading.Event()
+
+    def _handler(self):
+        """
+        :return: La classe qui répond aux requêtes HTTP
+        """
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("METRICS", "{} - {}", self.address_string(), format % args)
+
+        return Handler
+
+    def start(self):
+        """
+        Démarre le serveur HTTP et le résumé périodique, chacun dans un thread en tâche de fond.
+        """
+        self._stop_event.clear()
+        if self.port is not None:
+            self.httpd = ThreadingHTTPServer((self.host, self.port), self._handler())
+            logger.info("METRICS", "Métriques disponibles sur http://{}:{}/metrics",
+                        self.host, self.httpd.server_port)
+            threading.Thread(target=self.httpd.serve_forever, name="MetricsServer",
+                             daemon=True).start()
+        if self.log_interval_s:
+            threading.Thread(target=self._log_loop, name="MetricsLog", daemon=True).start()
+
+    def _log_loop(self):
+        """
+        Écrit un résumé des métriques dans le log toutes les `log_interval_s` secondes.
+        """
+        while not self._stop_event.wait(self.log_interval_s):
+            self.registry.log_summary()
+
+    def stop(self):
+        """
+        Arrête le serveur HTTP et le résumé périodique.
+        """
+        self._stop_event.set()
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+# Métriques du programme
+metrics = MetricsRegistry()
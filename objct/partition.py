@@ -0,0 +1,206 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+from objct.logger import logger
+
+
+class Partitioning:
+    """
+    Découpe la base de données en un fichier par jour ou par mois (la partition). Pour une base
+    de données `../mondon.db`, la partition du 18 octobre 2026 est `../mondon_20261018.db`
+    (`../mondon_202610.db` par mois). Les partitions sont découpées en heure locale.
+    Seule la partition courante reçoit les nouvelles vitesses : elle reste petite, et les
+    partitions fermées peuvent être compactées, archivées ou supprimées sans toucher à
+    l'acquisition (voir `PartitionMaintenance`).
+    """
+    DAY = 'day'
+    MONTH = 'month'
+    KEY_FORMATS = {DAY: '%Y%m%d', MONTH: '%Y%m'}  # Format de la date dans le nom des fichiers
+    COMPACTED_VERSION = 1  # `user_version` d'une partition déjà compactée
+
+    def __init__(self, period=DAY, retention_days=None, archive_directory=None):
+        """
+        Crée une nouvelle instance de `Partitioning`
+        :param period: Durée d'une partition (`DAY` ou `MONTH`)
+        :param retention_days: Nombre de jours pendant lesquels une partition fermée est gardée
+                               (None pour tout garder)
+        :param archive_directory: Dossier où sont déplacées les partitions expirées. Si None,
+                                  elles sont supprimées.
+        """
+        if period not in Partitioning.KEY_FORMATS:
+            raise ValueError("Période de partition inconnue: {}".format(period))
+        self.period = period
+        self.retention_days = retention_days
+        self.archive_directory = archive_directory
+        self._key_format = Partitioning.KEY_FORMATS[period]
+        self._key_pattern = re.compile(r'_(\d{{{}}})$'.format(8 if period == Partitioning.DAY
+                                                               else 6))
+
+    def key(self, ts):
+        """
+        :param ts: Millitimestamp
+        :return: La clé de la partition qui contient `ts` (ex: "20261018")
+        """
+        return datetime.fromtimestamp(ts / 1000).strftime(self._key_format)
+
+    def bounds(self, key):
+        """
+        :param key: Clé d'une partition
+        :return: (début inclus, fin exclue) de la partition en millitimestamp
+        """
+        start = datetime.strptime(key, self._key_format)
+        if self.period == Partitioning.DAY:
+            end = start + timedelta(days=1)
+        else:
+            end = (start + timedelta(days=32)).replace(day=1)
+        return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+    def path(self, database_location, key):
+        """
+        :return: Le chemin du fichier de la partition `key`
+        """
+        root, extension = os.path.splitext(database_location)
+        return '{}_{}{}'.format(root, key, extension)
+
+    def existing_keys(self, database_location):
+        """
+        :return: Les clés des partitions présentes sur le disque, dans l'ordre chronologique
+        """
+        root, extension = os.path.splitext(database_location)
+        keys = []
+        for path in glob.glob(glob.escape(root) + '_*' + extension):
+            match = self._key_pattern.search(os.path.splitext(path)[0])
+            if match:
+                keys.append(match.group(1))
+        return sorted(keys)
+
+    def keys_between(self, database_location, start, end):
+        """
+        :param start: Millitimestamp de début (inclus)
+        :param end: Millitimestamp de fin (exclu)
+        :return: Les clés des partitions présentes sur le disque qui recouvrent la plage
+        """
+        keys = []
+        for key in self.existing_keys(database_location):
+            key_start, key_end = self.bounds(key)
+            if key_start < end and start < key_end:
+                keys.append(key)
+        return keys
+
+    def is_expired(self, key, now_ms):
+        """
+        :return: True si la partition `key` est plus vieille que `retention_days`
+        """
+        if self.retention_days is None:
+            return False
+        return self.bounds(key)[1] <= now_ms - self.retention_days * 24 * 3600 * 1000
+
+
+class PartitionMaintenance:
+    """
+    Entretient les partitions fermées dans un thread en tâche de fond, avec ses propres
+    connexions SQLite :
+    - les partitions plus vieilles que `retention_days` sont archivées ou supprimées
+    - les autres sont compactées une fois (checkpoint du WAL puis VACUUM)
+    """
+    def __init__(self, database_location, partitioning):
+        """
+        Crée une nouvelle instance de `PartitionMaintenance`
+        :param database_location: Chemin de la base de données (voir `Partitioning.path`)
+        :param partitioning: `Partitioning` utilisé par la base de données
+        """
+        self.database_location = database_location
+        self.partitioning = partitioning
+        self._thread = None
+
+    def start(self, current_key, now_ms, attached_keys=()):
+        """
+        Lance l'entretien des partitions antérieures à `current_key`, sauf si il est déjà en
+        cours.
+        :param current_key: Clé de la partition courante, jamais touchée
+        :param now_ms: Millitimestamp utilisé pour la rétention
+        :param attached_keys: Clés des partitions attachées à la connexion de la base de
+                              données, qui ne sont ni archivées ni supprimées
+        :return: Le thread lancé, ou None si un entretien est déjà en cours
+        """
+        if self._thread and self._thread.is_alive():
+            return None
+        self._thread = threading.Thread(target=self.run,
+                                        args=(current_key, now_ms, attached_keys),
+                                        name="PartitionMaintenance", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def join(self, timeout=None):
+        """
+        Attend la fin de l'entretien en cours.
+        """
+        if self._thread:
+            self._thread.join(timeout)
+
+    def run(self, current_key, now_ms, attached_keys=()):
+        """
+        Entretient toutes les partitions fermées.
+        """
+        for key in self.partitioning.existing_keys(self.database_location):
+            if key >= current_key:
+                continue
+            path = self.partitioning.path(self.database_location, key)
+            try:
+                if self.partitioning.is_expired(key, now_ms):
+                    if key not in attached_keys:
+                        self._expire(path)
+                else:
+                    self._compact(path)
+            except (OSError, sqlite3.Error) as e:
+                # Par exemple, la partition est ouverte par un autre programme. On réessaiera au
+                # prochain entretien.
+                logger.warning("DATABASE", "Entretien de la partition {} impossible: {}", path, e)
+
+    @staticmethod
+    def _compact(path):
+        """
+        Compacte une partition fermée si ce n'est pas déjà fait.
+        """
+        conn = sqlite3.connect(path, timeout=30)
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= Partitioning.COMPACTED_VERSION:
+                return
+            logger.info("DATABASE", "Compactage de la partition {}", path)
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA optimize")
+            conn.execute("PRAGMA user_version = {:d}".format(Partitioning.COMPACTED_VERSION))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _expire(self, path):
+        """
+        Archive ou supprime une partition expirée.
+        """
+        conn = sqlite3.connect(path, timeout=30)
+        try:
+            # Reporte le WAL dans le fichier pour n'avoir qu'un fichier à déplacer
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+        archive_directory = self.partitioning.archive_directory
+        if archive_directory:
+            logger.info("DATABASE", "Archivage de la partition {} dans {}", path,
+                        archive_directory)
+            os.makedirs(archive_directory, exist_ok=True)
+            os.replace(path, os.path.join(archive_directory, os.path.basename(path)))
+        else:
+            logger.info("DATABASE", "Suppression de la partition {}", path)
+            os.remove(path)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
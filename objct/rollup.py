@@ -0,0 +1,168 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+from datetime import datetime
+
+
+# Granularités des agrégats en millisecondes
+SECOND_MS = 1000
+MINUTE_MS = 60 * SECOND_MS
+HOUR_MS = 60 * MINUTE_MS
+GRANULARITIES_MS = (SECOND_MS, MINUTE_MS, HOUR_MS)
+
+# Requêtes à compléter avec le schéma ("main" ou une partition attachée, voir `Database`)
+CREATE_ROLLUP_TABLE = "CREATE TABLE IF NOT EXISTS {schema}.mondon_speed_rollup " \
+                      "(granularity INTEGER, bucket INTEGER, min_speed INTEGER, " \
+                      "max_speed INTEGER, sum_speed INTEGER, count INTEGER, stopped_ms INTEGER, " \
+                      "PRIMARY KEY (granularity, bucket)) WITHOUT ROWID"
+
+# Fusionne un agrégat partiel avec celui déjà présent dans la table. min/max peuvent être NULL
+# pour un agrégat qui ne contient que du temps d'arrêt (l'intervalle qui suit la dernière vitesse
+# d'un lot déjà écrit).
+UPSERT_ROLLUP = "INSERT INTO {schema}.mondon_speed_rollup VALUES (?, ?, ?, ?, ?, ?, ?) " \
+                "ON CONFLICT (granularity, bucket) DO UPDATE SET " \
+                "min_speed = min(coalesce(min_speed, excluded.min_speed), " \
+                "coalesce(excluded.min_speed, min_speed)), " \
+                "max_speed = max(coalesce(max_speed, excluded.max_speed), " \
+                "coalesce(excluded.max_speed, max_speed)), " \
+                "sum_speed = sum_speed + excluded.sum_speed, " \
+                "count = count + excluded.count, " \
+                "stopped_ms = stopped_ms + excluded.stopped_ms"
+
+
+class RollupAccumulator:
+    """
+    Calcule de manière incrémentale les agrégats (min, max, somme, nombre de vitesses et temps
+    d'arrêt) de la table `mondon_speed_rollup` pour chaque seconde, minute et heure.
+    Les agrégats des vitesses ajoutées sont gardés en mémoire jusqu'à leur écriture avec le même
+    lot que les vitesses (voir `Database.flush`), puis fusionnés avec ceux déjà écrits.
+    """
+    STOP_THRESHOLD = 0  # Vitesse en dessous (ou égale) de laquelle la machine est à l'arrêt
+    MAX_GAP_MS = 5000  # Au delà de cet écart entre deux vitesses, on considère qu'il manque des
+                       # données et l'intervalle n'est pas compté comme temps d'arrêt.
+
+    def __init__(self, granularities_ms=GRANULARITIES_MS):
+        """
+        Crée une nouvelle instance de `RollupAccumulator`
+        :param granularities_ms: Granularités des agrégats en millisecondes
+        """
+        self.granularities_ms = granularities_ms
+        self._pending = {}  # (granularité, début du bucket) -> [min, max, somme, nombre, arrêt]
+        self.last = None  # (temps, vitesse) de la dernière vitesse ajoutée
+
+    def _bucket(self, granularity_ms, ts):
+        """
+        :return: L'agrégat en attente du bucket qui contient `ts` (créé si besoin)
+        """
+        key = (granularity_ms, ts - ts % granularity_ms)
+        aggregate = self._pending.get(key)
+        if aggregate is None:
+            aggregate = self._pending[key] = [None, None, 0, 0, 0]
+        return aggregate
+
+    def _add_stopped(self, start, end):
+        """
+        Ajoute le temps d'arrêt [start, end[ aux agrégats, réparti entre les buckets qu'il
+        traverse.
+        """
+        for granularity_ms in self.granularities_ms:
+            bucket = start - start % granularity_ms
+            while bucket < end:
+                self._bucket(granularity_ms, bucket)[4] += \
+                    min(end, bucket + granularity_ms) - max(start, bucket)
+                bucket += granularity_ms
+
+    def add(self, ts, speed):
+        """
+        Ajoute une vitesse aux agrégats.
+        L'intervalle depuis la vitesse précédente est compté comme temps d'arrêt si celle-ci
+        était à l'arrêt, dans chacun des buckets qu'il traverse.
+        :param ts: Millitimestamp de la vitesse
+        :param speed: Valeur de la vitesse
+        """
+        last = self.last
+        if last is not None and ts <= last[0]:
+            # Vitesse déjà vue (même timestamp) ou plus ancienne : ignorée comme dans mondon_speed
+            return
+        if last is not None and last[1] <= RollupAccumulator.STOP_THRESHOLD \
+                and ts - last[0] <= RollupAccumulator.MAX_GAP_MS:
+            self._add_stopped(last[0], ts)
+        for granularity_ms in self.granularities_ms:
+            aggregate = self._bucket(granularity_ms, ts)
+            if aggregate[0] is None or speed < aggregate[0]:
+                aggregate[0] = speed
+            if aggregate[1] is None or speed > aggregate[1]:
+                aggregate[1] = speed
+            aggregate[2] += speed
+            aggregate[3] += 1
+        self.last = (ts, speed)
+
+    def statements(self, schema_of=None):
+        """
+        :param schema_of: Fonction qui retourne le schéma où écrire le bucket qui commence au
+                          millitimestamp donné (par défaut "main")
+        :return: Les requêtes (pour `Database._run_transaction`) qui fusionnent les agrégats en
+                 attente avec la table. Liste vide si rien n'est en attente.
+        """
+        rows_by_schema = {}
+        for (granularity_ms, bucket), aggregate in self._pending.items():
+            schema = schema_of(bucket) if schema_of else 'main'
+            rows_by_schema.setdefault(schema, []).append((granularity_ms, bucket, *aggregate))
+        return [(UPSERT_ROLLUP.format(schema=schema), rows, True)
+                for schema, rows in rows_by_schema.items()]
+
+    def clear(self):
+        """
+        Oublie les agrégats en attente, à appeler une fois qu'ils ont été écrits.
+        """
+        self._pending = {}
+
+    def discard(self, last):
+        """
+        Oublie les agrégats en attente sans les écrire (transaction annulée) et revient à la
+        dernière vitesse écrite.
+        :param last: `last` avant l'ajout des vitesses non écrites
+        """
+        self._pending = {}
+        self.last = last
+
+
+def parse_date(value):
+    """
+    Convertit une date "AAAA-MM-JJ" (heure locale) en millitimestamp.
+    """
+    return int(datetime.strptime(value, '%Y-%m-%d').timestamp() * 1000)
+
+
+def main():
+    """
+    Commande de reconstruction des agrégats d'une base de données existante :
+    python -m objct.rollup <base de données> [--from AAAA-MM-JJ] [--to AAAA-MM-JJ]
+                           [--partition day|month]
+    """
+    from objct.base_de_donnee import Database
+    from objct.partition import Partitioning
+
+    parser = argparse.ArgumentParser(description="Reconstruit la table mondon_speed_rollup à "
+                                                 "partir des vitesses de mondon_speed")
+    parser.add_argument('database', help="Chemin du fichier contenant la base de données")
+    parser.add_argument('--from', dest='start', type=parse_date, default=None,
+                        help="Premier jour à reconstruire (par défaut la première vitesse)")
+    parser.add_argument('--to', dest='end', type=parse_date, default=None,
+                        help="Jour (exclu) où s'arrêter (par défaut après la dernière vitesse)")
+    parser.add_argument('--partition', choices=sorted(Partitioning.KEY_FORMATS), default=None,
+                        help="Reconstruit les partitions par jour ou par mois de la base de données")
+    args = parser.parse_args()
+
+    db = Database(args.database,
+                  partitioning=Partitioning(args.partition) if args.partition else None)
+    try:
+        count = db.backfill_rollups(args.start, args.end)
+    finally:
+        db.close()
+    print("{} vitesses agrégées".format(count))
+
+
+if __name__ == '__main__':
+    main()
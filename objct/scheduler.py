@@ -0,0 +1,120 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+from objct.metrics import jitter_buckets_ms, metrics
+
+
+MISSED_TICKS = metrics.counter('scheduler_missed_ticks_total',
+                               "Nombre d'échéances sautées car trop en retard")
+
+
+class Tick:
+    """
+    Représente un réveil du `FixedRateScheduler`.
+    """
+    __slots__ = ('index', 'scheduled_ms', 'observed_ms', 'missed')
+
+    def __init__(self, index, scheduled_ms, observed_ms, missed):
+        """
+        Crée une nouvelle instance de `Tick`
+        :param index: Numéro de l'échéance depuis le démarrage du scheduler
+        :param scheduled_ms: Millitimestamp auquel le réveil était prévu
+        :param observed_ms: Millitimestamp auquel le réveil a réellement eu lieu
+        :param missed: Nombre d'échéances sautées juste avant ce réveil
+        """
+        self.index = index
+        self.scheduled_ms = scheduled_ms
+        self.observed_ms = observed_ms
+        self.missed = missed
+
+
+class FixedRateScheduler:
+    """
+    Planifie des réveils à intervalle fixe en se basant sur une horloge monotone.
+    L'échéance n est toujours `début + n * période` : elle est calculée depuis le planning idéal
+    et non depuis le réveil précédent, donc le temps passé entre deux réveils (communication avec
+    l'automate, écriture dans la base de données, ...) ne décale pas le planning.
+    Si l'on est en retard de plus d'une période, les échéances dépassées sont sautées (et
+    comptées dans `missed_ticks`) plutôt que d'enchaîner les réveils pour rattraper le retard.
+    """
+    MAX_WALL_CLOCK_DRIFT_MS = 1000  # Écart maximum entre l'horloge système et le planning avant
+                                    # de recaler le planning sur l'horloge système (changement
+                                    # d'heure manuel, synchronisation NTP, ...).
+
+    def __init__(self, period_ms, sleep=time.sleep):
+        """
+        Crée une nouvelle instance de `FixedRateScheduler`
+        :param period_ms: Période entre deux réveils en millisecondes
+        :param sleep: Fonction utilisée pour attendre (prend un temps en secondes). Permet par
+                      exemple d'utiliser `threading.Event.wait` pour pouvoir être interrompu.
+        """
+        self.period_ms = period_ms
+        self.missed_ticks = 0  # Nombre total d'échéances sautées
+        # Un histogramme par période : ses buckets contiennent la période (échéance sautée),
+        # les plannings d'une autre période (ex: machines de `AcquisitionEngine`) ont le leur
+        self._wakeup_lateness = metrics.histogram(
+            'scheduler_wakeup_lateness_ms_period_{:g}'.format(period_ms).replace('.', '_'),
+            "Retard du réveil par rapport à l'échéance prévue (période de {:g} ms)"
+            .format(period_ms), jitter_buckets_ms(period_ms))
+        self._sleep = sleep
+        self.reset()
+
+    def reset(self):
+        """
+        Redémarre le planning à partir de maintenant. Le prochain réveil est immédiat.
+        """
+        self._start_monotonic = time.monotonic()
+        self._start_wall_ms = time.time() * 1000
+        self._next_index = 0
+        self._current = (0, 0)  # (index, échéances sautées) de l'échéance en cours
+        self._deadline = self._start_monotonic  # Échéance en cours (horloge monotone)
+
+    def next_delay(self):
+        """
+        Calcule la prochaine échéance du planning. Si l'on est en retard de plus d'une période,
+        les échéances dépassées sont sautées.
+        Doit être suivi d'une attente du temps retourné puis d'un appel à `tick`.
+        :return: Le temps à attendre en secondes avant l'échéance (0 si elle est dépassée)
+        """
+        period_s = self.period_ms / 1000
+        index = self._next_index
+        deadline = self._start_monotonic + index * period_s
+        now = time.monotonic()
+        missed = 0
+        if now - deadline >= period_s:
+            # Trop en retard : on saute les échéances dépassées et on attend la suivante
+            missed = int((now - deadline) // period_s)
+            index += missed
+            deadline += missed * period_s
+            self.missed_ticks += missed
+            MISSED_TICKS.inc(missed)
+        self._current = (index, missed)
+        self._deadline = deadline
+        self._next_index = index + 1
+        return max(0, deadline - now)
+
+    def tick(self):
+        """
+        :return: Le `Tick` correspondant à l'échéance calculée par le dernier `next_delay`
+        """
+        index, missed = self._current
+        self._wakeup_lateness.observe(max(0, time.monotonic() - self._deadline) * 1000)
+        observed_ms = int(round(time.time() * 1000))
+        scheduled_ms = int(round(self._start_wall_ms + index * self.period_ms))
+        if abs(observed_ms - scheduled_ms) > FixedRateScheduler.MAX_WALL_CLOCK_DRIFT_MS:
+            # L'horloge système a bougé par rapport à l'horloge monotone
+            self._start_wall_ms += observed_ms - scheduled_ms
+            scheduled_ms = observed_ms
+        return Tick(index, scheduled_ms, observed_ms, missed)
+
+    def wait_next(self):
+        """
+        Attend la prochaine échéance du planning.
+        :return: Le `Tick` correspondant à l'échéance atteinte
+        """
+        delay = self.next_delay()
+        if delay > 0:
+            self._sleep(delay)
+        return self.tick()
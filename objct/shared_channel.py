@@ -0,0 +1,386 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from multiprocessing import resource_tracker, shared_memory
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from objct.logger import logger
+
+
+class SharedChannel:
+    """
+    Canal en mémoire partagée (`multiprocessing.shared_memory`) entre le processus d'acquisition,
+    seul à écrire, et le GUI, qui lit la mémoire projetée sans passer par le processus
+    d'acquisition : le GUI peut être bloqué, fermé ou relancé sans que l'acquisition attende.
+
+    Contenu du segment (little endian) :
+    - en-tête (`HEADER`) : signature, version, capacité, pid du processus d'acquisition. L'octet
+      `STOP` (dans le bourrage de l'en-tête) est mis à 1 pour demander l'arrêt de l'acquisition
+      (voir `request_stop`), ce qui marche aussi sous Windows, sans signal
+    - `HEARTBEAT` : millitimestamp mis à jour régulièrement par le processus d'acquisition
+    - `COUNT` : nombre total de vitesses publiées (la prochaine va dans la case COUNT % capacité)
+    - l'état (`STATUS`) : état du superviseur, nombre d'erreurs, temps et message de la dernière
+      erreur, protégé par un compteur de séquence (impair pendant une écriture)
+    - à partir de `DATA_OFFSET`, le buffer circulaire des vitesses : les temps (int64) puis les
+      vitesses (float64)
+    Une vitesse est écrite dans sa case avant que `COUNT` soit augmenté. Un lecteur vérifie
+    après sa lecture que les cases lues n'ont pas été écrasées entre-temps, ni ne sont la case
+    en cours d'écriture (la case COUNT % capacité, qui contient la plus ancienne vitesse quand le
+    buffer est plein).
+    """
+    NAME = 'mondon_speed'  # Nom du segment de mémoire partagée par défaut
+    CAPACITY = 4096  # Nombre de vitesses gardées (le GUI lit plusieurs fois par seconde)
+    MAGIC = b'MSHM'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHxxII')  # Signature, version, capacité, pid
+    STOP = struct.Struct('<B')
+    STOP_OFFSET = 6
+    HEARTBEAT = struct.Struct('<q')
+    HEARTBEAT_OFFSET = 16
+    COUNT = struct.Struct('<Q')
+    COUNT_OFFSET = 24
+    SEQUENCE = struct.Struct('<Q')
+    SEQUENCE_OFFSET = 32
+    STATUS = struct.Struct('<16sQq184s')  # État, nombre d'erreurs, temps et message de l'erreur
+    STATUS_OFFSET = 40
+    DATA_OFFSET = 256  # Fin de `STATUS`
+    MAX_STATUS_ATTEMPTS = 100  # Lectures de l'état avant d'abandonner (écrivain arrêté pendant
+                               # une écriture)
+    STATE_NO_ACQUISITION = 'NO_ACQUISITION'  # État affiché quand aucun processus ne publie
+    ALIVE_TIMEOUT_MS = 3000  # Temps sans battement de cœur au delà duquel l'acquisition est
+                             # considérée comme arrêtée
+
+    def __init__(self, shm, owner):
+        """
+        Utiliser `create` (processus d'acquisition) ou `attach` (GUI).
+        :param shm: `SharedMemory` du canal
+        :param owner: Vrai pour le processus qui a créé le segment (et le supprime à la fin)
+        """
+        self.shm = shm
+        self.owner = owner
+        magic, version, self.capacity, self.pid = SharedChannel.HEADER.unpack_from(shm.buf)
+        if magic != SharedChannel.MAGIC or version != SharedChannel.VERSION:
+            shm.close()
+            raise ValueError("La mémoire partagée {} n'est pas un canal (version {})"
+                             .format(shm.name, SharedChannel.VERSION))
+        times_end = SharedChannel.DATA_OFFSET + 8 * self.capacity
+        self._times = shm.buf[SharedChannel.DATA_OFFSET:times_end].cast('q')
+        self._speeds = shm.buf[times_end:times_end + 8 * self.capacity].cast('d')
+        self._count = SharedChannel.COUNT.unpack_from(shm.buf, SharedChannel.COUNT_OFFSET)[0]
+        self._sequence = 0
+        self._status = ['', 0, 0, '']  # État, nombre d'erreurs, temps et message de l'erreur
+        self._lock = threading.Lock()  # Les vitesses et l'état viennent de plusieurs threads
+
+    @staticmethod
+    def _open(name):
+        """
+        Ouvre un segment existant sans que ce processus en devienne responsable.
+        """
+        try:
+            return shared_memory.SharedMemory(name, track=False)  # Python 3.13 et plus
+        except TypeError:
+            shm = shared_memory.SharedMemory(name)
+            if os.name == 'posix':
+                # Sinon le resource_tracker de ce processus supprimerait le segment à sa sortie
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            return shm
+
+    @classmethod
+    def create(cls, name=None, capacity=None):
+        """
+        Crée le canal (dans le processus d'acquisition).
+        Un segment laissé par un processus d'acquisition arrêté brutalement est remplacé, mais
+        pas celui d'un processus d'acquisition encore actif.
+        :param name: Nom du segment (par défaut `NAME`)
+        :param capacity: Nombre de vitesses gardées (par défaut `CAPACITY`)
+        :return: Le nouveau `SharedChannel`
+        """
+        name = name or SharedChannel.NAME
+        capacity = capacity or SharedChannel.CAPACITY
+        size = SharedChannel.DATA_OFFSET + 16 * capacity
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            old = cls._open(name)
+            try:
+                old_channel = cls(old, owner=False)
+            except ValueError:
+                old_channel = None
+            if old_channel is not None and old_channel.is_alive():
+                old_channel.close()
+                raise RuntimeError("Une acquisition publie déjà dans {} (pid {})"
+                                   .format(name, old_channel.pid))
+            logger.warning("SHARED", "Remplacement de la mémoire partagée {} abandonnée", name)
+            if old_channel is not None:
+                old_channel.close()
+            else:
+                old.close()
+            old.unlink()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        SharedChannel.HEADER.pack_into(shm.buf, 0, SharedChannel.MAGIC, SharedChannel.VERSION,
+                                       capacity, os.getpid())
+        channel = cls(shm, owner=True)
+        channel.beat()
+        logger.info("SHARED", "Vitesses publiées dans la mémoire partagée {}", name)
+        return channel
+
+    @classmethod
+    def attach(cls, name=None):
+        """
+        Ouvre le canal d'un processus d'acquisition (dans le GUI).
+        :param name: Nom du segment (par défaut `NAME`)
+        :return: Le `SharedChannel`, ou None si il n'existe pas
+        """
+        try:
+            return cls(cls._open(name or SharedChannel.NAME), owner=False)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @classmethod
+    def is_running(cls, name=None):
+        """
+        :return: Vrai si un processus d'acquisition publie dans le canal `name`
+        """
+        channel = cls.attach(name)
+        if channel is None:
+            return False
+        try:
+            return channel.is_alive()
+        finally:
+            channel.close()
+
+    @classmethod
+    def stop_running(cls, name=None):
+        """
+        Demande l'arrêt du processus d'acquisition qui publie dans le canal `name`.
+        :return: Vrai si un processus d'acquisition publiait dans le canal
+        """
+        channel = cls.attach(name)
+        if channel is None:
+            return False
+        try:
+            channel.request_stop()
+            return channel.is_alive()
+        finally:
+            channel.close()
+
+    def request_stop(self):
+        """
+        Demande au processus d'acquisition de s'arrêter (voir `stop_requested`).
+        """
+        SharedChannel.STOP.pack_into(self.shm.buf, SharedChannel.STOP_OFFSET, 1)
+
+    def stop_requested(self):
+        """
+        :return: Vrai si l'arrêt du processus d'acquisition a été demandé
+        """
+        return bool(SharedChannel.STOP.unpack_from(self.shm.buf, SharedChannel.STOP_OFFSET)[0])
+
+    # Écriture (processus d'acquisition)
+
+    def beat(self):
+        """
+        Met à jour le battement de cœur (voir `is_alive`).
+        """
+        SharedChannel.HEARTBEAT.pack_into(self.shm.buf, SharedChannel.HEARTBEAT_OFFSET,
+                                          int(time.time() * 1000))
+
+    def publish_speed(self, speed, ts):
+        """
+        Publie une vitesse (même signature que `on_new_speed` de `SpeedAcquisition`).
+        :param speed: Vitesse
+        :param ts: Millitimestamp de la vitesse
+        """
+        with self._lock:
+            slot = self._count % self.capacity
+            self._times[slot] = ts
+            self._speeds[slot] = speed
+            self._count += 1
+            SharedChannel.COUNT.pack_into(self.shm.buf, SharedChannel.COUNT_OFFSET, self._count)
+
+    def _write_status(self):
+        """
+        Écrit l'état entre deux incréments du compteur de séquence. Le verrou doit être pris.
+        """
+        state, error_count, error_ts, error = self._status
+        buf = self.shm.buf
+        self._sequence += 1
+        SharedChannel.SEQUENCE.pack_into(buf, SharedChannel.SEQUENCE_OFFSET, self._sequence)
+        SharedChannel.STATUS.pack_into(buf, SharedChannel.STATUS_OFFSET,
+                                       state.encode('utf-8')[:16], error_count, error_ts,
+                                       error.encode('utf-8')[:184])
+        self._sequence += 1
+        SharedChannel.SEQUENCE.pack_into(buf, SharedChannel.SEQUENCE_OFFSET, self._sequence)
+
+    def publish_state(self, state):
+        """
+        Publie l'état du superviseur (même signature que `on_state`).
+        """
+        with self._lock:
+            self._status[0] = state
+            self._write_status()
+
+    def publish_error(self, error):
+        """
+        Publie une erreur (même signature que `on_error`).
+        """
+        with self._lock:
+            self._status[1] += 1
+            self._status[2] = int(time.time() * 1000)
+            self._status[3] = error
+            self._write_status()
+
+    def callbacks(self):
+        """
+        :return: Les fonctions de rappel à passer à `SpeedAcquisition`
+        """
+        return {'on_new_speed': self.publish_speed, 'on_error': self.publish_error,
+                'on_state': self.publish_state}
+
+    # Lecture (GUI)
+
+    @property
+    def count(self):
+        """
+        :return: Le nombre total de vitesses publiées
+        """
+        return SharedChannel.COUNT.unpack_from(self.shm.buf, SharedChannel.COUNT_OFFSET)[0]
+
+    def read(self, since):
+        """
+        Lit les vitesses publiées depuis la `since`ième, directement dans la mémoire partagée.
+        :param since: Nombre de vitesses déjà lues (`count` lors de la lecture précédente)
+        :return: (liste des (temps, vitesse) dans l'ordre, nouveau `since`, nombre de vitesses
+                 écrasées avant d'avoir été lues)
+        """
+        count = self.count
+        if since > count:
+            # Nouveau processus d'acquisition : on repart du début
+            since = 0
+        first = max(since, count - self.capacity)
+        samples = [(self._times[index % self.capacity], self._speeds[index % self.capacity])
+                   for index in range(first, count)]
+        # Les cases réécrites pendant la lecture sont retirées, ainsi que celle que l'écrivain
+        # est peut-être en train de remplir (la case `count` n'est comptée qu'après son écriture)
+        overwritten = self.count + 1 - self.capacity
+        if overwritten > first:
+            samples = samples[overwritten - first:]
+            first = overwritten
+        return samples, count, first - since
+
+    def status(self):
+        """
+        :return: (état, nombre d'erreurs, millitimestamp de la dernière erreur, message de la
+                 dernière erreur)
+        """
+        buf = self.shm.buf
+        for _ in range(SharedChannel.MAX_STATUS_ATTEMPTS):
+            before = SharedChannel.SEQUENCE.unpack_from(buf, SharedChannel.SEQUENCE_OFFSET)[0]
+            state, error_count, error_ts, error = SharedChannel.STATUS.unpack_from(
+                buf, SharedChannel.STATUS_OFFSET)
+            after = SharedChannel.SEQUENCE.unpack_from(buf, SharedChannel.SEQUENCE_OFFSET)[0]
+            if not before % 2 and before == after:
+                break
+            # Écriture en cours : on laisse le processus d'acquisition la terminer
+            time.sleep(0.001)
+        return (state.rstrip(b'\0').decode('utf-8', 'replace'), error_count, error_ts,
+                error.rstrip(b'\0').decode('utf-8', 'replace'))
+
+    def is_alive(self, timeout_ms=None):
+        """
+        :param timeout_ms: Temps maximum depuis le dernier battement de cœur
+                           (par défaut `ALIVE_TIMEOUT_MS`)
+        :return: Vrai si le processus d'acquisition a donné signe de vie récemment
+        """
+        heartbeat = SharedChannel.HEARTBEAT.unpack_from(self.shm.buf,
+                                                        SharedChannel.HEARTBEAT_OFFSET)[0]
+        timeout_ms = SharedChannel.ALIVE_TIMEOUT_MS if timeout_ms is None else timeout_ms
+        return time.time() * 1000 - heartbeat <= timeout_ms
+
+    def close(self):
+        """
+        Ferme le canal. Le processus qui l'a créé supprime aussi le segment.
+        """
+        self._times.release()
+        self._speeds.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class ChannelService:
+    """
+    Service du processus d'acquisition (pour `run_headless`) : exécute une `SpeedAcquisition`
+    dont les fonctions de rappel publient dans un `SharedChannel`, et entretient le battement
+    de cœur du canal.
+    """
+    HEARTBEAT_INTERVAL_MS = 500
+
+    def __init__(self, channel, service):
+        """
+        Crée une nouvelle instance de `ChannelService`
+        :param channel: `SharedChannel` créé par ce processus
+        :param service: Acquisition créée avec `channel.callbacks()`
+        """
+        self.channel = channel
+        self.service = service
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _heartbeat_loop(self):
+        while not self._stop_event.wait(ChannelService.HEARTBEAT_INTERVAL_MS / 1000):
+            self.channel.beat()
+
+    def start(self):
+        """
+        Démarre l'acquisition et le battement de cœur.
+        """
+        self.service.start()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._heartbeat_loop, name="ChannelHeartbeat",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Arrête l'acquisition (les vitesses bufferisées sont écrites) puis supprime le canal.
+        """
+        self.service.stop()
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.channel.close()
+
+
+def launch_acquisition_process(script, argument='--acquisition-process'):
+    """
+    Lance le processus d'acquisition détaché du processus courant : il continue après la
+    fermeture du GUI. Il s'arrête avec `SharedChannel.stop_running` (ou SIGTERM hors Windows,
+    pid dans `SharedChannel.pid`).
+    Dans l'exécutable cx_Freeze, `sys.executable` est l'application elle-même : elle est
+    relancée avec `argument`, sans `script`.
+    :param script: Chemin du script à lancer (`main.py`)
+    :param argument: Argument qui lance le mode processus d'acquisition
+    :return: Le pid du processus lancé
+    """
+    if getattr(sys, 'frozen', False):
+        command = [sys.executable, argument]
+    else:
+        command = [sys.executable, script, argument]
+    kwargs = {}
+    if os.name == 'nt':
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | \
+            subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+    process = subprocess.Popen(command, cwd=os.getcwd(),
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, **kwargs)
+    logger.info("SHARED", "Processus d'acquisition lancé (pid {})", process.pid)
+    return process.pid
@@ -1,187 +1,237 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from datetime import datetime
-import locale
-from PyQt5.QtCore import pyqtSignal, QThread
-from random import randint
-import socket
-import time
-
-from objct.automate_command import CONNECT, GET_SPEED
-from objct.base_de_donnee import Database
+from collections import deque
+import threading
+
+from PyQt5.QtCore import pyqtSignal, QObject, QThread, QTimer
+
+from objct.acquisition import SpeedAcquisition, SpeedAcquisitionSimulator
 from objct.logger import logger
+from objct.shared_channel import SharedChannel
+
+
+class SpeedBatch(QObject):
+    """
+    Vitesses reçues par l'acquisition, en attente d'affichage par le GUI (voir
+    `MainWindow.watch_signals`). `NEW_SPEEDS_SIGNAL` n'est émis que quand le lot était vide :
+    tant que le GUI n'a pas pris le lot (`take`), les vitesses suivantes s'y ajoutent sans
+    nouveau signal. Il n'y a donc jamais plus d'un signal en attente dans la queue de Qt.
+    """
+    NEW_SPEEDS_SIGNAL = pyqtSignal()
+    MAX_SPEEDS = 1000  # Nombre maximum de vitesses gardées si le GUI ne les prend pas (les plus
+                       # anciennes sont abandonnées)
+
+    def __init__(self):
+        """
+        Crée une nouvelle instance de `SpeedBatch` (dans le thread du GUI)
+        """
+        QObject.__init__(self)
+        self._speeds = deque(maxlen=SpeedBatch.MAX_SPEEDS)
+        self._lock = threading.Lock()  # Les vitesses sont ajoutées par le thread d'acquisition
+
+    def add(self, speed, ts):
+        """
+        Ajoute une vitesse au lot (même signature que `on_new_speed` de `SpeedAcquisition`).
+        :param speed: Vitesse écrite dans la base de données
+        :param ts: Millitimestamp de la vitesse
+        """
+        self.extend(((speed, ts),))
+
+    def extend(self, speeds):
+        """
+        Ajoute plusieurs vitesses au lot avec un seul signal.
+        :param speeds: Liste de (vitesse, millitimestamp)
+        """
+        with self._lock:
+            was_empty = not self._speeds
+            self._speeds.extend(speeds)
+            emit = was_empty and self._speeds
+        if emit:
+            self.NEW_SPEEDS_SIGNAL.emit()
+
+    def take(self):
+        """
+        Retire toutes les vitesses du lot.
+        :return: Liste de (vitesse, millitimestamp), de la plus ancienne à la plus récente
+        """
+        with self._lock:
+            speeds = list(self._speeds)
+            self._speeds.clear()
+        return speeds
 
 
 class SpeedThread(QThread):
     """
-    Thread qui se charge de se connecter à l'automate et de communiquer avec lui.
-    S'occupe de récupérer les nouvelles vitesses et de les insérer dans la base de données.
+    QThread qui exécute une `SpeedAcquisition` pour le GUI : les fonctions de rappel de
+    l'acquisition émettent les signaux Qt, transmis par Qt au thread du GUI. Les vitesses sont
+    transmises par lots (`speeds`).
     """
-    SLEEP_TIME_MS = 240
-    SLEEP_ON_ERROR_MS = 1000
-    NEW_SPEED_SIGNAL = pyqtSignal('unsigned long long', 'unsigned long long')
+    ACQUISITION_CLASS = SpeedAcquisition  # Classe de la boucle d'acquisition
     ERROR_SIGNAL = pyqtSignal('QString')
+    STATE_SIGNAL = pyqtSignal('QString')
 
-    def __init__(self, automate_ip, automate_port, db_location):
+    def __init__(self, automate_ip, automate_port, db_location, **kwargs):
         """
         Crée une nouvelle instance de SpeedThread
+        :param kwargs: Paramètres passés à `SpeedAcquisition` (db_batch_size, tags, ...)
         """
         QThread.__init__(self)
-        self.socket = None
-        self.db = None
-        self.automate_ip = automate_ip
-        self.automate_port = automate_port
-        self.db_location = db_location
-
-    def _init_socket(self):
-        """
-        Crée une nouvelle socket (et ferme la socket courante si il y en a une) et connecte la
-        à l'automate.
-        """
-        logger.log("SPEED_THREAD", "Initialization de la socket")
-        if self.socket:
-            logger.log("SPEED_THREAD", "Socket déjà initialisée, fermeture de la socket")
-            self.socket.close()
-        logger.log("SPEED_THREAD", "Création d'une socket")
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        logger.log("SPEED_THREAD", "Connexion à {}:{}"
-                   .format(self.automate_ip, self.automate_port))
-        self.socket.connect((self.automate_ip, self.automate_port))
-
-    def _send_to_automate(self, command):
-        """
-        Envoi une commande à l'automate
-        :param command: Commande a envoyer à l'automate
-        """
-        logger.log("SPEED_THREAD", 'Envoi de la commande {} ({})'
-                   .format(command.description, command.hex))
-        self.socket.sendall(command.binary)
-
-    def _receive_from_automate(self):
-        """
-        Attends un message de l'automate
-        :return: Retourne le message reçu de l'automate. Retourne un string vide si rien n'a
-                 été reçu.
-        """
-        response = self.socket.recv(1024)
-        logger.log("SPEED_THREAD", "Reçu de l'automate: {}".format(response))
-        return response
-
-    def _connect(self):
-        """
-        Initialise la connexion à l'automate
-        """
-        self._init_socket()  # Création de la socket
-        self._send_to_automate(CONNECT)  # Envoi du message initial de connexion
-        response = self._receive_from_automate()
-        # L'automate est supposé retourner un message non vide si la connexion est correctement
-        # établie.
-        if not response:
-            raise Exception("Réponse invalide après tentative de connexion à l'automate: {}"
-                            .format(response))
-
-    def _get_speed(self):
-        """
-        Récupère la vitesse courante de l'automate.
-        :return: la vitesse de l'automate.
-        """
-        self._send_to_automate(GET_SPEED)
-        response = self._receive_from_automate()
-        if not response:
-            raise Exception("Réponse invalide après tentative de récupération de "
-                            "la vitesse de l'automate: {}"
-                            .format(response))
-        mondon_speed = int.from_bytes(response[-4:], byteorder="big")
-        logger.log("SPEED_THREAD", "Nouvelle vitesse reçue: {}".format(mondon_speed))
-        return mondon_speed
-
-    @staticmethod
-    def timestamp_to_date(millitimestamp):
-        """
-        Utilitaire pour convertir un millitimestamp en date + heure.
-        :param millitimestamp: le millitimestamp à convertir
-        :return: Un string au format
-                 "<années>:<mois>:<jours> <heures>:<minutes>:<secondes>.<millisecondes>"
-                 ou "????-??-?? ??:??:??" en cas d'erreur.
-        """
-        ts = millitimestamp / 1000
-        try:
-            locale.setlocale(locale.LC_TIME, '')
-            return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S.%f')
-        except:
-            return '????-??-?? ??:??:??'
-
-    def _save_speed(self, ts, speed):
-        """
-        Gère l'insertion de la nouvelle vitesse dans la base de données et signal le résultat.
-        :param speed_value: Nouvelle vitesse
-        :param ts: Millitimestamp de quand on a reçu la vitesse
-        """
-        logger.log("SPEED_THREAD", "Insert vitesse {} au temps {}"
-                   .format(speed, SpeedThread.timestamp_to_date(ts)))
-        try:
-            self.db.insert_speed(speed, ts)
-            self.NEW_SPEED_SIGNAL.emit(speed, ts)
-        except Exception as e:
-            self.ERROR_SIGNAL.emit(str(e))
-            logger.log("SPEED_THREAD", "Erreur lors de l'insertion dans la base de données: {}"
-                       .format(e))
+        self.speeds = SpeedBatch()
+        self.acquisition = self.ACQUISITION_CLASS(automate_ip, automate_port, db_location,
+                                                  on_new_speed=self.speeds.add,
+                                                  on_error=self.ERROR_SIGNAL.emit,
+                                                  on_state=self.STATE_SIGNAL.emit, **kwargs)
 
     def run(self):
         """
         Méthode principale qui sera exécuter sur un nouveau thread.
-        Se charge d'établir une connexion à l'automate et de récupérer la vitesse courante
-        toutes les `SLEEP_TIME_MS` millisecondes.
-        En cas d'erreur, un pause de `SLEEP_ON_ERROR_MS` millisecondes est prise avant de
-        recommencer (depuis le début, création de la connexion incluse).
-        """
-        self.db = Database(self.db_location)
-        try:
-            self._connect()
-            while True:
-                # Récupération de la vitesse
-                ts_before = time.time()
-                mondon_speed = self._get_speed()
-
-                # Sauvegarde la nouvelle vitesse
-                ts = int(round(time.time() * 1000))
-                self._save_speed(ts, mondon_speed)
-
-                # Calcule combien de temps on a mis à récupérer et sauvegarder la vitesse
-                ts_after = time.time()
-                delay = ts_after - ts_before
-
-                # Pause pendant SpeedThread.SLEEP_TIME_MS (moins le temps qu'il a fallu pour
-                # récupérer la vitesse et la sauvegarder dans la base de données).
-                self.msleep(max(0, SpeedThread.SLEEP_TIME_MS - delay))
-        except Exception as e:
-            self.ERROR_SIGNAL.emit(str(e))
-            logger.log("SPEED_THREAD", "Erreur: {}".format(e))
-            self.msleep(SpeedThread.SLEEP_ON_ERROR_MS)
-            self.run()
+        """
+        self.acquisition.run()
+
+    def stop(self):
+        """
+        Demande l'arrêt du thread et attend qu'il se termine. Les vitesses bufferisées sont
+        écrites dans la base de données avant l'arrêt.
+        """
+        self.acquisition.stop()
+        self.wait()
 
 
 class SpeedThreadSimulator(SpeedThread):
     """
-    Thread qui hérite de SpeedThread et qui redéfinit les fonctions `_connect` et `_get_speed`
-    pour simuler l'automate en locale.
+    SpeedThread qui simule l'automate en locale (voir `SpeedAcquisitionSimulator`).
+    """
+    ACQUISITION_CLASS = SpeedAcquisitionSimulator
+
+
+class EngineSignals(QObject):
+    """
+    Signaux Qt équivalents à ceux de `SpeedThread` pour `AcquisitionEngine`.
+    Les méthodes `handle_*` sont passées comme callbacks à `AcquisitionEngine` : elles sont
+    appelées depuis les threads de l'engine et Qt transmet les signaux au thread du GUI.
+    Les vitesses de toutes les machines sont transmises par lots (`speeds`).
     """
-    def _connect(self):
+    ERROR_SIGNAL = pyqtSignal('QString')
+    STATUS_SIGNAL = pyqtSignal('QString', 'QString', 'QString')
+
+    def __init__(self):
         """
-        Simule la connexion à l'automate. Ne fait rien à part un log.
+        Crée une nouvelle instance de `EngineSignals` (dans le thread du GUI)
         """
-        logger.log("SPEED_THREAD", "Simulation d'une connexion à l'automate")
+        QObject.__init__(self)
+        self.speeds = SpeedBatch()
 
-    def _get_speed(self):
+    def handle_new_speed(self, speed, ts):
         """
-        Simule la récupération d'une nouvelle vitesse en générant une valeur aléatoire.
-        Simule une erreur de manière aléatoire 1% du temps.
-        :return:
+        :param speed: Vitesse écrite dans la base de données
+        :param ts: Millitimestamp de la vitesse
+        """
+        self.speeds.add(speed, ts)
+
+    def handle_error(self, error):
         """
-        if randint(0, 100) == 1:
-            raise Exception("Simulation d'une erreur!!")
-        random_speed = randint(0, 185)
-        logger.log("SPEED_THREAD", "Génération d'une vitesse aléatoire ({})"
-                   .format(random_speed))
-        return random_speed
+        :param error: Message d'erreur
+        """
+        self.ERROR_SIGNAL.emit(error)
+
+    def handle_status(self, machine, state, speed):
+        """
+        :param machine: Nom de la machine
+        :param state: État du superviseur de la machine
+        :param speed: Dernière vitesse lue (ou None)
+        """
+        self.STATUS_SIGNAL.emit(machine, state, '' if speed is None else str(speed))
+
+
+class SharedChannelWatcher(QObject):
+    """
+    Lit le `SharedChannel` publié par le processus d'acquisition et émet les mêmes signaux que
+    `SpeedThread` (les vitesses lues en une fois forment un seul lot). La lecture est faite par
+    un QTimer dans le thread du GUI : rien n'est envoyé au processus d'acquisition, qui continue
+    si le GUI est bloqué ou fermé. Si le processus d'acquisition s'arrête, le canal est rouvert
+    dès qu'un nouveau processus le publie.
+    """
+    ERROR_SIGNAL = pyqtSignal('QString')
+    STATE_SIGNAL = pyqtSignal('QString')
+    POLL_INTERVAL_MS = 100  # Temps entre deux lectures du canal
+
+    def __init__(self, name=None):
+        """
+        Crée une nouvelle instance de `SharedChannelWatcher`
+        :param name: Nom du canal (par défaut `SharedChannel.NAME`)
+        """
+        QObject.__init__(self)
+        self.name = name
+        self.speeds = SpeedBatch()
+        self.channel = None
+        self._since = 0  # Nombre de vitesses du canal déjà lues
+        self._state = None
+        self._error_count = 0
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.poll)
+
+    def start(self):
+        """
+        Démarre la lecture périodique du canal.
+        """
+        self.poll()
+        self._timer.start(SharedChannelWatcher.POLL_INTERVAL_MS)
+
+    def stop(self):
+        """
+        Arrête la lecture et ferme le canal. Le processus d'acquisition continue.
+        """
+        self._timer.stop()
+        self._close()
+
+    def _close(self):
+        if self.channel:
+            self.channel.close()
+            self.channel = None
+
+    def _open(self):
+        """
+        Ouvre le canal si un processus d'acquisition le publie.
+        :return: Vrai si le canal est ouvert
+        """
+        channel = SharedChannel.attach(self.name)
+        if channel is None or not channel.is_alive():
+            if channel:
+                channel.close()
+            if self._state != SharedChannel.STATE_NO_ACQUISITION:
+                self._state = SharedChannel.STATE_NO_ACQUISITION
+                self.ERROR_SIGNAL.emit("Pas de processus d'acquisition")
+                self.STATE_SIGNAL.emit(self._state)
+            return False
+        logger.info("SHARED", "Lecture du processus d'acquisition {}", channel.pid)
+        self.channel = channel
+        # Seule la dernière vitesse déjà publiée est affichée
+        self._since = max(0, channel.count - 1)
+        self._error_count = channel.status()[1]
+        return True
+
+    def poll(self):
+        """
+        Émet les signaux des vitesses, de l'état et des erreurs publiés depuis la dernière
+        lecture.
+        """
+        if self.channel is None and not self._open():
+            return
+        if not self.channel.is_alive():
+            logger.warning("SHARED", "Le processus d'acquisition {} ne répond plus",
+                           self.channel.pid)
+            self._close()
+            self._open()
+            return
+        samples, self._since, lost = self.channel.read(self._since)
+        if lost:
+            logger.warning("SHARED", "{} vitesses publiées n'ont pas été lues", lost)
+        self.speeds.extend([(int(speed), ts) for ts, speed in samples])
+        state, error_count, _, error = self.channel.status()
+        if state and state != self._state:
+            self._state = state
+            self.STATE_SIGNAL.emit(state)
+        if error_count != self._error_count:
+            self._error_count = error_count
+            self.ERROR_SIGNAL.emit(error)
@@ -0,0 +1,369 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import struct
+import threading
+
+from objct.backoff import Backoff
+from objct.base_de_donnee import Database
+from objct.logger import logger
+from objct.metrics import metrics
+
+
+SPOOL_PENDING = metrics.gauge('spool_pending_records',
+                              "Nombre de valeurs du spool pas encore écrites dans la base de données")
+
+
+class Spool:
+    """
+    Fichier tampon en ajout seul, projeté en mémoire (mmap), où l'acquisition dépose les valeurs
+    lues avant qu'elles soient écrites dans la base de données par `SpoolDrainer`.
+    Déposer une valeur revient à copier un enregistrement de taille fixe dans la projection : ça
+    ne dépend jamais de la base de données, et les valeurs survivent à un arrêt brutal du
+    programme (le système écrit la projection sur le disque).
+
+    Format du fichier :
+    - en-tête (`HEADER`) : signature, version, nombre de séries, index de lecture et d'écriture
+    - table des séries : `MAX_SERIES` noms de `SERIES_NAME_SIZE` octets (vitesse ou machine/tag)
+    - à partir de `DATA_OFFSET`, les enregistrements (`RECORD`) : temps, valeur, numéro de série
+    Les enregistrements entre l'index de lecture et l'index d'écriture restent à écrire dans la
+    base de données. Quand tout a été écrit, les deux index reviennent à 0 : le fichier ne grossit
+    que pendant une panne de la base de données (sa taille est doublée quand il est plein).
+    """
+    MAGIC = b'MSPL'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHQQ')  # Signature, version, nombre de séries, lecture, écriture
+    RECORD = struct.Struct('<qdH6x')  # Millitimestamp, valeur, numéro de série (24 octets)
+    MAX_SERIES = 64  # Nombre maximum de séries différentes (vitesse + tags)
+    SERIES_NAME_SIZE = 64  # Taille maximum du nom d'une série en octets (UTF-8)
+    DATA_OFFSET = 8192  # Position du premier enregistrement
+    INITIAL_CAPACITY = 65536  # Nombre d'enregistrements à la création du fichier (1.5 Mo)
+    TAG_SEPARATOR = '\t'  # Sépare la machine et le tag dans le nom d'une série
+
+    def __init__(self, path, initial_capacity=None):
+        """
+        Crée une nouvelle instance de `Spool` et ouvre (ou crée) le fichier.
+        :param path: Chemin du fichier
+        :param initial_capacity: Nombre d'enregistrements à la création du fichier
+                                 (par défaut `INITIAL_CAPACITY`)
+        """
+        self.path = path
+        self.initial_capacity = initial_capacity or Spool.INITIAL_CAPACITY
+        self._lock = threading.Lock()
+        self._series = []  # Numéro -> clé (`Database.SPEED_KEY` ou (machine, tag))
+        self._series_ids = {}  # Clé -> numéro
+        exists = os.path.exists(path) and os.path.getsize(path) >= Spool.DATA_OFFSET
+        self._file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self._file.truncate(self._size_for(self.initial_capacity))
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        if exists:
+            self._load()
+        else:
+            self._read_index = self._write_index = 0
+            self._write_header()
+        logger.info("DATABASE", "Spool {} ouvert, {} valeurs en attente", path, self.pending)
+
+    @staticmethod
+    def _size_for(capacity):
+        """
+        :return: La taille du fichier pour `capacity` enregistrements
+        """
+        return Spool.DATA_OFFSET + capacity * Spool.RECORD.size
+
+    @property
+    def capacity(self):
+        """
+        :return: Le nombre d'enregistrements que le fichier peut contenir sans grossir
+        """
+        return (len(self._map) - Spool.DATA_OFFSET) // Spool.RECORD.size
+
+    @property
+    def pending(self):
+        """
+        :return: Le nombre d'enregistrements qui restent à écrire dans la base de données
+        """
+        return self._write_index - self._read_index
+
+    def _load(self):
+        """
+        Lit l'en-tête et la table des séries d'un fichier existant.
+        """
+        magic, version, series_count, self._read_index, self._write_index = \
+            Spool.HEADER.unpack_from(self._map, 0)
+        if magic != Spool.MAGIC or version != Spool.VERSION:
+            raise ValueError("{} n'est pas un spool (version {})".format(self.path, Spool.VERSION))
+        for series_id in range(series_count):
+            offset = Spool.HEADER.size + series_id * Spool.SERIES_NAME_SIZE
+            name = bytes(self._map[offset:offset + Spool.SERIES_NAME_SIZE]).rstrip(b'\0')
+            self._register(self._decode_key(name.decode('utf-8')))
+        if not self.pending and self.capacity > self.initial_capacity:
+            # Rien en attente : le fichier qui avait grossi pendant une panne reprend sa taille
+            self._resize(self.initial_capacity)
+
+    def _write_header(self):
+        """
+        Écrit l'en-tête (les index) dans la projection.
+        """
+        Spool.HEADER.pack_into(self._map, 0, Spool.MAGIC, Spool.VERSION, len(self._series),
+                               self._read_index, self._write_index)
+
+    @staticmethod
+    def _encode_key(key):
+        """
+        :return: Le nom de la série de la clé `key`
+        """
+        return key if key == Database.SPEED_KEY else Spool.TAG_SEPARATOR.join(key)
+
+    @staticmethod
+    def _decode_key(name):
+        """
+        :return: La clé de la série `name`
+        """
+        if name == Database.SPEED_KEY:
+            return name
+        return tuple(name.split(Spool.TAG_SEPARATOR, 1))
+
+    def _register(self, key):
+        """
+        Ajoute une série à la table des séries en mémoire.
+        :return: Le numéro de la série
+        """
+        series_id = len(self._series)
+        self._series.append(key)
+        self._series_ids[key] = series_id
+        return series_id
+
+    def _series_id(self, key):
+        """
+        :return: Le numéro de la série `key`, ajoutée à la table du fichier si besoin
+        """
+        series_id = self._series_ids.get(key)
+        if series_id is not None:
+            return series_id
+        if len(self._series) >= Spool.MAX_SERIES:
+            raise ValueError("Trop de séries dans le spool (maximum {})".format(Spool.MAX_SERIES))
+        name = Spool._encode_key(key).encode('utf-8')
+        if len(name) > Spool.SERIES_NAME_SIZE:
+            raise ValueError("Nom de série trop long: {}".format(name))
+        series_id = self._register(key)
+        offset = Spool.HEADER.size + series_id * Spool.SERIES_NAME_SIZE
+        self._map[offset:offset + Spool.SERIES_NAME_SIZE] = name.ljust(Spool.SERIES_NAME_SIZE,
+                                                                       b'\0')
+        return series_id
+
+    def _resize(self, capacity):
+        """
+        Change la taille du fichier et refait la projection.
+        """
+        self._map.close()
+        self._file.truncate(self._size_for(capacity))
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def _append(self, key, ts, value):
+        """
+        Ajoute un enregistrement (le verrou doit être pris).
+        """
+        series_id = self._series_id(key)
+        if self._write_index >= self.capacity:
+            logger.warning("DATABASE", "Spool plein ({} valeurs en attente), agrandissement",
+                           self.pending)
+            self._resize(self.capacity * 2)
+        Spool.RECORD.pack_into(self._map, Spool.DATA_OFFSET + self._write_index * Spool.RECORD.size,
+                               ts, value, series_id)
+        self._write_index += 1
+
+    def append_speed(self, ts, speed):
+        """
+        Dépose une vitesse.
+        :param ts: Millitimestamp de la vitesse
+        :param speed: Valeur de la vitesse
+        """
+        with self._lock:
+            self._append(Database.SPEED_KEY, ts, speed)
+            self._write_header()
+
+    def append_tags(self, ts, values, machine=None):
+        """
+        Dépose les valeurs d'un ensemble de tags lus au même moment.
+        :param ts: Millitimestamp des valeurs
+        :param values: Dictionnaire nom du tag -> valeur
+        :param machine: Nom de la machine (par défaut `Database.DEFAULT_MACHINE`)
+        """
+        machine = machine or Database.DEFAULT_MACHINE
+        with self._lock:
+            for tag, value in values.items():
+                self._append((machine, tag), ts, value)
+            self._write_header()
+
+    def read(self, max_records):
+        """
+        Lit les plus anciens enregistrements en attente, sans les retirer (voir `consume`).
+        :param max_records: Nombre maximum d'enregistrements à lire
+        :return: Liste de (clé, temps, valeur)
+        """
+        with self._lock:
+            count = min(max_records, self.pending)
+            records = []
+            for index in range(self._read_index, self._read_index + count):
+                ts, value, series_id = Spool.RECORD.unpack_from(
+                    self._map, Spool.DATA_OFFSET + index * Spool.RECORD.size)
+                records.append((self._series[series_id], ts, value))
+            return records
+
+    def consume(self, count):
+        """
+        Retire les `count` plus anciens enregistrements, une fois écrits dans la base de données.
+        """
+        with self._lock:
+            self._read_index = min(self._read_index + count, self._write_index)
+            if self._read_index == self._write_index:
+                self._read_index = self._write_index = 0
+            self._write_header()
+
+    def sync(self):
+        """
+        Force l'écriture de la projection sur le disque (protège aussi d'une coupure de courant).
+        """
+        with self._lock:
+            self._map.flush()
+
+    def close(self):
+        """
+        Écrit la projection sur le disque et ferme le fichier.
+        """
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+
+
+class SpoolDrainer:
+    """
+    Thread qui écrit dans la base de données les valeurs déposées dans un `Spool`.
+    Les enregistrements ne sont retirés du spool qu'une fois la transaction validée : si la base
+    de données est verrouillée ou indisponible, ils restent dans le spool et sont réécrits dès
+    que possible (aussi au prochain démarrage). Un enregistrement réécrit après un arrêt brutal
+    entre la transaction et le retrait est ignoré par `mondon_speed` (INSERT OR IGNORE) et par
+    `mondon_speed_rollup` (les vitesses qui ne sont pas plus récentes que la dernière vitesse
+    écrite ne sont pas agrégées).
+    """
+    BATCH_SIZE = 1000  # Nombre maximum d'enregistrements écrits par transaction
+    INTERVAL_MS = 2000  # Temps entre deux écritures
+    SLEEP_ON_ERROR_MS = 1000  # Temps d'attente après la première erreur d'écriture, doublé
+                              # à chaque échec consécutif jusqu'à MAX_SLEEP_ON_ERROR_MS
+    MAX_SLEEP_ON_ERROR_MS = 30000
+
+    def __init__(self, spool, db_location, on_new_speed=None, on_error=None, interval_ms=None,
+                 **db_kwargs):
+        """
+        Crée une nouvelle instance de `SpoolDrainer`
+        :param spool: `Spool` à vider
+        :param db_location: Chemin du fichier contenant la base de données
+        :param on_new_speed: Fonction appelée avec (vitesse, temps) une fois la vitesse écrite
+        :param on_error: Fonction appelée avec le message d'erreur en cas d'erreur d'écriture
+        :param interval_ms: Temps entre deux écritures (par défaut `INTERVAL_MS`)
+        :param db_kwargs: Paramètres passés à `Database` (storage_policy, partitioning, ...)
+        """
+        self.spool = spool
+        self.db_location = db_location
+        self.on_new_speed = on_new_speed
+        self.on_error = on_error
+        self.interval_ms = interval_ms or SpoolDrainer.INTERVAL_MS
+        self.db_kwargs = db_kwargs
+        self.backoff = Backoff(initial_ms=SpoolDrainer.SLEEP_ON_ERROR_MS,
+                               max_ms=SpoolDrainer.MAX_SLEEP_ON_ERROR_MS)
+        self.drained_count = 0  # Nombre d'enregistrements écrits dans la base de données
+        self._unconfirmed = 0  # Enregistrements transmis à `Database` mais pas encore écrits
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Démarre le thread d'écriture.
+        """
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="SpoolDrainer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Écrit les valeurs en attente (si la base de données est disponible) et arrête le thread.
+        """
+        if self._thread:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def _handle_durable_speeds(self, durable_speeds):
+        """
+        Signal les vitesses qui ont été écrites dans la base de données.
+        :param durable_speeds: Liste de (value, time) écrites dans la base de données
+        """
+        if self.on_new_speed:
+            for speed, ts in durable_speeds:
+                self.on_new_speed(speed, ts)
+
+    def drain(self, db):
+        """
+        Écrit tous les enregistrements en attente, par transactions de `BATCH_SIZE`.
+        Lève une exception si une transaction échoue (les enregistrements restent dans le spool).
+        :param db: `Database` du thread d'écriture
+        """
+        self.spool.sync()
+        while True:
+            if self._unconfirmed:
+                # Enregistrements du lot précédent, toujours dans le buffer de `Database`
+                self._handle_durable_speeds(db.flush())
+                self.spool.consume(self._unconfirmed)
+                self.drained_count += self._unconfirmed
+                self._unconfirmed = 0
+            SPOOL_PENDING.set(self.spool.pending)
+            records = self.spool.read(SpoolDrainer.BATCH_SIZE)
+            if not records:
+                return
+            self._unconfirmed = len(records)
+            speeds = []
+            tags = {}
+            for key, ts, value in records:
+                if key == Database.SPEED_KEY:
+                    speeds.append((ts, int(value) if value.is_integer() else value))
+                else:
+                    tags.setdefault((key[0], ts), {})[key[1]] = value
+            for ts, speed in speeds:
+                # Les tags lus avec la vitesse sont écrits avec elle
+                db.insert_speed(speed, ts, tags.pop((Database.DEFAULT_MACHINE, ts), None))
+            for (machine, ts), values in tags.items():
+                db.insert_tags(ts, values, machine=machine)
+
+    def _run(self):
+        """
+        Boucle du thread d'écriture.
+        """
+        # Les écritures sont déclenchées par `drain` uniquement
+        db = Database(self.db_location, batch_size=2 ** 31, batch_delay_ms=0, **self.db_kwargs)
+        delay_ms = 0
+        while True:
+            stopping = self._stop_event.wait(delay_ms / 1000)
+            try:
+                self.drain(db)
+                self.backoff.reset()
+                delay_ms = self.interval_ms
+            except Exception as e:
+                logger.error("DATABASE", "Erreur lors de l'écriture du spool ({} valeurs en "
+                                         "attente): {}", self.spool.pending, e)
+                if self.on_error:
+                    self.on_error(str(e))
+                delay_ms = self.backoff.next_delay_ms()
+            if stopping:
+                break
+        try:
+            if not self._unconfirmed:
+                db.close()
+            else:
+                # La base de données est indisponible, les valeurs restent dans le spool
+                db.conn.close()
+        except Exception as e:
+            logger.error("DATABASE", "Erreur lors de la fermeture de la base de données: {}", e)
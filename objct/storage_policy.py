@@ -0,0 +1,123 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from objct.rollup import RollupAccumulator
+
+
+class DeadbandPolicy:
+    """
+    Politique de stockage "sur changement" : une valeur n'est écrite que si elle s'écarte de plus
+    de `deadband` de la dernière valeur écrite. Entre deux lignes, la valeur est considérée
+    constante (signal en escalier, voir `iter_steps`).
+    Pour que les trous dans les données restent visibles, deux lignes consécutives ne sont
+    jamais écartées de plus de `heartbeat_ms` tant que les valeurs arrivent :
+    - dès qu'une valeur arrive plus de `heartbeat_ms` après la dernière ligne écrite, la valeur
+      précédente (non écrite) est écrite pour fermer la marche
+    - si la valeur arrive elle même plus de `heartbeat_ms` après la précédente (perte de
+      connexion, ...), elle est écrite aussi
+    Deux lignes écartées de plus de `heartbeat_ms` veulent donc toujours dire qu'il manque des
+    données entre les deux.
+    Avec `deadband` à 0, le signal en escalier relu est exactement celui qui a été lu sur
+    l'automate. Les agrégats de `mondon_speed_rollup` sont calculés sur toutes les valeurs avant
+    ce filtre. Si ils sont reconstruits à partir des lignes écrites (`backfill_rollups`), le
+    min, le max et le temps d'arrêt restent exacts tant que `heartbeat_ms` ne dépasse pas
+    `RollupAccumulator.MAX_GAP_MS`, mais le nombre de vitesses et la moyenne ne le sont plus.
+    """
+    DEADBAND = 0  # Écart minimum avec la dernière valeur écrite pour écrire une nouvelle valeur
+    HEARTBEAT_MS = RollupAccumulator.MAX_GAP_MS  # Écart maximum entre deux lignes écrites
+
+    def __init__(self, deadband=None, heartbeat_ms=None):
+        """
+        Crée une nouvelle instance de `DeadbandPolicy`
+        :param deadband: Écart minimum pour écrire une nouvelle valeur (par défaut `DEADBAND`)
+        :param heartbeat_ms: Écart maximum entre deux lignes écrites (par défaut `HEARTBEAT_MS`)
+        """
+        self.deadband = DeadbandPolicy.DEADBAND if deadband is None else deadband
+        self.heartbeat_ms = heartbeat_ms or DeadbandPolicy.HEARTBEAT_MS
+        self._last_written = {}  # clé -> (temps, valeur) de la dernière ligne écrite
+        self._last_seen = {}  # clé -> (temps, valeur) de la dernière valeur reçue
+        self.seen_count = 0  # Nombre de valeurs reçues
+        self.written_count = 0  # Nombre de lignes à écrire retournées
+
+    def filter(self, key, ts, value):
+        """
+        Applique la politique à une nouvelle valeur.
+        :param key: Identifiant de la série (ex: nom du tag). Chaque série est filtrée séparément.
+        :param ts: Millitimestamp de la valeur
+        :param value: Valeur reçue
+        :return: La liste des (temps, valeur) à écrire : vide, la valeur, ou la valeur
+                 précédente puis la valeur
+        """
+        seen = self._last_seen.get(key)
+        if seen is not None and ts <= seen[0]:
+            # Valeur déjà vue (même timestamp) ou plus ancienne : ignorée comme dans la table
+            return []
+        self.seen_count += 1
+        rows = []
+        written = self._last_written.get(key)
+        if written is not None and ts - written[0] > self.heartbeat_ms and seen[0] > written[0]:
+            # Ferme la marche avec la valeur précédente
+            rows.append(seen)
+            written = seen
+        if written is None or abs(value - written[1]) > self.deadband \
+                or ts - written[0] > self.heartbeat_ms:
+            written = (ts, value)
+            rows.append(written)
+        self._last_written[key] = written
+        self._last_seen[key] = (ts, value)
+        self.written_count += len(rows)
+        return rows
+
+    def pending(self):
+        """
+        Retourne les dernières valeurs reçues qui n'ont pas été écrites (à écrire à l'arrêt pour
+        que la dernière marche se termine au bon moment) et les considère comme écrites.
+        :return: Liste de (clé, temps, valeur)
+        """
+        rows = []
+        for key, seen in self._last_seen.items():
+            if self._last_written.get(key) != seen:
+                self._last_written[key] = seen
+                self.written_count += 1
+                rows.append((key,) + seen)
+        return rows
+
+
+def iter_steps(rows, start, end, max_gap_ms):
+    """
+    Reconstruit un signal en escalier à partir des lignes écrites : chaque valeur est constante
+    jusqu'à la ligne suivante, sauf si celle-ci est à plus de `max_gap_ms` (données manquantes).
+    :param rows: Itérable de (temps, valeur) dans l'ordre chronologique, qui commence par la
+                 dernière ligne avant (ou à) `start` et peut continuer après `end`
+    :param start: Millitimestamp de début (inclus)
+    :param end: Millitimestamp de fin (exclu)
+    :param max_gap_ms: Écart au delà duquel deux lignes consécutives sont séparées par un trou
+    :return: Un générateur de (début, fin, valeur), la valeur étant constante sur [début, fin[.
+             Une valeur isolée (suivie d'un trou) donne une marche de durée nulle.
+    """
+    current = None  # Marche en cours de construction [début, fin, valeur]
+    previous = None
+    for ts, value in rows:
+        if previous is not None:
+            step_end = ts if ts - previous[0] <= max_gap_ms else previous[0]
+            step_start = max(previous[0], start)
+            step_end = min(step_end, end)
+            if step_start < step_end or step_start == step_end == previous[0]:
+                if current is not None and current[1] == step_start and current[2] == previous[1] \
+                        and step_start < step_end:
+                    current[1] = step_end
+                else:
+                    if current is not None:
+                        yield tuple(current)
+                    current = [step_start, step_end, previous[1]]
+        if ts >= end:
+            break
+        previous = (ts, value)
+    else:
+        if previous is not None and previous[0] >= start:
+            if current is None or current[1] != previous[0] or current[2] != previous[1]:
+                if current is not None:
+                    yield tuple(current)
+                current = [previous[0], previous[0], previous[1]]
+    if current is not None:
+        yield tuple(current)
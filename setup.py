@@ -7,7 +7,7 @@ executables = [Executable(
     targetName="Server Mondon.exe"
     )]
 include_files = ["icon", "objct"]
-packages = ["idna"]
+packages = ["idna", "numpy"]  # numpy : objct.analytics (et vues de objct.archive)
 options = {
     'build_exe': {
         'packages': packages,
@@ -0,0 +1,297 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark de la couche de stockage : chaque scénario écrit des vitesses avec `writers` threads
+(chacun avec sa propre `Database`, comme plusieurs programmes sur la même base de données)
+pendant que `readers` threads lisent, sur une base de données temporaire.
+
+Exemple (depuis la racine du dépôt) :
+PYTHONPATH=. python tests/db_benchmark.py --duration 5 --writers 1 4 --batch-size 1 25 \
+    --mode direct deadband spool --journal-mode WAL DELETE --output benchmark.json
+
+Le résultat est un JSON (une entrée par scénario) à comparer entre deux versions :
+inserts/s, latences p50/p99/max des écritures et des lectures, nouvelles tentatives après un
+verrou, et taille finale des fichiers.
+"""
+
+import argparse
+from array import array
+from itertools import product
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+from time import perf_counter, time
+
+from objct.base_de_donnee import ConnectionProfile, Database, TRANSACTION_FAILURES, \
+    TRANSACTION_RETRIES
+from objct.logger import logger
+from objct.spool import Spool, SpoolDrainer
+from objct.storage_policy import DeadbandPolicy
+
+
+MODES = ('direct', 'deadband', 'spool')  # Écriture directe, avec `DeadbandPolicy`, via `Spool`
+SPOOL_INTERVAL_MS = 200  # Temps entre deux écritures du `SpoolDrainer` en mode spool
+READ_WINDOW_MS = 10000  # Plage lue par les lecteurs (les dernières secondes écrites)
+
+
+def percentiles(latencies):
+    """
+    :param latencies: Durées en secondes
+    :return: Dictionnaire des p50, p99 et max en millisecondes (None si aucune durée)
+    """
+    if not latencies:
+        return {'p50_ms': None, 'p99_ms': None, 'max_ms': None}
+    values = sorted(latencies)
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 4)
+
+    return {'p50_ms': at(0.5), 'p99_ms': at(0.99), 'max_ms': round(values[-1] * 1000, 4)}
+
+
+def speed_at(index):
+    """
+    :return: Une vitesse qui change par paliers (pour que le mode deadband ait quelque chose à
+             filtrer), comme une machine qui accélère puis ralentit
+    """
+    return (index // 50) % 200
+
+
+def database_size(directory):
+    """
+    :return: Taille totale en octets des fichiers de la base de données du dossier (WAL compris,
+             sans le spool)
+    """
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+               if not name.endswith('.spool'))
+
+
+class Scenario:
+    """
+    Un scénario du benchmark : mode d'écriture, concurrence et réglages SQLite.
+    """
+    def __init__(self, mode, writers, readers, batch_size, journal_mode, synchronous, duration_s):
+        """
+        Crée une nouvelle instance de `Scenario`
+        :param mode: Mode d'écriture (voir `MODES`)
+        :param writers: Nombre de threads qui écrivent
+        :param readers: Nombre de threads qui lisent
+        :param batch_size: Nombre de vitesses par écriture groupée
+        :param journal_mode: Mode de journalisation SQLite
+        :param synchronous: Niveau de synchronisation SQLite
+        :param duration_s: Durée du scénario en secondes
+        """
+        self.mode = mode
+        self.writers = writers
+        self.readers = readers
+        self.batch_size = batch_size
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.duration_s = duration_s
+
+    def describe(self):
+        """
+        :return: Les paramètres du scénario
+        """
+        return {'mode': self.mode, 'writers': self.writers, 'readers': self.readers,
+                'batch_size': self.batch_size, 'journal_mode': self.journal_mode,
+                'synchronous': self.synchronous, 'duration_s': self.duration_s}
+
+    def _database(self, location, **kwargs):
+        """
+        :return: Une `Database` avec les réglages du scénario
+        """
+        profile = ConnectionProfile(journal_mode=self.journal_mode, synchronous=self.synchronous)
+        return Database(location, profile=profile, **kwargs)
+
+    def run(self):
+        """
+        Exécute le scénario dans un dossier temporaire, supprimé à la fin.
+        :return: Les paramètres et les mesures du scénario
+        """
+        directory = tempfile.mkdtemp(prefix='mondon_benchmark_')
+        try:
+            return self._run(directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _run(self, directory):
+        location = os.path.join(directory, 'mondon.db')
+        # Crée les tables avant de lancer les threads
+        self._database(location).close()
+
+        stop_event = threading.Event()
+        start_ms = int(time() * 1000)
+        write_latencies = [array('d') for _ in range(self.writers)]
+        read_latencies = [array('d') for _ in range(self.readers)]
+        errors = [0]
+        errors_lock = threading.Lock()
+        retries_before = TRANSACTION_RETRIES.value
+        failures_before = TRANSACTION_FAILURES.value
+
+        spool = drainer = None
+        if self.mode == 'spool':
+            spool = Spool(os.path.join(directory, 'mondon.spool'))
+            drainer = SpoolDrainer(spool, location, interval_ms=SPOOL_INTERVAL_MS,
+                                   profile=ConnectionProfile(journal_mode=self.journal_mode,
+                                                             synchronous=self.synchronous))
+            drainer.start()
+
+        def count_error(e):
+            logger.warning("BENCHMARK", "Erreur: {}", e)
+            with errors_lock:
+                errors[0] += 1
+
+        def writer(writer_index):
+            latencies = write_latencies[writer_index]
+            db = None
+            if spool is None:
+                policy = DeadbandPolicy(deadband=0) if self.mode == 'deadband' else None
+                db = self._database(location, batch_size=self.batch_size,
+                                    batch_delay_ms=60000, storage_policy=policy)
+            index = 0
+            try:
+                while not stop_event.is_set():
+                    # Temps uniques entre les threads : chaque vitesse est bien écrite
+                    ts = start_ms + index * self.writers + writer_index
+                    value = speed_at(index)
+                    begin = perf_counter()
+                    try:
+                        if spool is None:
+                            db.insert_speed(value, ts)
+                        else:
+                            spool.append_speed(ts, value)
+                    except Exception as e:
+                        count_error(e)
+                    latencies.append(perf_counter() - begin)
+                    index += 1
+            finally:
+                if db is not None:
+                    try:
+                        db.close()
+                    except Exception as e:
+                        count_error(e)
+
+        def reader(reader_index):
+            latencies = read_latencies[reader_index]
+            db = self._database(location, rollups=False)
+            try:
+                while not stop_event.is_set():
+                    # Les temps écrits avancent de `writers` par vitesse : la fin de la plage
+                    # est estimée à partir du nombre de vitesses déjà écrites
+                    written = sum(len(l) for l in write_latencies) or 1
+                    end = start_ms + written
+                    begin = perf_counter()
+                    try:
+                        db.get_speed_stats(max(start_ms, end - READ_WINDOW_MS), end)
+                        for _ in db.iter_speeds(max(start_ms, end - 1000), end):
+                            pass
+                    except Exception as e:
+                        count_error(e)
+                    latencies.append(perf_counter() - begin)
+            finally:
+                db.close()
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(self.writers)] + \
+                  [threading.Thread(target=reader, args=(i,)) for i in range(self.readers)]
+        begin = perf_counter()
+        for thread in threads:
+            thread.start()
+        stop_event.wait(self.duration_s)
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+        if drainer is not None:
+            drainer.stop()
+            spool.close()
+        elapsed = perf_counter() - begin
+
+        all_writes = [latency for latencies in write_latencies for latency in latencies]
+        all_reads = [latency for latencies in read_latencies for latency in latencies]
+        conn = sqlite3.connect(location)
+        try:
+            rows = conn.execute("SELECT count(*) FROM mondon_speed").fetchone()[0]
+        finally:
+            conn.close()
+        result = self.describe()
+        result.update({
+            'elapsed_s': round(elapsed, 3),
+            'inserts': len(all_writes),
+            'inserts_per_s': round(len(all_writes) / elapsed, 1),
+            'write_latency': percentiles(all_writes),
+            'reads': len(all_reads),
+            'reads_per_s': round(len(all_reads) / elapsed, 1),
+            'read_latency': percentiles(all_reads),
+            'rows_written': rows,
+            'lock_retries': TRANSACTION_RETRIES.value - retries_before,
+            'transaction_failures': TRANSACTION_FAILURES.value - failures_before,
+            'errors': errors[0],
+            'file_size_bytes': database_size(directory),
+        })
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark des écritures et lectures de la base "
+                                                 "de données (résultat en JSON)")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="Durée de chaque scénario en secondes")
+    parser.add_argument('--mode', nargs='+', choices=MODES, default=['direct'],
+                        help="Modes d'écriture à comparer")
+    parser.add_argument('--writers', nargs='+', type=int, default=[1],
+                        help="Nombres de threads qui écrivent")
+    parser.add_argument('--readers', nargs='+', type=int, default=[0],
+                        help="Nombres de threads qui lisent")
+    parser.add_argument('--batch-size', nargs='+', type=int, default=[1, 25],
+                        help="Tailles des écritures groupées (modes direct et deadband)")
+    parser.add_argument('--journal-mode', nargs='+', default=['WAL'],
+                        help="Modes de journalisation SQLite (WAL, DELETE, ...)")
+    parser.add_argument('--synchronous', nargs='+', default=['NORMAL'],
+                        help="Niveaux de synchronisation SQLite (OFF, NORMAL, FULL)")
+    parser.add_argument('--output', default=None,
+                        help="Fichier où écrire le JSON (par défaut la sortie standard)")
+    args = parser.parse_args()
+
+    logger.log_app_start()
+    logger.set_level(logger.ERROR)
+
+    scenarios = []
+    for mode, writers, readers, journal_mode, synchronous in product(
+            args.mode, args.writers, args.readers, args.journal_mode, args.synchronous):
+        # La taille des lots n'a pas de sens en mode spool (écrit par `SpoolDrainer`)
+        batch_sizes = [SpoolDrainer.BATCH_SIZE] if mode == 'spool' else args.batch_size
+        for batch_size in batch_sizes:
+            scenarios.append(Scenario(mode, writers, readers, batch_size, journal_mode,
+                                      synchronous, args.duration))
+
+    results = []
+    for number, scenario in enumerate(scenarios, 1):
+        print("[{}/{}] {}".format(number, len(scenarios), scenario.describe()), file=sys.stderr)
+        result = scenario.run()
+        print("    {} inserts/s, p99 {} ms, {} nouvelles tentatives".format(
+            result['inserts_per_s'], result['write_latency']['p99_ms'], result['lock_retries']),
+            file=sys.stderr)
+        results.append(result)
+
+    report = {
+        'created_at': int(time() * 1000),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
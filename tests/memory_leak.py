@@ -1,91 +1,248 @@
-from itertools import groupby
-import operator
-import resource
-from pympler import tracker, muppy, summary
-from random import randint
-from threading import Thread
-from time import time, sleep
-
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Test d'endurance mémoire en temps accéléré : la vraie boucle d'acquisition
+(`SpeedAcquisitionSimulator.run`, avec ses erreurs simulées, reconnexions, écritures dans la
+base de données et lignes de log) est exécutée sans attendre entre deux échéances, pendant
+des millions de cycles (1 million de cycles = 2.8 jours de production à 240 ms).
+
+Après une phase de chauffe, des snapshots tracemalloc sont comparés au premier. Le test échoue
+(code de sortie 1) si la mémoire résidente, la mémoire allouée par une même ligne de code ou le
+nombre de fichiers ouverts augmente plus que le budget.
+
+Exemple (depuis la racine du dépôt) :
+PYTHONPATH=. python tests/memory_leak.py --cycles 2000000 --max-rss-growth-mb 32
+"""
+
+import argparse
+import ctypes
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 
-from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QApplication
-
-from objct.base_de_donnee import Database
+from objct.acquisition import SpeedAcquisition, SpeedAcquisitionSimulator
+from objct.backoff import Backoff
 from objct.logger import logger
-from objct.main_window import MainWindow
-from objct.speed_thread import SpeedThreadSimulator
-
-
-def memory_usage_thread_func():
-    tr = tracker.SummaryTracker()
-    sleep(20)
-    first_summary = tr.create_summary()
-    while True:
-        latest_summary = tr.create_summary()
-        tr.print_diff(summary1=first_summary, summary2=latest_summary)
-        self_use = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1000 * 1000)
-        print('Memory usage: {} Mb'.format(self_use))
-        sleep(10)
-
-Thread(target=memory_usage_thread_func).start()
-
-
-logger.log_app_start()
-
-logger.log("INITIALISATION", "Création de la QApplication avec les paramètres: {}".format(sys.argv))
-app = QApplication(sys.argv)
-
-logger.log("INITIALISATION", "Définition de l'icone de l'application")
-app.setWindowIcon(QIcon('icon/logo_get_speed.ico'))
-
-logger.log("INITIALISATION", "Initialisation de Database")
-db = Database('../../mondon.db')
-
-logger.log("INITIALISATION", "Création de MainWindow")
-window = MainWindow(database=db)
-
-logger.log("INITIALISATION", "Configuration de MainWindow")
-window.setFixedSize(250, 50)
-window.setWindowTitle("Get speed")
-
-logger.log("INITIALISATION", "Affichage de MainWindow")
-window.show()
-
-logger.log("INITIALISATION", "Création de SpeedThread (Simulator)")
-speed_thread = SpeedThreadSimulator(automate_ip=None, automate_port=None)
-
-logger.log("INITIALISATION", "MainWindow écoute SpeedThread")
-window.watch_signal(speed_thread.NEW_SPEED_SIGNAL)
-
-logger.log("INITIALISATION", "Démarrage de SpeedThread")
-speed_thread.start()
-
-sys.exit(app.exec_())
-
-# def insert_in_db():
-#     new_speed = randint(1, 200)
-#     new_time = int(round(time() * 1000))
-#     # print('inserting ({}, {})'.format(new_speed, new_time))
-#     try:
-#         db.insert_speed(new_speed, new_time)
-#         # print('inserted ({}, {})'.format(new_speed, new_time))
-#     except Exception as e:
-#         print('failed for ({}, {}), error:\n{}\n{}\n\n\n'
-#               .format(new_speed, new_time, e.__class__.__name__, e))
-
-
-
-# dicts = [repr(ao) for ao in all_objects if isinstance(ao, dict)]
-# grouped = [(len(list(v)), k) for k, v in groupby(sorted(dicts))]
-# sorted_group = reversed(sorted(grouped, key=operator.itemgetter(0)))
-# for data in sorted_group:
-#     print(str(data[0]).ljust(5), data[1][:100])
-
-
-# strs = [ao for ao in all_objects if isinstance(ao, str)]
-# grouped = [(len(list(v)), k) for k, v in groupby(sorted(strs))]
-# sorted_group = reversed(sorted(grouped, key=operator.itemgetter(0)))
-#
-# for data in sorted_group:
-#     print(str(data[0]).ljust(5), data[1])
+from objct.scheduler import Tick
+
+try:
+    import resource
+except ImportError:
+    # Windows : la mémoire résidente est lue avec GetProcessMemoryInfo (voir `rss_kb`)
+    resource = None
+
+
+# Fichiers dont les allocations ne sont pas comptées (outils de mesure et imports)
+IGNORED_FILES = (tracemalloc.__file__, '<frozen importlib._bootstrap>',
+                 '<frozen importlib._bootstrap_external>', '<unknown>')
+
+
+class VirtualScheduler:
+    """
+    Remplace `FixedRateScheduler` : chaque échéance arrive tout de suite, avec un temps prévu qui
+    avance d'une période (le temps simulé avance beaucoup plus vite que le temps réel).
+    `pause` bloque la boucle d'acquisition dans `wait_next` pendant les snapshots.
+    """
+    def __init__(self, period_ms):
+        """
+        Crée une nouvelle instance de `VirtualScheduler`
+        :param period_ms: Période simulée entre deux échéances
+        """
+        self.period_ms = period_ms
+        self.start_ms = int(time.time() * 1000)
+        self.index = 0
+        self.missed_ticks = 0
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._parked = threading.Event()
+
+    def reset(self):
+        """
+        Appelé après chaque reconnexion : le temps simulé continue (pas de doublons).
+        """
+        pass
+
+    def pause(self, timeout=None):
+        """
+        Bloque la prochaine échéance et attend que la boucle d'acquisition l'attende : plus
+        aucune ligne de log ni écriture ne vient de cette boucle jusqu'à `resume`.
+        :param timeout: Temps maximum d'attente en secondes (None pour attendre indéfiniment)
+        :return: True si la boucle d'acquisition est bloquée
+        """
+        self._parked.clear()
+        self._resumed.clear()
+        return self._parked.wait(timeout)
+
+    def resume(self):
+        """
+        Débloque la boucle d'acquisition après `pause`.
+        """
+        self._resumed.set()
+
+    def wait_next(self):
+        """
+        :return: Le `Tick` de l'échéance suivante, sans attendre (sauf pendant une pause)
+        """
+        if not self._resumed.is_set():
+            self._parked.set()
+            self._resumed.wait()
+        self.index += 1
+        scheduled_ms = self.start_ms + self.index * self.period_ms
+        return Tick(self.index, scheduled_ms, scheduled_ms, 0)
+
+
+class ProcessMemoryCounters(ctypes.Structure):
+    """
+    Structure PROCESS_MEMORY_COUNTERS de Windows (voir `rss_kb`).
+    """
+    _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong)] + \
+        [(name, ctypes.c_size_t) for name in ('PeakWorkingSetSize', 'WorkingSetSize',
+                                              'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                                              'QuotaPeakNonPagedPoolUsage',
+                                              'QuotaNonPagedPoolUsage', 'PagefileUsage',
+                                              'PeakPagefileUsage')]
+
+
+def rss_kb():
+    """
+    :return: La mémoire résidente actuelle en kilo-octets (la plus haute si /proc n'existe pas et
+             que l'on n'est pas sous Windows)
+    """
+    if os.name == 'nt':
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters.WorkingSetSize // 1024
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def open_files():
+    """
+    :return: Le nombre de descripteurs de fichiers ouverts (None si inconnu)
+    """
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def take_snapshot():
+    """
+    :return: Un snapshot tracemalloc sans les allocations de `IGNORED_FILES`
+    """
+    snapshot = tracemalloc.take_snapshot()
+    return snapshot.filter_traces([tracemalloc.Filter(False, name) for name in IGNORED_FILES])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test d'endurance mémoire de l'acquisition")
+    parser.add_argument('--cycles', type=int, default=1000000,
+                        help="Nombre d'échéances simulées")
+    parser.add_argument('--warmup', type=int, default=50000,
+                        help="Nombre d'échéances avant le snapshot de référence")
+    parser.add_argument('--snapshot-every', type=int, default=200000,
+                        help="Nombre d'échéances entre deux snapshots")
+    parser.add_argument('--max-rss-growth-mb', type=float, default=32,
+                        help="Augmentation maximum de la mémoire résidente (le cache de pages "
+                             "SQLite en fait partie)")
+    parser.add_argument('--max-site-growth-kb', type=float, default=256,
+                        help="Augmentation maximum de la mémoire allouée par une même ligne")
+    parser.add_argument('--max-open-files-growth', type=int, default=2,
+                        help="Augmentation maximum du nombre de fichiers ouverts")
+    parser.add_argument('--frames', type=int, default=1,
+                        help="Profondeur des traces tracemalloc")
+    parser.add_argument('--spool', action='store_true',
+                        help="Écrit les valeurs via un spool (voir `Spool`)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='mondon_soak_')
+    # Les fichiers de log (plusieurs centaines de Mo) sont écrits dans le dossier temporaire
+    logger.set_log_directory(directory)
+    logger.log_app_start()
+    # Une ligne de log par échéance en plus de celles de la boucle d'acquisition
+    logger.set_level(logger.DEBUG, "SPEED_THREAD")
+    logger.set_level(logger.WARNING, "DATABASE")
+
+    acquisition = SpeedAcquisitionSimulator(
+        automate_ip=None, automate_port=None, db_location=os.path.join(directory, 'mondon.db'),
+        db_batch_size=25, db_batch_delay_ms=2000, use_scheduled_time=True,
+        spool_location=os.path.join(directory, 'mondon.spool') if args.spool else None)
+    scheduler = acquisition.scheduler = VirtualScheduler(SpeedAcquisition.SLEEP_TIME_MS)
+    # Les erreurs simulées (1%) passent par `_handle_failure` sans attendre
+    acquisition.backoff = Backoff(initial_ms=0, max_ms=0)
+
+    tracemalloc.start(args.frames)
+    acquisition.start()
+    begin = time.monotonic()
+    baseline = baseline_rss = baseline_files = None
+    next_snapshot = args.warmup
+    failures = []
+    try:
+        while True:
+            time.sleep(0.2)
+            index = scheduler.index
+            if index < next_snapshot and index < args.cycles:
+                continue
+            # La boucle d'acquisition est arrêtée pendant le snapshot : sinon elle remplit de
+            # nouveau la queue du logger pendant `flush`, et ces lignes ne sont pas une fuite
+            scheduler.pause(timeout=5)
+            try:
+                index = scheduler.index
+                logger.flush(timeout=5)
+                snapshot = take_snapshot()
+                current_rss, current_files = rss_kb(), open_files()
+            finally:
+                scheduler.resume()
+            elapsed = time.monotonic() - begin
+            print("{:>9} cycles en {:.0f} s ({:.0f}/s), RSS {:.1f} Mo, {} fichiers ouverts, "
+                  "{} lignes de log abandonnées"
+                  .format(index, elapsed, index / elapsed, current_rss / 1024, current_files,
+                          logger.dropped_count))
+            if baseline is None:
+                baseline, baseline_rss, baseline_files = snapshot, current_rss, current_files
+            else:
+                for stat in snapshot.compare_to(baseline, 'lineno')[:5]:
+                    print("    {}".format(stat))
+            next_snapshot = index + args.snapshot_every
+            if index >= args.cycles:
+                break
+    finally:
+        scheduler.resume()
+        acquisition.stop()
+        tracemalloc.stop()
+
+    rss_growth_mb = (current_rss - baseline_rss) / 1024
+    if rss_growth_mb > args.max_rss_growth_mb:
+        failures.append("RSS: +{:.1f} Mo (budget {} Mo)"
+                        .format(rss_growth_mb, args.max_rss_growth_mb))
+    for stat in snapshot.compare_to(baseline, 'lineno'):
+        if stat.size_diff / 1024 > args.max_site_growth_kb:
+            failures.append("{} (budget {} Ko)".format(stat, args.max_site_growth_kb))
+    if current_files is not None and baseline_files is not None \
+            and current_files - baseline_files > args.max_open_files_growth:
+        failures.append("Fichiers ouverts: {} -> {} (budget +{})"
+                        .format(baseline_files, current_files, args.max_open_files_growth))
+
+    # Le fichier de log est fermé avant de supprimer le dossier (impossible sous Windows sinon)
+    logger.close()
+    shutil.rmtree(directory, ignore_errors=True)
+    print("Transitions: {}".format(acquisition.transition_counts))
+    if failures:
+        print("ÉCHEC, budget dépassé :")
+        for failure in failures:
+            print("    {}".format(failure))
+        sys.exit(1)
+    print("OK : RSS +{:.1f} Mo".format(rss_growth_mb))
+
+
+if __name__ == '__main__':
+    main()
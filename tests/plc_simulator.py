@@ -0,0 +1,536 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Simulateur d'automates FINS/TCP et FINS/UDP en local, pour tester le vrai chemin réseau
+(socket, trames, reconnexion) de `SpeedAcquisition` et `AcquisitionEngine` sans l'automate de la
+ligne.
+
+Chaque automate simulé écoute sur son propre port (en TCP et en UDP), répond à la demande
+d'adresse de nœud (`CONNECT`) puis aux commandes MEMORY AREA READ (`GET_SPEED`) et MULTIPLE
+MEMORY AREA READ. La
+vitesse est écrite dans le mot de `SPEED_TAG` selon un profil, les autres mots valent 0 sauf
+si `set_word` est utilisé.
+
+Exemples (depuis la racine du dépôt) :
+PYTHONPATH=. python tests/plc_simulator.py --port 9600 --profile sine:120:60:30
+PYTHONPATH=. python tests/plc_simulator.py --plcs 20 --latency-ms 5 --jitter-ms 20 \
+    --split 7 --error-rate 0.01 --disconnect-every 500 --acquire 60
+PYTHONPATH=. python tests/plc_simulator.py --latency-ms 120 --acquire 30 --transport udp \
+    --period-ms 50 --in-flight 4
+
+Profils de vitesse :
+- constant:V
+- ramp:MIN:MAX:PERIODE_S (dent de scie)
+- sine:MOYENNE:AMPLITUDE:PERIODE_S
+- steps:V1,V2,...:DUREE_S (chaque valeur pendant DUREE_S)
+- random:MIN:MAX
+- file:CHEMIN (JSON [[temps_s, vitesse], ...], interpolé linéairement et rejoué en boucle)
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+from time import monotonic, sleep
+
+from objct.automate_command import AREA_AR, AREA_AR_BIT, AREA_CIO, AREA_CIO_BIT, AREA_DM, \
+    AREA_DM_BIT, AREA_HR, AREA_HR_BIT, AREA_WR, AREA_WR_BIT, BIT_AREAS, MEMORY_AREA_READ, \
+    MULTIPLE_MEMORY_AREA_READ, READ_ITEM, SPEED_TAG, WORD
+from objct.fins import FINS_HEADER, FINS_RESPONSE_HEADER, ICF_RESPONSE, NODE_ADDRESS, \
+    TCP_COMMAND_FRAME_SEND, TCP_COMMAND_NODE_ADDRESS_REQUEST, TCP_COMMAND_NODE_ADDRESS_RESPONSE, \
+    TCP_HEADER, TCP_MAGIC
+
+
+# Zone mot correspondant à chaque zone bit (un bit est lu dans le mot de même adresse)
+WORD_AREA_OF_BIT_AREA = {AREA_CIO_BIT: AREA_CIO, AREA_WR_BIT: AREA_WR, AREA_HR_BIT: AREA_HR,
+                         AREA_AR_BIT: AREA_AR, AREA_DM_BIT: AREA_DM}
+END_CODE_NORMAL = 0x0000
+END_CODE_NOT_SUPPORTED = 0x0401  # Commande non supportée
+END_CODE_ADDRESS_RANGE = 0x1103  # Adresse hors limites
+TCP_ERROR_NOT_SUPPORTED = 0x03  # Commande FINS/TCP non supportée
+SERVER_NODE = 0x01  # Nœud de l'automate simulé
+FIRST_CLIENT_NODE = 0xEF  # Nœud attribué au premier client qui demande une adresse automatique
+MAX_FRAME_SIZE = 4096
+
+
+class SpeedProfile:
+    """
+    Vitesse de l'automate en fonction du temps (voir les profils dans la description du module).
+    """
+    def __init__(self, spec, phase_s=0):
+        """
+        Crée une nouvelle instance de `SpeedProfile`
+        :param spec: Description du profil (ex: "sine:120:60:30")
+        :param phase_s: Décalage dans le temps (pour que plusieurs automates soient différents)
+        """
+        kind, _, args = spec.partition(':')
+        self.spec = spec
+        self.phase_s = phase_s
+        self._start = monotonic()
+        if kind == 'file':
+            with open(args) as f:
+                self._points = [(float(t), float(v)) for t, v in json.load(f)]
+            if not self._points:
+                raise ValueError("Profil vide: {}".format(args))
+            self._value = self._interpolate
+        else:
+            params = args.split(':') if args else []
+            functions = {
+                'constant': lambda v: lambda t: float(v),
+                'ramp': lambda low, high, period: lambda t: float(low) + (
+                    float(high) - float(low)) * ((t % float(period)) / float(period)),
+                'sine': lambda mean, amplitude, period: lambda t: float(mean) + float(
+                    amplitude) * math.sin(2 * math.pi * t / float(period)),
+                'steps': lambda values, duration: lambda t: float(values.split(',')[
+                    int(t // float(duration)) % len(values.split(','))]),
+                'random': lambda low, high: lambda t: random.uniform(float(low), float(high)),
+            }
+            if kind not in functions:
+                raise ValueError("Profil de vitesse inconnu: {}".format(spec))
+            self._value = functions[kind](*params)
+
+    def _interpolate(self, t):
+        """
+        :return: La vitesse du profil "file" au temps `t`, rejoué en boucle
+        """
+        points = self._points
+        t = t % points[-1][0] if points[-1][0] > 0 else 0
+        previous = points[0]
+        for point in points:
+            if point[0] >= t:
+                if point[0] == previous[0]:
+                    return point[1]
+                ratio = (t - previous[0]) / (point[0] - previous[0])
+                return previous[1] + (point[1] - previous[1]) * ratio
+            previous = point
+        return points[-1][1]
+
+    def speed(self):
+        """
+        :return: La vitesse courante (entier entre 0 et 0xFFFF)
+        """
+        value = self._value(monotonic() - self._start + self.phase_s)
+        return max(0, min(0xFFFF, int(round(value))))
+
+
+class FaultConfig:
+    """
+    Défauts injectés par un automate simulé.
+    """
+    def __init__(self, latency_ms=0, jitter_ms=0, split=0, error_rate=0, error_code=None,
+                 disconnect_every=0, disconnect_rate=0, seed=None):
+        """
+        Crée une nouvelle instance de `FaultConfig`
+        :param latency_ms: Temps de réponse minimum
+        :param jitter_ms: Temps ajouté au hasard (entre 0 et `jitter_ms`) à chaque réponse
+        :param split: Si non nul, les réponses sont envoyées par segments de `split` octets
+        :param error_rate: Probabilité qu'une réponse ait un code de fin d'erreur
+        :param error_code: Code de fin des réponses en erreur (par défaut `END_CODE_ADDRESS_RANGE`)
+        :param disconnect_every: Ferme la connexion après ce nombre de réponses (0 pour jamais)
+        :param disconnect_rate: Probabilité de fermer la connexion au lieu de répondre (en UDP,
+                                de perdre le datagramme)
+        :param seed: Graine du générateur aléatoire (pour rejouer un test)
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.split = split
+        self.error_rate = error_rate
+        self.error_code = END_CODE_ADDRESS_RANGE if error_code is None else error_code
+        self.disconnect_every = disconnect_every
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    """
+    Serveur FINS/UDP d'un `SimulatedPlc` : chaque datagramme reçu contient une trame FINS.
+    """
+    def __init__(self, plc):
+        """
+        Crée une nouvelle instance de `UdpProtocol`
+        :param plc: `SimulatedPlc` qui répond aux trames
+        """
+        self.plc = plc
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        faults = self.plc.faults
+        if len(data) < FINS_HEADER.size or \
+                faults.disconnect_rate and faults.random.random() < faults.disconnect_rate:
+            # Datagramme perdu
+            self.plc.stats['disconnects'] += 1
+            return
+        response = self.plc.answer_fins(data)
+        delay_ms = faults.latency_ms + faults.random.uniform(0, faults.jitter_ms)
+        asyncio.get_running_loop().call_later(delay_ms / 1000, self.transport.sendto, response,
+                                              addr)
+
+
+class SimulatedPlc:
+    """
+    Un automate simulé : mémoire, profil de vitesse et serveurs FINS/TCP et FINS/UDP.
+    Les requêtes qui arrivent ensemble (client qui envoie plusieurs requêtes sans attendre les
+    réponses) reçoivent leurs réponses dans un seul envoi, ce qui produit des segments TCP qui
+    contiennent plusieurs trames. Le temps de réponse (`latency_ms`) est celui d'un réseau : les
+    requêtes suivantes sont lues pendant que les réponses précédentes attendent.
+    """
+    def __init__(self, name, profile, faults, host='127.0.0.1', port=0):
+        """
+        Crée une nouvelle instance de `SimulatedPlc`
+        :param name: Nom de l'automate (pour les statistiques)
+        :param profile: `SpeedProfile` écrit dans le mot de `SPEED_TAG`
+        :param faults: `FaultConfig` des défauts injectés
+        :param host: Adresse d'écoute
+        :param port: Port d'écoute (0 pour un port libre)
+        """
+        self.name = name
+        self.profile = profile
+        self.faults = faults
+        self.host = host
+        self.port = port
+        self.memory = {}  # (zone mot, adresse) -> valeur du mot
+        self.server = None
+        self.udp = None
+        self._clients = set()  # Tâches des connexions en cours
+        self._next_client_node = FIRST_CLIENT_NODE
+        self.stats = {'connections': 0, 'requests': 0, 'errors': 0, 'disconnects': 0}
+
+    def set_word(self, area, address, value):
+        """
+        Écrit un mot de la mémoire simulée.
+        """
+        self.memory[(area, address)] = value & 0xFFFF
+
+    def _word(self, area, address):
+        """
+        :return: La valeur d'un mot, la vitesse étant calculée à la lecture
+        """
+        if (area, address) == (SPEED_TAG.area, SPEED_TAG.address):
+            return self.profile.speed()
+        return self.memory.get((area, address), 0)
+
+    async def start(self):
+        """
+        Démarre le serveur (le port choisi est dans `port`).
+        """
+        self.server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.udp, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: UdpProtocol(self), local_addr=(self.host, self.port))
+
+    async def stop(self):
+        """
+        Arrête le serveur et ferme les connexions en cours.
+        """
+        if self.server:
+            self.server.close()
+        if self.udp:
+            self.udp.close()
+        for task in list(self._clients):
+            task.cancel()
+        await asyncio.gather(*self._clients, return_exceptions=True)
+        if self.server:
+            await self.server.wait_closed()
+
+    def _answer(self, tcp_command, body):
+        """
+        Construit la réponse à une trame.
+        :return: La trame de réponse, ou None si la connexion doit être fermée
+        """
+        if tcp_command == TCP_COMMAND_NODE_ADDRESS_REQUEST:
+            # Le corps contient le nœud demandé par le client (0 pour une attribution automatique)
+            client_node = struct.unpack_from('>I', body)[0] if len(body) >= 4 else 0
+            if not client_node:
+                client_node = self._next_client_node
+                self._next_client_node = self._next_client_node % 0xFE + 1
+            data = NODE_ADDRESS.pack(client_node, SERVER_NODE)
+            return TCP_HEADER.pack(TCP_MAGIC, 8 + len(data), TCP_COMMAND_NODE_ADDRESS_RESPONSE,
+                                   0) + data
+        if tcp_command != TCP_COMMAND_FRAME_SEND or len(body) < FINS_HEADER.size:
+            return TCP_HEADER.pack(TCP_MAGIC, 8, tcp_command, TCP_ERROR_NOT_SUPPORTED)
+        fins = self.answer_fins(body)
+        return TCP_HEADER.pack(TCP_MAGIC, 8 + len(fins), TCP_COMMAND_FRAME_SEND, 0) + fins
+
+    def answer_fins(self, body):
+        """
+        Construit la réponse à une trame FINS (sans en-tête FINS/TCP).
+        """
+        self.stats['requests'] += 1
+        fields = FINS_HEADER.unpack_from(body)
+        _, _, _, dna, da1, da2, sna, sa1, sa2, sid, mrc, src = fields
+        params = body[FINS_HEADER.size:]
+        end_code, data = END_CODE_NORMAL, b''
+        if self.faults.error_rate and self.faults.random.random() < self.faults.error_rate:
+            end_code = self.faults.error_code
+        elif (mrc, src) == MEMORY_AREA_READ:
+            area, address, _ = READ_ITEM.unpack_from(params)
+            count = WORD.unpack_from(params, READ_ITEM.size)[0]
+            data = b''.join(WORD.pack(self._word(area, address + i)) for i in range(count))
+        elif (mrc, src) == MULTIPLE_MEMORY_AREA_READ:
+            chunks = []
+            for offset in range(0, len(params) - READ_ITEM.size + 1, READ_ITEM.size):
+                area, address, bit = READ_ITEM.unpack_from(params, offset)
+                if area in BIT_AREAS:
+                    word = self._word(WORD_AREA_OF_BIT_AREA[area], address)
+                    chunks.append(bytes((area, word >> bit & 1)))
+                else:
+                    chunks.append(bytes((area,)) + WORD.pack(self._word(area, address)))
+            data = b''.join(chunks)
+        else:
+            end_code = END_CODE_NOT_SUPPORTED
+        if end_code:
+            self.stats['errors'] += 1
+        # Les adresses source et destination sont inversées dans la réponse
+        return FINS_RESPONSE_HEADER.pack(0x80 | ICF_RESPONSE, 0, 0x02, sna, sa1, sa2, dna, da1,
+                                         da2, sid, mrc, src, end_code) + data
+
+    async def _send(self, writer, data):
+        """
+        Envoie les réponses, éventuellement découpées en petits segments.
+        """
+        split = self.faults.split
+        if not split:
+            writer.write(data)
+            await writer.drain()
+            return
+        for offset in range(0, len(data), split):
+            writer.write(data[offset:offset + split])
+            await writer.drain()
+            # Laisse partir le segment avant d'écrire le suivant
+            await asyncio.sleep(0)
+
+    async def _sender(self, writer, queue):
+        """
+        Envoie les réponses de `queue` (temps monotonic d'envoi, données) dans l'ordre, chacune
+        à son temps d'envoi.
+        """
+        while True:
+            due, data = await queue.get()
+            if due > monotonic():
+                await asyncio.sleep(due - monotonic())
+            await self._send(writer, data)
+            queue.task_done()
+
+    async def _handle_client(self, reader, writer):
+        """
+        Traite une connexion client jusqu'à sa fermeture.
+        """
+        self.stats['connections'] += 1
+        task = asyncio.current_task()
+        self._clients.add(task)
+        faults = self.faults
+        buffer = bytearray()
+        answered = 0
+        queue = asyncio.Queue()
+        sender = asyncio.ensure_future(self._sender(writer, queue))
+        try:
+            while True:
+                chunk = await reader.read(MAX_FRAME_SIZE)
+                if not chunk:
+                    return
+                buffer += chunk
+                responses = []
+                while len(buffer) >= TCP_HEADER.size:
+                    magic, length, tcp_command, _ = TCP_HEADER.unpack_from(buffer)
+                    if magic != TCP_MAGIC or not 8 <= length <= MAX_FRAME_SIZE:
+                        return
+                    size = TCP_HEADER.size + length - 8
+                    if len(buffer) < size:
+                        break
+                    body = bytes(buffer[TCP_HEADER.size:size])
+                    del buffer[:size]
+                    if faults.disconnect_rate and \
+                            faults.random.random() < faults.disconnect_rate:
+                        self.stats['disconnects'] += 1
+                        return
+                    responses.append(self._answer(tcp_command, body))
+                    answered += 1
+                    if faults.disconnect_every and answered >= faults.disconnect_every:
+                        break
+                if not responses:
+                    continue
+                delay_ms = faults.latency_ms + faults.random.uniform(0, faults.jitter_ms)
+                queue.put_nowait((monotonic() + delay_ms / 1000, b''.join(responses)))
+                if faults.disconnect_every and answered >= faults.disconnect_every:
+                    await asyncio.wait([sender, asyncio.ensure_future(queue.join())],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    self.stats['disconnects'] += 1
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Connexion fermée par le client, ou arrêt du simulateur (`stop`)
+            pass
+        finally:
+            sender.cancel()
+            self._clients.discard(task)
+            writer.close()
+
+
+class PlcSimulator:
+    """
+    Plusieurs `SimulatedPlc` servis par une boucle asyncio dans un thread, pour être utilisé
+    depuis un autre script de test :
+    simulator = PlcSimulator(count=4, profile='sine:120:60:30')
+    ports = simulator.start()
+    ...
+    simulator.stop()
+    """
+    def __init__(self, count=1, profile='sine:120:60:30', faults=None, host='127.0.0.1',
+                 first_port=0):
+        """
+        Crée une nouvelle instance de `PlcSimulator`
+        :param count: Nombre d'automates simulés
+        :param profile: Description du profil de vitesse (voir `SpeedProfile`), décalé pour
+                        chaque automate
+        :param faults: `FaultConfig` commun à tous les automates (par défaut aucun défaut)
+        :param host: Adresse d'écoute
+        :param first_port: Port du premier automate, les suivants utilisent les ports suivants
+                           (0 pour des ports libres)
+        """
+        faults = faults or FaultConfig()
+        self.plcs = [SimulatedPlc('plc_{}'.format(i + 1), SpeedProfile(profile, phase_s=i * 1.7),
+                                  faults, host, first_port + i if first_port else 0)
+                     for i in range(count)]
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+
+    def start(self):
+        """
+        Démarre les automates dans un thread.
+        :return: La liste des ports d'écoute
+        """
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(asyncio.gather(*[plc.start() for plc in self.plcs]))
+            started.set()
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="PlcSimulator", daemon=True)
+        self._thread.start()
+        started.wait()
+        return [plc.port for plc in self.plcs]
+
+    def stop(self):
+        """
+        Arrête les automates et le thread.
+        """
+        async def stop_all():
+            await asyncio.gather(*[plc.stop() for plc in self.plcs])
+
+        asyncio.run_coroutine_threadsafe(stop_all(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def stats(self):
+        """
+        :return: Statistiques de chaque automate
+        """
+        return {plc.name: dict(plc.stats, port=plc.port) for plc in self.plcs}
+
+
+def run_acquisition(ports, duration_s, **kwargs):
+    """
+    Fait tourner la vraie acquisition contre les automates simulés pendant `duration_s`, avec
+    une base de données temporaire, puis affiche les métriques.
+    :param ports: Ports des automates simulés
+    :param kwargs: Paramètres passés à `SpeedAcquisition` avec un seul automate (period_ms,
+                   transport, max_in_flight)
+    """
+    from objct.acquisition import SpeedAcquisition
+    from objct.acquisition_engine import AcquisitionEngine, MachineConfig
+    from objct.metrics import metrics
+
+    directory = tempfile.mkdtemp(prefix='mondon_simulator_')
+    db_location = os.path.join(directory, 'mondon.db')
+    if len(ports) == 1:
+        service = SpeedAcquisition(automate_ip='127.0.0.1', automate_port=ports[0],
+                                   db_location=db_location, db_batch_size=25,
+                                   db_batch_delay_ms=2000, **kwargs)
+    else:
+        machines = [MachineConfig('plc_{}'.format(i + 1), '127.0.0.1', port,
+                                  store_speed=(i == 0))
+                    for i, port in enumerate(ports)]
+        service = AcquisitionEngine(db_location, machines, db_batch_size=25,
+                                    db_batch_delay_ms=2000)
+    print("Acquisition pendant {} s, base de données {}".format(duration_s, db_location),
+          file=sys.stderr)
+    service.start()
+    try:
+        sleep(duration_s)
+    finally:
+        service.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    for line in metrics.render().splitlines():
+        if not line.startswith('#') and '_bucket' not in line:
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulateur d'automates FINS/TCP et FINS/UDP")
+    parser.add_argument('--host', default='127.0.0.1', help="Adresse d'écoute")
+    parser.add_argument('--port', type=int, default=0,
+                        help="Port du premier automate (0 pour des ports libres)")
+    parser.add_argument('--plcs', type=int, default=1, help="Nombre d'automates simulés")
+    parser.add_argument('--profile', default='sine:120:60:30', help="Profil de vitesse")
+    parser.add_argument('--latency-ms', type=float, default=0, help="Temps de réponse minimum")
+    parser.add_argument('--jitter-ms', type=float, default=0,
+                        help="Temps de réponse supplémentaire aléatoire maximum")
+    parser.add_argument('--split', type=int, default=0,
+                        help="Envoie les réponses par segments de SPLIT octets")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="Probabilité d'une réponse avec un code de fin d'erreur")
+    parser.add_argument('--error-code', type=lambda value: int(value, 16), default=None,
+                        help="Code de fin des erreurs en hexadécimal (par défaut 1103)")
+    parser.add_argument('--disconnect-every', type=int, default=0,
+                        help="Ferme la connexion après ce nombre de réponses")
+    parser.add_argument('--disconnect-rate', type=float, default=0,
+                        help="Probabilité de fermer la connexion au lieu de répondre")
+    parser.add_argument('--seed', type=int, default=None, help="Graine du générateur aléatoire")
+    parser.add_argument('--acquire', type=float, default=None, metavar='SECONDES',
+                        help="Fait tourner l'acquisition contre les automates simulés pendant "
+                             "SECONDES puis affiche les métriques")
+    parser.add_argument('--transport', choices=('tcp', 'udp'), default=None,
+                        help="Transport FINS de l'acquisition (un seul automate)")
+    parser.add_argument('--period-ms', type=int, default=None,
+                        help="Période de l'acquisition (un seul automate)")
+    parser.add_argument('--in-flight', type=int, default=None,
+                        help="Requêtes en cours de l'acquisition (un seul automate)")
+    args = parser.parse_args()
+
+    faults = FaultConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, split=args.split,
+                         error_rate=args.error_rate, error_code=args.error_code,
+                         disconnect_every=args.disconnect_every,
+                         disconnect_rate=args.disconnect_rate, seed=args.seed)
+    simulator = PlcSimulator(args.plcs, args.profile, faults, args.host, args.port)
+    ports = simulator.start()
+    print("Automates simulés sur {}:{}".format(args.host, ', '.join(str(p) for p in ports)),
+          file=sys.stderr)
+    try:
+        if args.acquire is not None:
+            run_acquisition(ports, args.acquire, period_ms=args.period_ms,
+                            transport=args.transport, max_in_flight=args.in_flight)
+        else:
+            while True:
+                sleep(10)
+                print(json.dumps(simulator.stats()), file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(simulator.stats(), indent=2), file=sys.stderr)
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
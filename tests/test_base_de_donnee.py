@@ -0,0 +1,64 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Vérifie le nombre de lignes écrites par `Database` avec une politique de stockage "sur
+changement", et que les statistiques comptent toujours toutes les vitesses reçues.
+
+Exemple (depuis la racine du dépôt) :
+PYTHONPATH=. python -m unittest tests.test_base_de_donnee
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from objct.base_de_donnee import Database
+from objct.storage_policy import DeadbandPolicy
+
+
+class DeadbandStorageTest(unittest.TestCase):
+    POLL_PERIOD_MS = 240
+    SAMPLE_COUNT = 1000
+    START_MS = 1500000000123  # Ne tombe pas sur un début de seconde
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='mondon_database_')
+        self.path = os.path.join(self.directory, 'mondon.db')
+        # `batch_size` par défaut (`Database.BATCH_SIZE`) : un flush par vitesse
+        self.database = Database(self.path, storage_policy=DeadbandPolicy())
+
+    def tearDown(self):
+        self.database.conn.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def insert_constant_speeds(self):
+        for index in range(self.SAMPLE_COUNT):
+            self.database.insert_speed(172, self.START_MS + index * self.POLL_PERIOD_MS)
+        return self.START_MS + self.SAMPLE_COUNT * self.POLL_PERIOD_MS
+
+    def count_rows(self):
+        return sum(1 for _ in self.database.iter_speeds(0, 2 ** 62))
+
+    def test_constant_speed_writes_one_row_per_heartbeat(self):
+        end = self.insert_constant_speeds()
+        duration_ms = end - self.START_MS
+        # La première ligne, puis la vitesse qui précède chaque dépassement de `heartbeat_ms`
+        max_rows = duration_ms // (DeadbandPolicy.HEARTBEAT_MS - self.POLL_PERIOD_MS) + 1
+        self.assertLessEqual(self.count_rows(), max_rows)
+
+    def test_stats_count_every_received_speed(self):
+        end = self.insert_constant_speeds()
+        stats = self.database.get_speed_stats(self.START_MS, end)
+        self.assertEqual(stats['count'], self.SAMPLE_COUNT)
+        self.assertEqual((stats['min'], stats['max']), (172, 172))
+
+    def test_close_writes_the_last_speed(self):
+        end = self.insert_constant_speeds()
+        self.database.close()
+        self.database = Database(self.path, read_only=True)
+        self.assertEqual(self.database.get_latest_speed(), (end - self.POLL_PERIOD_MS, 172))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Vérifie que les lignes de log formatées en arrière plan montrent les arguments tels qu'ils
+étaient au moment de l'appel.
+
+Exemple (depuis la racine du dépôt) :
+PYTHONPATH=. python -m unittest tests.test_logger
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from objct.logger import Logger
+
+
+class LoggerArgumentsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='mondon_logger_')
+        # Les lignes restent dans la queue jusqu'au premier flush (voir `read_lines`)
+        self.logger = Logger(self.directory, deferred_writer=True)
+
+    def tearDown(self):
+        self.logger.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def read_lines(self):
+        self.assertTrue(self.logger.flush(timeout=5))
+        lines = []
+        for file_name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, file_name)) as log_file:
+                lines.extend(log_file.read().splitlines())
+        return lines
+
+    def test_mutable_argument_changed_after_call(self):
+        # Le thread d'écriture n'est démarré qu'au flush : la ligne est formatée après la
+        # modification
+        values = {'speed': 172, 'tension': 4}
+        self.logger.log("TEST", "Valeurs: {}", values)
+        values.pop('speed')
+        self.assertIn("Valeurs: {'speed': 172, 'tension': 4}", self.read_lines()[-1])
+
+    def test_immutable_argument_keeps_format_spec(self):
+        self.logger.log("TEST", "Attente {:.0f} ms (SID={:02X})", 1234.6, 10)
+        self.assertIn("Attente 1235 ms (SID=0A)", self.read_lines()[-1])
+
+    def test_disabled_level_is_not_converted(self):
+        class Unprintable:
+            def __str__(self):
+                raise AssertionError("Argument converti alors que le niveau est désactivé")
+        self.logger.debug("TEST", "Valeur: {}", Unprintable())
+        self.assertEqual(self.read_lines(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()